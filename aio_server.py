@@ -0,0 +1,679 @@
+import argparse
+import asyncio
+import contextvars
+import functools
+import io
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from aiohttp import web
+from itsdangerous import BadSignature
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.http import dump_options_header
+
+from aio_upstream import AsyncUpstreamSession
+from api import METABOLIGHTS_DOWNLOAD_URL, api_session, app, metabobank_bundle_files
+from catalog import CATALOG_MODE, get_catalog
+from downloads import (BUNDLE_WORKERS, DOWNLOAD_CHUNK_SIZE, FORWARDED_RESPONSE_HEADERS, BundleFiles, ZipStream,
+                       nothing_downloaded)
+from file_cache import (CLOSE, END, FILE, FILL, FOLLOW, OPEN, PENDING, RESPONSE, STREAM, WAIT, Fill, download_cache,
+                        next_step)
+from logging_config import logger
+from metrics import DOWNLOAD_BYTES, REQUEST_LATENCY, REQUESTS
+from payload_store import payload_store
+from study_sections import SECTIONS, STUDY_PAYLOAD_URLS, get_study_data
+from upstream import replaying, request_key
+from utils import (metabobank_crawl_steps, metabobank_fetch_result_and_raw_files, metabobank_get_directories,
+                   metabolights_fetch_result_files, metabolights_result_files_request, payload_is_fresh,
+                   revalidation_headers)
+
+# threads rendering pages and running the other sync code; they never wait on prefetched upstream requests
+ASYNC_THREADS = int(os.environ.get('METABOLOMICS_ASYNC_THREADS', 32))
+MAX_REQUEST_BODY = 16 * 1024 * 1024
+
+# body bytes sent by the native view of the current request, counted in the download bytes metric
+_sent_bytes = contextvars.ContextVar('sent_bytes')
+
+
+@contextmanager
+def recording():
+    """
+    Collects the upstream responses received ahead of time for a request and replays them to the sync code
+    called in the block (see `upstream.replaying`); their temporary files are removed at the end.
+    :return: the dictionary {request_key(): RecordedResponse} to fill
+    """
+    recorded = {}
+    try:
+        with replaying(recorded):
+            yield recorded
+    finally:
+        for response in recorded.values():
+            response.close()
+
+
+def attachment(filename: str) -> str:
+    """
+    :return: the Content-Disposition of a downloaded file, formatted like Flask does
+    """
+    return dump_options_header('attachment', {'filename': filename})
+
+
+def empty_json(status: int) -> web.Response:
+    """
+    :return: the response of a view returning ({}, status)
+    """
+    return web.Response(status=status, body=b"{}\n", content_type='application/json')
+
+
+def internal_error() -> web.Response:
+    """
+    :return: the error page sent by Flask when a view fails
+    """
+    return web.Response(status=500, text=InternalServerError().get_body(), content_type='text/html')
+
+
+async def _iter_items(items):
+    for item in items:
+        yield item
+
+
+async def _prepend(first, items):
+    try:
+        yield first
+        async for item in items:
+            yield item
+    finally:
+        await items.aclose()
+
+
+class _UpstreamBody:
+    """
+    The body of an upstream response added to a bundle; the connection is released by `close`
+    even if reading never started, see `downloads.UpstreamStream`.
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __aiter__(self):
+        return self.upstream.content.iter_chunked(DOWNLOAD_CHUNK_SIZE).__aiter__()
+
+    def close(self):
+        self.upstream.release()
+
+
+class _AsyncFill(Fill):
+    """
+    A fill of the download cache followed by tasks of the event loop; it is written and completed in threads.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    def notify(self, state: str = None):
+        if state is not None:
+            self.state = state
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def changed(self):
+        await self._changed.wait()
+
+
+class AsyncServer:
+    """
+    Serves the Flask application on an asyncio event loop, so waiting on slow upstreams does not hold a thread.
+    The download routes are served natively with non-blocking upstream I/O. Before a study page or section
+    is handed to Flask (in a thread pool), the upstream requests it needs are sent asynchronously and
+    their responses are replayed to the unchanged sync code, so it renders the same page without waiting on
+    the network. All other routes are handed to Flask as they are.
+    """
+
+    def __init__(self, flask_app=app, upstream: AsyncUpstreamSession = None, threads: int = ASYNC_THREADS):
+        """
+        :param flask_app: the Flask application
+        :param upstream: session used for the upstream requests
+        :param threads: number of threads running Flask
+        """
+        self.flask_app = flask_app
+        self.upstream = upstream or AsyncUpstreamSession(breakers=api_session)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='flask')
+        self.url_adapter = flask_app.url_map.bind('localhost')
+        self.fills = {}
+        self._tasks = set()
+        # endpoints served on the event loop
+        self.views = {
+            'metabolights_download_file': self.metabolights_download_file,
+            'metabolights_download_bundle': self.metabolights_download_bundle,
+            'metabobank_download_file': self.metabobank_download_file,
+            'metabobank_download_bundle': self.metabobank_download_bundle,
+        }
+        # endpoints whose upstream requests are sent before Flask renders them
+        self.prefetchers = {
+            'metabolights_get_study_details_info': self.prefetch_metabolights_page,
+            'metabolomics_workbench_get_study_details_info': functools.partial(self.prefetch_page, 'workbench'),
+            'metabobank_get_study_details_info': functools.partial(self.prefetch_page, 'metabobank'),
+            'study_section': self.prefetch_section,
+        }
+
+    def application(self) -> web.Application:
+        application = web.Application(client_max_size=MAX_REQUEST_BODY)
+        application.router.add_route('*', '/{path:.*}', self.dispatch)
+        application.on_startup.append(self._start)
+        application.on_cleanup.append(self._close)
+        return application
+
+    async def _start(self, application: web.Application):
+        await self.upstream.start()
+
+    async def _close(self, application: web.Application):
+        await self.upstream.close()
+        self.executor.shutdown(wait=False)
+
+    async def run_sync(self, func, *args, **kwargs):
+        """
+        Runs sync code in the thread pool with the context variables of the current request.
+        """
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def dispatch(self, request: web.Request) -> web.StreamResponse:
+        try:
+            rule, view_args = self.url_adapter.match(request.path, request.method, return_rule=True)
+        except HTTPException:
+            # not found, wrong method or redirect: answered by Flask
+            return await self.call_flask(request)
+
+        view = self.views.get(rule.endpoint)
+        if view is not None:
+            return await self.call_view(request, rule.rule, view, view_args)
+
+        prefetch = self.prefetchers.get(rule.endpoint)
+        with recording() as recorded:
+            if prefetch is not None:
+                await prefetch(request, recorded, **view_args)
+            return await self.call_flask(request)
+
+    async def call_view(self, request: web.Request, route: str, view, view_args: dict) -> web.StreamResponse:
+        """
+        Runs a native view, recording the same request and download metrics as Flask does for its routes.
+        """
+        started = time.perf_counter()
+        sent_bytes = [0]
+        _sent_bytes.set(sent_bytes)
+        status = 500
+        try:
+            response = await view(request, **view_args)
+            if not response.prepared:
+                await response.prepare(request)
+                await response.write_eof()
+            status = response.status
+            if isinstance(response, web.FileResponse):
+                sent_bytes[0] += response.content_length or 0
+            return response
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+            REQUESTS.inc(route=route, method=request.method, status=status)
+            DOWNLOAD_BYTES.inc(sent_bytes[0], route=route)
+
+    @staticmethod
+    async def send(response: web.StreamResponse, chunk: bytes):
+        await response.write(chunk)
+        _sent_bytes.get()[0] += len(chunk)
+
+    def wsgi_environ(self, request: web.Request, body: bytes) -> dict:
+        host, _, port = request.host.partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.scheme == 'https' else '80'),
+            'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+            'REMOTE_ADDR': request.remote or '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name in set(request.headers.keys()):
+            values = request.headers.getall(name)
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = f"HTTP_{key}"
+            environ[key] = ('; ' if key == 'HTTP_COOKIE' else ', ').join(values)
+        return environ
+
+    async def call_flask(self, request: web.Request) -> web.StreamResponse:
+        """
+        Hands a request to the Flask application in the thread pool; the response body is sent as it is produced.
+        """
+        environ = self.wsgi_environ(request, await request.read())
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+        body = await self.run_sync(self.flask_app, environ, start_response)
+        try:
+            chunks = iter(body)
+            chunk = await self.run_sync(next, chunks, None)
+            code, _, reason = started['status'].partition(' ')
+            response = web.StreamResponse(status=int(code), reason=reason or None)
+            for name, value in started['headers']:
+                response.headers.add(name, value)
+            await response.prepare(request)
+            while chunk is not None:
+                if chunk:
+                    await response.write(chunk)
+                chunk = await self.run_sync(next, chunks, None)
+            await response.write_eof()
+            return response
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                await self.run_sync(close)
+
+    def session(self, request: web.Request) -> dict:
+        """
+        :return: the content of the client's Flask session (read only)
+        """
+        cookie = request.cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        if not cookie or serializer is None:
+            return {}
+        try:
+            return serializer.loads(cookie, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return {}
+
+    # upstream requests sent ahead of the sync code
+
+    async def prefetch_payload(self, url: str, recorded: dict):
+        """
+        Sends the conditional request `utils.conditional_get` would send for a stored payload that is not fresh.
+        """
+        stored = await self.run_sync(payload_store.get, url)
+        if payload_is_fresh(stored):
+            return
+        recorded[request_key('GET', url)] = await self.upstream.record('GET', url, headers=revalidation_headers(stored))
+
+    async def prefetch_listing(self, url: str, recorded: dict):
+        await self.prefetch_payload(url, recorded)
+        try:
+            return await self.run_sync(metabobank_get_directories, url=url, api_session=api_session)
+        except requests.exceptions.RequestException:
+            # the sync crawl gets the same error from the recorded response
+            return [], 500
+
+    async def prefetch_crawl(self, study_id: str, recorded: dict):
+        """
+        Crawls the directory listings of a Metabobank study with concurrent non-blocking requests,
+        storing them like the sync crawl does, so the sync crawl only reads them from the payload store.
+        """
+        crawl = metabobank_crawl_steps(study_id=study_id)
+        listings = {}
+        try:
+            urls = next(crawl)
+            while True:
+                pending = [url for url in dict.fromkeys(urls) if url not in listings]
+                results = await asyncio.gather(*(self.prefetch_listing(url, recorded) for url in pending))
+                listings.update(zip(pending, results))
+                urls = crawl.send(listings)
+        except StopIteration:
+            pass
+
+    def _needs_upstream(self, source: str, study_id: str) -> bool:
+        # the shared cache backends and the catalog are read with blocking I/O
+        if get_study_data.is_cached(source, study_id, api_session):
+            return False
+        catalog = get_catalog()
+        return not (CATALOG_MODE == 'prefer' and catalog is not None and catalog.get(source, study_id) is not None)
+
+    async def prefetch_study(self, source: str, study_id: str, recorded: dict):
+        """
+        Sends the upstream requests of `study_sections.get_study_data` unless the study is cached or mirrored.
+        """
+        if not await self.run_sync(self._needs_upstream, source, study_id):
+            return
+        if source == 'metabobank':
+            await self.prefetch_crawl(study_id, recorded)
+        else:
+            await asyncio.gather(*(self.prefetch_payload(url.format(study_id=study_id), recorded)
+                                   for url in STUDY_PAYLOAD_URLS[source]))
+
+    async def prefetch_result_files(self, study_id: str, api_token: str, recorded: dict):
+        request_kwargs = metabolights_result_files_request(study_id=study_id, api_token=api_token)
+        recorded[request_key('GET', request_kwargs['url'])] = await self.upstream.record('GET', **request_kwargs)
+
+    async def prefetch_page(self, source: str, request: web.Request, recorded: dict, study_id: str):
+        await self.prefetch_study(source, study_id, recorded)
+
+    async def prefetch_metabolights_page(self, request: web.Request, recorded: dict, study_id: str):
+        prefetches = [self.prefetch_study('metabolights', study_id, recorded)]
+        api_token = self.session(request).get('api_token')
+        if api_token:
+            prefetches.append(self.prefetch_result_files(study_id, api_token, recorded))
+        await asyncio.gather(*prefetches)
+
+    async def prefetch_section(self, request: web.Request, recorded: dict, source: str, study_id: str,
+                               section: str):
+        if source in SECTIONS:
+            await self.prefetch_study(source, study_id, recorded)
+
+    # downloads
+
+    def file_response(self, entry, filename: str) -> web.FileResponse:
+        # Range requests are answered by aiohttp, the file is sent with sendfile()
+        content_type = entry.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return web.FileResponse(entry.path, headers={'Content-Type': content_type,
+                                                     'Content-Disposition': attachment(filename)})
+
+    async def stream_upstream(self, request: web.Request, upstream, filename: str) -> web.StreamResponse:
+        """
+        Passes a streamed upstream response through to the client, see `downloads.stream_upstream_response`.
+        """
+        headers = upstream.headers
+        content_type = (headers.get('Content-Type') or mimetypes.guess_type(filename)[0]
+                        or 'application/octet-stream')
+        response = web.StreamResponse(status=upstream.status, headers={'Content-Type': content_type})
+        for name in FORWARDED_RESPONSE_HEADERS:
+            if name in headers:
+                response.headers[name] = headers[name]
+        response.headers['Content-Disposition'] = attachment(filename)
+        try:
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                await self.send(response, chunk)
+            await response.write_eof()
+        finally:
+            upstream.release()
+        return response
+
+    async def follow_fill(self, request: web.Request, fill: _AsyncFill, filename: str) -> web.StreamResponse:
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self.executor, fill.open)
+        try:
+            content_type = fill.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = web.StreamResponse(headers={'Content-Type': content_type})
+            if fill.content_length is not None:
+                response.headers['Content-Length'] = fill.content_length
+            response.headers['Content-Disposition'] = attachment(filename)
+            await response.prepare(request)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, f.read, DOWNLOAD_CHUNK_SIZE)
+                if chunk:
+                    await self.send(response, chunk)
+                    continue
+                progress = fill.progress(f.tell())
+                if progress == END:
+                    break
+                if progress == WAIT:
+                    await fill.changed()
+            await response.write_eof()
+            return response
+        finally:
+            await loop.run_in_executor(self.executor, f.close)
+
+    async def run_fill(self, url: str, fill: _AsyncFill, upstream, f):
+        """
+        Appends an upstream body to the partial file of a fill; the file is written and added to the cache
+        in the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                async for chunk in upstream.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await loop.run_in_executor(self.executor, fill.append, f, chunk)
+            finally:
+                await loop.run_in_executor(self.executor, f.close)
+            await loop.run_in_executor(self.executor, download_cache.complete_fill, url, fill, self.fills,
+                                       upstream.headers)
+        except Exception as e:
+            await loop.run_in_executor(self.executor, download_cache.fail_fill, url, fill, self.fills, e)
+        finally:
+            upstream.release()
+
+    def start_fill(self, url: str, fill: _AsyncFill, upstream, f):
+        # the fill goes on if the client that started it disconnects
+        task = asyncio.ensure_future(self.run_fill(url, fill, upstream, f))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def serve_download(self, request: web.Request, url: str, filename: str, open_upstream):
+        """
+        Serves a download from the download cache, filling it from the upstream on a miss, with the steps
+        of `file_cache.DownloadCache.serve_steps`; they read and write the disk, so they run in the thread pool.
+        :param request: client request
+        :param url: url identifying the upstream file
+        :param filename: name of the downloaded file
+        :param open_upstream: coroutine function taking request headers and returning an upstream response
+        :return: a response (or None if the upstream failed) and the HTTP status code
+        """
+        loop = asyncio.get_running_loop()
+        steps = download_cache.serve_steps(url, request.headers, self.fills, functools.partial(_AsyncFill, loop))
+        result, error = None, None
+        try:
+            while True:
+                action, argument = await loop.run_in_executor(self.executor, next_step, steps, result, error)
+                result, error = None, None
+                if action == RESPONSE:
+                    return argument
+                if action == WAIT:
+                    while argument.state == PENDING:
+                        await argument.changed()
+                elif action == FILE:
+                    result = self.file_response(argument, filename)
+                elif action == FOLLOW:
+                    result = await self.follow_fill(request, argument, filename)
+                elif action == OPEN:
+                    try:
+                        upstream = await open_upstream(argument)
+                    except requests.exceptions.RequestException as e:
+                        error = e
+                    else:
+                        result = upstream, upstream.status
+                elif action == CLOSE:
+                    argument.release()
+                elif action == STREAM:
+                    result = await self.stream_upstream(request, argument, filename)
+                elif action == FILL:
+                    fill, upstream, f = argument
+                    self.start_fill(url, fill, upstream, f)
+                    result = await self.follow_fill(request, fill, filename)
+        finally:
+            steps.close()
+
+    async def iter_upstream_files(self, files, open_file, max_workers: int = BUNDLE_WORKERS):
+        """
+        Opens upstream downloads ahead of time with bounded concurrency and yields them in order,
+        see `downloads.iter_upstream_files`.
+        :param files: list of (archive name, file reference) pairs
+        :param open_file: coroutine function opening an upstream response for a file reference
+        :param max_workers: maximum number of upstream requests in flight
+        :return: an async generator of (archive name, body) pairs
+        """
+        bundle = BundleFiles(files, open_file, lambda open_file, file_ref: asyncio.ensure_future(open_file(file_ref)),
+                             max_workers)
+        try:
+            for arcname, file_ref, task in iter(bundle.next, None):
+                try:
+                    upstream = await task
+                except Exception as e:
+                    bundle.failed(file_ref, e)
+                    continue
+                if upstream.status >= 400:
+                    bundle.failed(file_ref, f"HTTP {upstream.status}")
+                    upstream.release()
+                    continue
+                yield arcname, _UpstreamBody(upstream)
+        finally:
+            bundle.close(lambda upstream: upstream.release())
+
+        errors_entry = bundle.errors_entry()
+        if errors_entry is not None:
+            arcname, chunks = errors_entry
+            yield arcname, _iter_items(chunks)
+
+    async def bundle_response(self, request: web.Request, files, filename: str) -> web.StreamResponse:
+        """
+        Streams the bundle of the entries of `iter_upstream_files`, see `downloads.bundle_entries`.
+        :return: the ZIP archive, or a 502 if none of the files could be downloaded
+        """
+        try:
+            first = await files.__anext__()
+        except StopAsyncIteration:
+            first = None
+        if nothing_downloaded(first):
+            await files.aclose()
+            return empty_json(502)
+        return await self.stream_zip(request, _prepend(first, files), filename)
+
+    async def stream_zip(self, request: web.Request, files, filename: str) -> web.StreamResponse:
+        """
+        Streams a ZIP archive of upstream files while it is built, see `downloads.stream_zip_response`.
+        Entries are compressed in the thread pool.
+        :param files: async iterable of (archive name, async iterable of bytes chunks)
+        :param filename: name of the downloaded archive
+        """
+        response = web.StreamResponse(headers={'Content-Type': 'application/zip',
+                                               'Content-Disposition': attachment(filename)})
+        archive = ZipStream()
+        loop = asyncio.get_running_loop()
+        try:
+            await response.prepare(request)
+            async for arcname, body in files:
+                try:
+                    archive.open_entry(arcname)
+                    async for chunk in body:
+                        data = await loop.run_in_executor(self.executor, archive.write, chunk)
+                        if data:
+                            await self.send(response, data)
+                    data = await loop.run_in_executor(self.executor, archive.close_entry)
+                finally:
+                    close = getattr(body, 'close', None)
+                    if close is not None:
+                        close()
+                if data:
+                    await self.send(response, data)
+            await self.send(response, await loop.run_in_executor(self.executor, archive.close))
+            await response.write_eof()
+        finally:
+            await files.aclose()
+        return response
+
+    async def metabolights_download_file(self, request: web.Request, study_id: str, filename: str):
+        url = METABOLIGHTS_DOWNLOAD_URL.format(study_id=study_id)
+        params = {'study_id': study_id, 'file': filename}
+
+        if filename != 'metadata':
+            async def open_upstream(headers: dict):
+                return await self.upstream.open('GET', url, params=params, headers=headers)
+
+            try:
+                response, _ = await self.serve_download(request, f"{url}?file={filename}", filename, open_upstream)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Connection error occurred: {e}")
+                return empty_json(500)
+            return response if response is not None else internal_error()
+
+        try:
+            upstream = await self.upstream.open('GET', url, params=params)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Connection error occurred: {e}")
+            return empty_json(500)
+        if upstream.status >= 400:
+            upstream.release()
+            return internal_error()
+        return await self.stream_zip(request, _iter_items([('metadata.zip', _UpstreamBody(upstream))]), 'metadata.zip')
+
+    async def metabolights_download_bundle(self, request: web.Request, study_id: str):
+        file_names = request.query.getall('file', [])
+        if not file_names:
+            session = self.session(request)
+            if 'api_token' not in session:
+                return empty_json(401)
+            with recording() as recorded:
+                await self.prefetch_result_files(study_id, session['api_token'], recorded)
+                file_names, resp_code = await self.run_sync(metabolights_fetch_result_files, study_id=study_id,
+                                                            api_token=session['api_token'], api_session=api_session)
+            if resp_code != 200:
+                return empty_json(resp_code)
+        if not file_names:
+            return empty_json(404)
+
+        url = METABOLIGHTS_DOWNLOAD_URL.format(study_id=study_id)
+
+        async def open_file(file_name: str):
+            return await self.upstream.open('GET', url, params={'study_id': study_id, 'file': file_name})
+
+        files = [(file_name, file_name) for file_name in dict.fromkeys(file_names)]
+        return await self.bundle_response(request, self.iter_upstream_files(files, open_file), f"{study_id}.zip")
+
+    async def metabobank_download_file(self, request: web.Request, file_url: str):
+        async def open_upstream(headers: dict):
+            return await self.upstream.open('GET', file_url, headers=headers)
+
+        try:
+            response, _ = await self.serve_download(request, file_url, file_url.split('/')[-1], open_upstream)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Connection error occurred: {e}")
+            return empty_json(500)
+
+        if response is not None:
+            return response
+        logger.error(f"Error downloading file: {file_url}")
+        return internal_error()
+
+    async def metabobank_download_bundle(self, request: web.Request, study_id: str):
+        with recording() as recorded:
+            await self.prefetch_crawl(study_id, recorded)
+            (results_files, _), resp_code = await self.run_sync(metabobank_fetch_result_and_raw_files,
+                                                                study_id=study_id, api_session=api_session)
+        if resp_code != 200:
+            return empty_json(resp_code)
+
+        files = metabobank_bundle_files(study_id, results_files, request.query.getall('file', []))
+        if not files:
+            return empty_json(404)
+
+        async def open_file(file_url: str):
+            return await self.upstream.open('GET', file_url)
+
+        return await self.bundle_response(request, self.iter_upstream_files(files, open_file), f"{study_id}.zip")
+
+
+async def create_app() -> web.Application:
+    """
+    Production entry point: `python aio_server.py`, or with several worker processes
+    `gunicorn aio_server:create_app --worker-class aiohttp.GunicornWebWorker --workers 4 --bind 0.0.0.0:5000`
+    (set METABOLOMICS_SECRET_KEY so that all workers accept the same sessions).
+    """
+    return AsyncServer().application()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the application on an asyncio event loop.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
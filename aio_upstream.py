@@ -0,0 +1,144 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+import requests
+from yarl import URL
+
+from logging_config import logger
+from metrics import UPSTREAM_LATENCY, UPSTREAM_RESPONSES
+from upstream import (BACKOFF_BASE, CONNECT_TIMEOUT, IDEMPOTENT_METHODS, MAX_RETRIES, READ_TIMEOUT, RETRY_STATUSES,
+                      UPSTREAM_OVERRIDES, CircuitOpenError, RecordedResponse, UpstreamSession, backoff_delay,
+                      is_upstream_failure, override_url, prepare_url)
+
+# connections are cheap on the event loop: thousands of upstream requests can wait at the same time
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('METABOLOMICS_ASYNC_CONNECTIONS', 4096))
+ASYNC_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('METABOLOMICS_ASYNC_CONNECTIONS_PER_HOST', 1024))
+RECORD_CHUNK_SIZE = 64 * 1024
+
+
+def as_request_exception(error: Exception) -> requests.exceptions.RequestException:
+    """
+    :param error: an aiohttp or timeout error
+    :return: the requests exception reporting the same failure, which the service code already handles
+    """
+    if isinstance(error, requests.exceptions.RequestException):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        return requests.exceptions.ReadTimeout(str(error) or "upstream request timed out")
+    return requests.exceptions.ConnectionError(str(error))
+
+
+class AsyncUpstreamSession:
+    """
+    Non-blocking counterpart of UpstreamSession for the async serving mode (aio_server.py), built on aiohttp:
+    same connect/read timeouts, bounded retries of idempotent requests with jittered backoff, host overrides and
+    metrics. The circuit breakers are those of a sync session, so both see the same state of a host.
+    Failures are raised as requests exceptions. Must be started and closed on the event loop that uses it.
+    """
+
+    def __init__(self, breakers: UpstreamSession, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries: int = MAX_RETRIES, backoff_base: float = BACKOFF_BASE, host_overrides: dict = None,
+                 max_connections: int = ASYNC_MAX_CONNECTIONS,
+                 max_connections_per_host: int = ASYNC_MAX_CONNECTIONS_PER_HOST):
+        """
+        :param breakers: the sync session whose per-host circuit breakers are shared
+        :param timeout: (connect, read) timeout in seconds
+        :param max_retries: maximum number of retries of a failed idempotent request
+        :param backoff_base: base of the exponential backoff between retries in seconds
+        :param host_overrides: dictionary {host: base url} of upstream hosts served from another address
+        :param max_connections: maximum number of open upstream connections
+        :param max_connections_per_host: maximum number of open connections to one upstream host
+        """
+        self.breakers = breakers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.host_overrides = UPSTREAM_OVERRIDES if host_overrides is None else host_overrides
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._session = None
+
+    async def start(self):
+        connect_timeout, read_timeout = self.timeout
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def open(self, method: str, url: str, params=None, headers: dict = None, json=None):
+        """
+        Sends an upstream request and returns as soon as the response headers arrive.
+        :param method: HTTP method
+        :param url: upstream url
+        :param params: query parameters
+        :param headers: request headers
+        :param json: JSON request body
+        :return: the aiohttp response; the caller reads its body and releases it
+        :raise requests.exceptions.RequestException: if the host is unreachable, times out or its circuit is open
+        """
+        host, url = override_url(prepare_url(url, params), self.host_overrides)
+        # the url is already encoded the way requests encodes it
+        target = URL(url, encoded=True)
+        breaker = self.breakers.breaker(host)
+        attempts = 1 + (self.max_retries if method.upper() in IDEMPOTENT_METHODS else 0)
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                UPSTREAM_RESPONSES.inc(host=host, status='circuit_open')
+                raise CircuitOpenError(f"Upstream host {host} is unavailable (circuit open)")
+            last_attempt = attempt + 1 == attempts
+
+            started = time.perf_counter()
+            try:
+                response = await self._session.request(method, target, headers=headers, json=json)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host)
+                UPSTREAM_RESPONSES.inc(host=host, status='error')
+                breaker.record_failure()
+                if last_attempt:
+                    raise as_request_exception(e) from e
+                logger.info(f"Upstream request to {url} failed ({e!r}), retrying")
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base))
+                continue
+
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host)
+            UPSTREAM_RESPONSES.inc(host=host, status=response.status)
+            if is_upstream_failure(response.status):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status not in RETRY_STATUSES or last_attempt:
+                return response
+            logger.info(f"Upstream request to {url} returned {response.status}, retrying")
+            response.release()
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_base))
+
+    async def record(self, method: str, url: str, params=None, headers: dict = None, json=None) -> RecordedResponse:
+        """
+        Sends an upstream request and reads its whole response, to be replayed to the sync service code
+        with `upstream.replaying`. A failure is recorded instead of being raised.
+        :return: the recorded response
+        """
+        try:
+            response = await self.open(method, url, params=params, headers=headers, json=json)
+        except requests.exceptions.RequestException as e:
+            return RecordedResponse(prepare_url(url, params), error=e)
+
+        recorded = RecordedResponse(prepare_url(url, params), status_code=response.status, reason=response.reason,
+                                    headers=response.headers)
+        try:
+            async for chunk in response.content.iter_chunked(RECORD_CHUNK_SIZE):
+                recorded.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            recorded.close()
+            return RecordedResponse(recorded.url, error=as_request_exception(e))
+        finally:
+            response.release()
+        return recorded
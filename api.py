@@ -1,25 +1,97 @@
-import io
+import inspect
 import logging
+import os
 import secrets
-import zipfile
+import threading
+import time
 import requests
-from flask import Flask, jsonify, render_template, url_for, redirect, request, flash, session, send_file
+from flask import Flask, Response, g, jsonify, render_template, url_for, redirect, request, flash, session
 from flask_bootstrap import Bootstrap
 
+from batch import MAX_BATCH_SIZE, STUDY_ID_PREFIXES, iter_batch_details, iter_ndjson
+from downloads import UpstreamStream, bundle_entries, iter_upstream_files, stream_zip_response
+from file_cache import download_cache
 from forms import MetabolightsForm, MetabolightsLoginForm, MetabolomicsWorkbenchForm, MetabobankForm
-from utils import (metabolights_fetch_metadata_and_raw_files, metabolights_fetch_result_files, fetch_study_list,
-                   metabolights_get_study_details, metabolomics_workbench_get_study_details,
-                   metabobank_get_study_details)
+from fragment_cache import fragment_cache
+from http_cache import compress_response, conditional_response, make_etag
+from utils import (METABOBANK_STUDY_URL, cache_stats, metabolights_fetch_result_files,
+                   metabobank_fetch_result_and_raw_files, RAW_FILE_MODES)
 from logging_config import logger
+from metabolite_index import SEARCH_LIMIT, SEARCH_MAX_LIMIT, metabolite_index, refresh_from_catalog
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, DOWNLOAD_BYTES, REQUEST_LATENCY, REQUESTS,
+                     CountingIterable, register_cache, registry)
+from payload_store import payload_store
+from profiling import configure_profiling, finish_profiling, start_profiling, teardown_profiling, timed
+from study_index import TYPEAHEAD_LIMIT, TYPEAHEAD_MAX_LIMIT
+from study_lists import STUDY_LIST_URLS, STUDY_LIST_WAIT, StudyListRefresher
+from study_sections import (SECTION_MAX_PAGE_SIZE, SECTION_PAGE_SIZE, SECTIONS, get_study_data, paginate,
+                            section_items)
+from upstream import UpstreamSession
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_urlsafe(16)
+# workers serving the same clients (see aio_server.py) must share the key signing the session cookies
+app.config['SECRET_KEY'] = os.environ.get('METABOLOMICS_SECRET_KEY') or secrets.token_urlsafe(16)
+configure_profiling(app.config)
 Bootstrap(app)
 
+# endpoints whose response bodies are counted in the download bytes metric
+DOWNLOAD_ENDPOINTS = {
+    'metabolights_download_file', 'metabolights_download_bundle', 'metabobank_download_file',
+    'metabobank_download_bundle',
+}
+METABOLIGHTS_DOWNLOAD_URL = "https://www.ebi.ac.uk/metabolights/ws/studies/{study_id}/download"
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if request.endpoint in DOWNLOAD_ENDPOINTS and response.response is not None and request.method != 'HEAD':
+        if inspect.isgenerator(response.response) or isinstance(response.response, UpstreamStream):
+            response.response = CountingIterable(response.response,
+                                                 lambda size: DOWNLOAD_BYTES.inc(size, route=route))
+        else:
+            # files sent with wsgi.file_wrapper (sendfile) are counted without wrapping them
+            DOWNLOAD_BYTES.inc(response.content_length or 0, route=route)
+    return response
+
+
+app.before_request(start_request_timer)
+app.before_request(start_profiling)
+# after_request functions run in reverse order: responses are compressed before they are measured,
+# the Server-Timing header of profiled requests is added last
+app.after_request(finish_profiling)
+app.after_request(record_request_metrics)
+app.after_request(compress_response)
+app.teardown_request(teardown_profiling)
+
+# study pages are rendered as the 'render' phase of profiled requests
+render_study_page = timed('render')(render_template)
+
 app.logger.addHandler(logging.StreamHandler())
 app.logger.setLevel(logging.INFO)
 
-api_session = requests.Session()
+# pooled, retrying session with timeouts and per-host circuit breakers shared by all upstream calls
+api_session = UpstreamSession()
+
+register_cache('cached', cache_stats)
+register_cache('fragments', fragment_cache.stats)
+register_cache('downloads', download_cache.stats)
+register_cache('payloads', payload_store.stats)
+
+# study lists are pre-warmed and refreshed in the background, so requests never wait on them
+# (set METABOLOMICS_WARMUP=0 to fetch them on demand instead)
+study_lists = StudyListRefresher(api_session=api_session)
+if os.environ.get('METABOLOMICS_WARMUP', '1') != '0':
+    study_lists.start()
+    # the metabolites of the mirrored studies are indexed in the background
+    threading.Thread(target=refresh_from_catalog, name="metabolite-index", daemon=True).start()
 
 
 @app.route('/')
@@ -52,7 +124,7 @@ def metabolights_login(email: str, secret: str):
 
     try:
         response = api_session.post(login_url, json=login_data, headers=headers)
-    except requests.exceptions.ConnectionError as e:
+    except requests.exceptions.RequestException as e:
         logger.error(f"Connection error occurred: {e}")
         return {}, 500
 
@@ -94,19 +166,41 @@ def metabolights_get_study_details_info(study_id: str):
              if available, includes result file names when the API token is present in the session
              with an option of download them
     """
-    study_details, resp_code = metabolights_get_study_details(study_id=study_id, api_session=api_session)
-    if resp_code == 200:
-        study_info_data = metabolights_fetch_metadata_and_raw_files(assays_content=study_details)
-        if 'api_token' in session:
-            study_result_files, _ = metabolights_fetch_result_files(
+    raw_files_mode = request.args.get('raw_files', 'rows')
+    if raw_files_mode not in RAW_FILE_MODES:
+        raw_files_mode = 'rows'
+    api_token = session.get('api_token')
+
+    study_info_data, resp_code = get_study_data('metabolights', study_id, api_session)
+    if resp_code != 200:
+        return render_template('metabolights_study_info.html', data={}, study_id=study_id,
+                               raw_files_mode=raw_files_mode), resp_code
+
+    def render_page():
+        # assays, metabolites and raw files are loaded by the page from `study_section`
+        study_result_files, result_files_code = [], 200
+        if api_token:
+            study_result_files, result_files_code = metabolights_fetch_result_files(
                 study_id=study_id,
-                api_token=session['api_token'],
+                api_token=api_token,
                 api_session=api_session
             )
-            study_info_data['result_file_names'] = study_result_files
-        return render_template('metabolights_study_info.html', data=study_info_data, study_id=study_id)
-    else:
-        return render_template('metabolights_study_info.html', data={}, study_id=study_id), resp_code
+        page = render_study_page('metabolights_study_info.html', data=study_info_data, study_id=study_id,
+                                 result_file_names=study_result_files, raw_files_mode=raw_files_mode)
+        return page, result_files_code
+
+    def cached_page():
+        page, _ = fragment_cache.get_or_render('metabolights', study_id, study_info_data.version,
+                                               f'page:{raw_files_mode}', render_page, api_token=api_token,
+                                               cacheable=lambda fragment: fragment[1] == 200)
+        return page
+
+    if api_token:
+        # the result files are per user: no shared validators
+        return cached_page()
+    # without result files the page only depends on the study payload: answer revalidations with a 304
+    return conditional_response(make_etag('metabolights', study_id, study_info_data.version, raw_files_mode),
+                                cached_page)
 
 
 @app.route('/metabolights_download_file/<study_id>/<filename>', methods=['GET'], strict_slashes=False)
@@ -116,45 +210,86 @@ def metabolights_download_file(study_id: str, filename: str):
     :param study_id: current study id
     :param filename: filename of the current file
     :return: a file response; if the filename is 'metadata', the file is wrapped into a ZIP archive before sending;
-             otherwise, the file content is sent directly; in case of an error, returns the HTTP status code
+             otherwise, the file content is served from the local download cache or streamed from the upstream
+             (Range requests are supported);
+             in case of an error, returns the HTTP status code
     """
-    url = f"https://www.ebi.ac.uk/metabolights/ws/studies/{study_id}/download"
+    url = METABOLIGHTS_DOWNLOAD_URL.format(study_id=study_id)
 
     request_data = {
         'study_id': study_id,
         'file': filename
     }
 
+    if filename != 'metadata':
+        def open_upstream(headers: dict):
+            return api_session.get(url, params=request_data, headers=headers, stream=True)
+
+        try:
+            file_response, resp_code = download_cache.serve(
+                url=f"{url}?file={filename}",
+                filename=filename,
+                open_upstream=open_upstream,
+                request_headers=request.headers
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Connection error occurred: {e}")
+            return {}, 500
+
+        if file_response is not None:
+            return file_response
+        return resp_code
+
     try:
         response = api_session.get(url, params=request_data, stream=True)
-    except requests.exceptions.ConnectionError as e:
+    except requests.exceptions.RequestException as e:
         logger.error(f"Connection error occurred: {e}")
         return {}, 500
 
     if response.ok:
-        if filename == 'metadata':
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                zip_file.writestr('metadata.zip', response.content)
-
-            zip_buffer.seek(0)
-            return send_file(
-                zip_buffer,
-                as_attachment=True,
-                attachment_filename='metadata.zip',
-                mimetype='application/zip'
-            )
-        else:
-            file_data = response.content
-            return send_file(
-                io.BytesIO(file_data),
-                as_attachment=True,
-                attachment_filename=filename
-            )
+        return stream_zip_response([('metadata.zip', UpstreamStream(response))], filename='metadata.zip')
     else:
+        response.close()
         return response.status_code
 
 
+@app.route('/metabolights_download_bundle/<study_id>', methods=['GET'], strict_slashes=False)
+def metabolights_download_bundle(study_id: str):
+    """
+    Downloads several files of a given MetaboLights study as one ZIP archive streamed while it is built.
+    Files that could not be downloaded are listed in the ERRORS.txt entry of the archive.
+    :param study_id: current study id
+    :return: a ZIP file response with the files selected by the 'file' query parameters;
+             without a selection, all result files (available only if the API token is present in the session);
+             in case of an error, returns an empty response and the HTTP status code (502 if none of the files
+             could be downloaded)
+    """
+    file_names = request.args.getlist('file')
+    if not file_names:
+        if 'api_token' not in session:
+            return {}, 401
+        file_names, resp_code = metabolights_fetch_result_files(
+            study_id=study_id,
+            api_token=session['api_token'],
+            api_session=api_session
+        )
+        if resp_code != 200:
+            return {}, resp_code
+    if not file_names:
+        return {}, 404
+
+    url = METABOLIGHTS_DOWNLOAD_URL.format(study_id=study_id)
+
+    def open_file(file_name: str):
+        return api_session.get(url, params={'study_id': study_id, 'file': file_name}, stream=True)
+
+    files = [(file_name, file_name) for file_name in dict.fromkeys(file_names)]
+    entries = bundle_entries(iter_upstream_files(files, open_file))
+    if entries is None:
+        return {}, 502
+    return stream_zip_response(entries, filename=f"{study_id}.zip")
+
+
 @app.route('/metabolomics_workbench_get_study_details_info/<study_id>', methods=['GET'], strict_slashes=False)
 def metabolomics_workbench_get_study_details_info(study_id: str):
     """
@@ -163,9 +298,16 @@ def metabolomics_workbench_get_study_details_info(study_id: str):
     :return: an HTML page rendered with the study information if retrieval is successful; otherwise,
              an HTML page with empty data and the relevant HTTP status code.
     """
-    study_info_data, resp_code = metabolomics_workbench_get_study_details(study_id=study_id, api_session=api_session)
+    study_info_data, resp_code = get_study_data('workbench', study_id, api_session)
     if resp_code == 200:
-        return render_template('metabolomics_workbench_study_info.html', data=study_info_data, study_id=study_id)
+        return conditional_response(
+            make_etag('workbench', study_id, study_info_data.version),
+            lambda: fragment_cache.get_or_render(
+                'workbench', study_id, study_info_data.version, 'page',
+                lambda: render_study_page('metabolomics_workbench_study_info.html', data=study_info_data,
+                                          study_id=study_id)
+            )
+        )
     else:
         return render_template('metabolomics_workbench_study_info.html', data={}, study_id=study_id), resp_code
 
@@ -177,9 +319,15 @@ def metabobank_get_study_details_info(study_id: str):
     :return: an HTML page rendered with the study information if retrieval is successful; otherwise,
              an HTML page with empty data and the relevant HTTP status code.
     """
-    study_info_data, resp_code = metabobank_get_study_details(study_id=study_id, api_session=api_session)
+    study_info_data, resp_code = get_study_data('metabobank', study_id, api_session)
     if resp_code == 200:
-        return render_template('metabobank_study_info.html', data=study_info_data, study_id=study_id)
+        return conditional_response(
+            make_etag('metabobank', study_id, study_info_data.version),
+            lambda: fragment_cache.get_or_render(
+                'metabobank', study_id, study_info_data.version, 'page',
+                lambda: render_study_page('metabobank_study_info.html', data=study_info_data, study_id=study_id)
+            )
+        )
     else:
         return render_template('metabobank_study_info.html', data={}, study_id=study_id), resp_code
 
@@ -189,55 +337,235 @@ def metabobank_download_file(file_url: str):
     """
     Downloads a specified file for a given Metabobank study.
     :param file_url: url of the current file
-    :return: the file content is sent directly; in case of an error, returns the HTTP status code
+    :return: the file content is served from the local download cache or streamed from the upstream
+             (Range requests are supported); in case of an error, returns the HTTP status code
     """
+    def open_upstream(headers: dict):
+        return api_session.get(url=file_url, headers=headers, stream=True)
+
     try:
-        response = api_session.get(url=file_url, stream=True)
-    except requests.exceptions.ConnectionError as e:
+        file_response, resp_code = download_cache.serve(
+            url=file_url,
+            filename=file_url.split('/')[-1],
+            open_upstream=open_upstream,
+            request_headers=request.headers
+        )
+    except requests.exceptions.RequestException as e:
         logger.error(f"Connection error occurred: {e}")
         return {}, 500
 
-    if response.ok:
-        file_name = file_url.split('/')[-1]
-        return send_file(
-            io.BytesIO(response.content),
-            as_attachment=True,
-            attachment_filename=file_name
-        )
+    if file_response is not None:
+        return file_response
     else:
         logger.error(f"Error downloading file: {file_url}")
         flash(f"Error downloading file: {file_url}", "error")
-        return response.status_code
+        return resp_code
+
+
+@app.route('/metabobank_download_bundle/<study_id>', methods=['GET'], strict_slashes=False)
+def metabobank_download_bundle(study_id: str):
+    """
+    Downloads the result files of a given Metabobank study as one ZIP archive streamed while it is built.
+    Files that could not be downloaded are listed in the ERRORS.txt entry of the archive.
+    :param study_id: current study id
+    :return: a ZIP file response with all result files, or only those selected by the 'file' query parameters
+             (file names or full urls); in case of an error, returns an empty response and the HTTP status code
+             (502 if none of the files could be downloaded)
+    """
+    (results_files, _), resp_code = metabobank_fetch_result_and_raw_files(study_id=study_id, api_session=api_session)
+    if resp_code != 200:
+        return {}, resp_code
+
+    files = metabobank_bundle_files(study_id, results_files, request.args.getlist('file'))
+    if not files:
+        return {}, 404
+
+    def open_file(file_url: str):
+        return api_session.get(url=file_url, stream=True)
 
+    entries = bundle_entries(iter_upstream_files(files, open_file))
+    if entries is None:
+        return {}, 502
+    return stream_zip_response(entries, filename=f"{study_id}.zip")
 
-def fetch_metabolights_studies():
-    api_url = "https://www.ebi.ac.uk/metabolights/ws/studies"
-    return fetch_study_list(api_url=api_url, source='metabolights', api_session=api_session)
+
+def metabobank_bundle_files(study_id: str, results_files: list, selection: list) -> list:
+    """
+    :param study_id: current study id
+    :param results_files: urls of the result files of the study
+    :param selection: names or urls of the selected files; all files if empty
+    :return: a list of (archive name, url) pairs of the files of a Metabobank bundle
+    """
+    selection = set(selection)
+    if selection:
+        results_files = [file_url for file_url in results_files
+                         if file_url in selection or file_url.split('/')[-1] in selection]
+    base_url = METABOBANK_STUDY_URL.format(study_id=study_id)
+    return [(file_url[len(base_url):], file_url) for file_url in results_files]
+
+
+@app.route('/batch_get_study_details', methods=['POST'], strict_slashes=False)
+def batch_get_study_details():
+    """
+    Retrieves the details of many studies at once, fetching them concurrently.
+    The request body is a JSON object {"study_ids": [...], "source": "metabolights"|"workbench"|"metabobank"};
+    without "source", the source of each study is detected from its id, so sources can be mixed.
+    :return: a newline-delimited JSON stream with one line {"study_id", "source", "status", "data"} per study,
+             written as soon as each study completes; HTTP status code 400 for an invalid request
+    """
+    request_data = request.get_json(silent=True) or {}
+    study_ids = request_data.get('study_ids')
+    source = request_data.get('source')
+
+    if not isinstance(study_ids, list) or not study_ids or not all(isinstance(el, str) for el in study_ids):
+        return jsonify({'error': "'study_ids' must be a non-empty list of study ids"}), 400
+    if len(study_ids) > MAX_BATCH_SIZE:
+        return jsonify({'error': f"at most {MAX_BATCH_SIZE} studies can be requested at once"}), 400
+    if source is not None and source not in STUDY_ID_PREFIXES:
+        return jsonify({'error': f"unknown source: {source}"}), 400
+
+    records = iter_batch_details(study_ids=study_ids, api_session=api_session, source=source)
+    return Response(iter_ndjson(records), mimetype='application/x-ndjson')
+
+
+def fetch_metabolights_studies(wait: float = 0):
+    return study_lists.get('metabolights', wait=wait)
 
 
-def fetch_workbench_studies():
-    api_url = "https://www.metabolomicsworkbench.org/rest/study/study_id/ST/summary"
-    return fetch_study_list(api_url=api_url, source='workbench', api_session=api_session)
+def fetch_workbench_studies(wait: float = 0):
+    return study_lists.get('workbench', wait=wait)
 
 
-def fetch_metabobank_studies():
-    api_url = "https://ddbj.nig.ac.jp/public/metabobank/study/"
-    return fetch_study_list(api_url=api_url, source='metabobank', api_session=api_session)
+def fetch_metabobank_studies(wait: float = 0):
+    return study_lists.get('metabobank', wait=wait)
+
+
+def study_list_response(source: str):
+    """
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :return: the JSON study list of a source, with an ETag of the current copy of the list
+    """
+    study_lst = study_lists.get(source, wait=STUDY_LIST_WAIT)
+    if not study_lst:
+        return jsonify(study_lst)
+    return conditional_response(make_etag('studies', source, study_lists.version(source)),
+                                lambda: jsonify(study_lst))
 
 
 @app.route('/fetch_metabolights_studies')
 def fetch_metabolights_studies_json():
-    return jsonify(fetch_metabolights_studies())
+    return study_list_response('metabolights')
 
 
 @app.route('/fetch_workbench_studies')
 def fetch_workbench_studies_json():
-    return jsonify(fetch_workbench_studies())
+    return study_list_response('workbench')
 
 
 @app.route('/fetch_metabobank_studies')
 def fetch_metabobank_studies_json():
-    return jsonify(fetch_metabobank_studies())
+    return study_list_response('metabobank')
+
+
+@app.route('/typeahead_studies/<source>')
+def typeahead_studies(source: str):
+    """
+    Searches the study ids of a source by prefix, page by page.
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :return: a JSON response {"results": [study ids], "next_cursor": id or null, "total": number of studies};
+             query parameters: 'prefix', 'limit' (at most 100) and 'cursor' (the 'next_cursor' of the previous page)
+    """
+    if source not in STUDY_LIST_URLS:
+        return jsonify({'error': f"unknown source: {source}"}), 404
+
+    prefix = request.args.get('prefix', '')
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), 1), TYPEAHEAD_MAX_LIMIT)
+
+    study_index = study_lists.index(source, wait=STUDY_LIST_WAIT)
+
+    def search():
+        results, next_cursor = study_index.search(prefix=prefix, limit=limit, cursor=cursor)
+        return jsonify({'results': results, 'next_cursor': next_cursor, 'total': len(study_index)})
+
+    return conditional_response(make_etag('typeahead', source, study_lists.version(source), prefix, limit, cursor),
+                                search)
+
+
+@app.route('/search_metabolites')
+def search_metabolites():
+    """
+    Finds the studies reporting a metabolite, across all studies parsed by the service or mirrored in the catalog.
+    Names are matched case- and punctuation-insensitively by prefix of the whole name or of one of its words.
+    :return: a JSON response {"results": [{"source", "study_id", "names"}], "next_cursor": cursor or null,
+             "total": number of studies}; query parameters: 'q' (at least 2 characters), 'source',
+             'limit' (at most 100) and 'cursor' (the 'next_cursor' of the previous page)
+    """
+    query = request.args.get('q', '')
+    source = request.args.get('source') or None
+    if source is not None and source not in STUDY_LIST_URLS:
+        return jsonify({'error': f"unknown source: {source}"}), 404
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+
+    refresh_from_catalog()
+
+    def search():
+        results, next_cursor, total = metabolite_index.search(query, source=source, limit=limit, cursor=cursor)
+        return jsonify({'results': results, 'next_cursor': next_cursor, 'total': total})
+
+    return conditional_response(make_etag('metabolites', metabolite_index.version, query, source, limit, cursor),
+                                search)
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Exposes request and upstream latencies, upstream status codes, Metabobank crawl requests, cache statistics
+    and downloaded bytes.
+    :return: the metrics in the Prometheus text exposition format
+    """
+    return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route('/study_section/<source>/<study_id>/<section>')
+def study_section(source: str, study_id: str, section: str):
+    """
+    Returns one page of a section of a study page (assays, metabolites or file lists) that the page loads on demand.
+    The study is served from the parsed study cache shared with the page.
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param study_id: current study id
+    :param section: name of the section, see `study_sections.SECTIONS`
+    :return: a JSON response {"items": [...], "next_cursor": cursor or null, "total": number of items};
+             query parameters: 'cursor' (the 'next_cursor' of the previous page), 'limit' (at most 500),
+             'assay' (the assay number of per-assay sections) and 'mode' (the shape of MetaboLights raw files)
+    """
+    if source not in SECTIONS or section not in SECTIONS[source]:
+        return jsonify({'error': f"unknown section: {source}/{section}"}), 404
+
+    study_data, resp_code = get_study_data(source, study_id, api_session)
+    if resp_code != 200:
+        return jsonify({'error': f"study details are not available: {resp_code}"}), resp_code
+
+    assay, mode = request.args.get('assay'), request.args.get('mode')
+    try:
+        # the items of a section are derived once per study version and shared by all its pages
+        items = fragment_cache.get_or_render(
+            source, study_id, study_data.version, f'section:{section}:{assay}:{mode}',
+            lambda: section_items(source, section, study_data, request.args)
+        )
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+
+    limit = min(max(request.args.get('limit', SECTION_PAGE_SIZE, type=int), 1), SECTION_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+
+    def section_page():
+        page, next_cursor = paginate(items, cursor=cursor, limit=limit)
+        return jsonify({'items': page, 'next_cursor': next_cursor, 'total': len(items)})
+
+    etag = make_etag('section', source, study_id, study_data.version, section, assay, mode, limit, cursor)
+    return conditional_response(etag, section_page)
 
 
 @app.route('/metabolomics', methods=['GET', 'POST'])
@@ -256,11 +584,11 @@ def metabolomics():
         form_type = request.form.get('form-name')
 
         if form_type == 'metabolights-selection':
-            metabolights_form.study.choices = fetch_metabolights_studies()
+            metabolights_form.study.index = study_lists.index('metabolights')
         elif form_type == 'metabolomicsworkbench-selection':
-            metabolomicsworkbench_form.study.choices = fetch_workbench_studies()
+            metabolomicsworkbench_form.study.index = study_lists.index('workbench')
         elif form_type == 'metabobank-selection':
-            metabobank_form.study.choices = fetch_metabobank_studies()
+            metabobank_form.study.index = study_lists.index('metabobank')
 
         if form_type == 'metabolights-login':
             email = request.form.get('email')
@@ -0,0 +1,70 @@
+import html
+import re
+from collections import namedtuple
+
+AutoindexEntry = namedtuple('AutoindexEntry', ['href', 'last_modified', 'size'])
+
+_ANCHOR_RE = re.compile(
+    r"""<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))[^>]*>""",
+    re.IGNORECASE
+)
+_TAG_RE = re.compile(r'<[^>]*>')
+# "2023-05-01 10:00" (Apache >= 2.4 default) or "01-May-2023 10:00" (older servers), then the size column
+_COLUMNS_RE = re.compile(
+    r'^\s*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?|\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}(?::\d{2})?)'
+    r'\s+(\d+(?:\.\d+)?[KMGTP]?|-)'
+)
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+
+def _parse_line(line: str):
+    matches = list(_ANCHOR_RE.finditer(line))
+    for i, match in enumerate(matches):
+        href = next(group for group in match.groups() if group is not None)
+        tail_end = matches[i + 1].start() if i + 1 < len(matches) else len(line)
+        tail = line[match.end():tail_end]
+        closing = tail.lower().find('</a>')
+        if closing >= 0:
+            tail = tail[closing + 4:]
+        columns = _COLUMNS_RE.match(html.unescape(_TAG_RE.sub(' ', tail)))
+        if columns:
+            last_modified, size = columns.groups()
+            yield AutoindexEntry(html.unescape(href), last_modified, None if size == '-' else size)
+        else:
+            yield AutoindexEntry(html.unescape(href), None, None)
+
+
+def iter_autoindex(lines):
+    """
+    Extracts the links of an Apache autoindex page line by line, without building a DOM.
+    Both the <pre> and the <table> ("FancyIndexing") layouts are supported; Apache writes one
+    entry per line, so the last-modified and size columns are read from the rest of the line.
+    :param lines: iterable of lines of the page (str or bytes, e.g. a file opened in binary mode)
+    :return: a generator of AutoindexEntry(href, last_modified, size) in page order;
+             last_modified and size are the raw column values, or None if the entry has none
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if '<a' in line or '<A' in line:
+            yield from _parse_line(line)
+
+
+def parse_autoindex(text: str) -> list:
+    """
+    :param text: an Apache autoindex page
+    :return: a list of AutoindexEntry in page order
+    """
+    return list(iter_autoindex(text.splitlines()))
+
+
+def size_in_bytes(size: str):
+    """
+    :param size: a size column value such as '512', '1.2K' or '3M'
+    :return: the approximate size in bytes, or None if unknown
+    """
+    if not size:
+        return None
+    unit = size[-1] if size[-1] in _SIZE_UNITS else ''
+    number = size[:-1] if unit else size
+    return int(float(number) * _SIZE_UNITS[unit])
@@ -0,0 +1,95 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from logging_config import logger
+from utils import (metabolights_get_study_details, metabolights_fetch_metadata_and_raw_files,
+                   metabolomics_workbench_get_study_details, metabobank_get_study_details)
+
+BATCH_WORKERS = 8
+MAX_BATCH_SIZE = 1000
+
+# study id prefixes of the supported sources
+STUDY_ID_PREFIXES = {
+    'metabolights': 'MTBLS',
+    'workbench': 'ST',
+    'metabobank': 'MTBK',
+}
+
+
+def detect_source(study_id: str):
+    """
+    :param study_id: current study id
+    :return: the source of the study ('metabolights', 'workbench' or 'metabobank') or None if it is unknown
+    """
+    for source, prefix in STUDY_ID_PREFIXES.items():
+        if study_id.upper().startswith(prefix):
+            return source
+    return None
+
+
+def get_study_details(source: str, study_id: str, api_session: requests.Session):
+    """
+    Fetches the details of a study from any source in the form used by its study page.
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param study_id: current study id
+    :param api_session: current session
+    :return: dictionary with study details and the HTTP status code
+    """
+    if source == 'metabolights':
+        study_details, resp_code = metabolights_get_study_details(study_id=study_id, api_session=api_session)
+        if resp_code != 200:
+            return {}, resp_code
+        return metabolights_fetch_metadata_and_raw_files(assays_content=study_details), 200
+    elif source == 'workbench':
+        return metabolomics_workbench_get_study_details(study_id=study_id, api_session=api_session)
+    elif source == 'metabobank':
+        return metabobank_get_study_details(study_id=study_id, api_session=api_session)
+    return {}, 400
+
+
+def iter_batch_details(study_ids: list, api_session: requests.Session, source: str = None,
+                       max_workers: int = BATCH_WORKERS):
+    """
+    Fetches the details of many studies with bounded concurrency and yields them as soon as each one completes.
+    :param study_ids: list of study ids
+    :param api_session: current session
+    :param source: source of all studies; if None, it is detected from each study id
+    :param max_workers: maximum number of studies fetched at the same time
+    :return: a generator of dictionaries {'study_id', 'source', 'status', 'data'} in completion order
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    try:
+        for study_id in dict.fromkeys(study_ids):
+            study_source = source or detect_source(study_id)
+            if study_source not in STUDY_ID_PREFIXES:
+                yield {'study_id': study_id, 'source': study_source, 'status': 400, 'data': {},
+                       'error': 'unknown source'}
+                continue
+            future = executor.submit(get_study_details, study_source, study_id, api_session)
+            futures[future] = (study_id, study_source)
+
+        for future in as_completed(futures):
+            study_id, study_source = futures[future]
+            try:
+                data, resp_code = future.result()
+                yield {'study_id': study_id, 'source': study_source, 'status': resp_code, 'data': data}
+            except Exception as e:
+                logger.error(f"Error fetching details of {study_id}: {e}")
+                yield {'study_id': study_id, 'source': study_source, 'status': 500, 'data': {}, 'error': str(e)}
+    finally:
+        # the client may have disconnected: do not start the remaining studies
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def iter_ndjson(records):
+    """
+    :param records: iterable of JSON-serializable objects
+    :return: a generator of newline-delimited JSON lines
+    """
+    for record in records:
+        yield json.dumps(record) + "\n"
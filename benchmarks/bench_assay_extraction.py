@@ -0,0 +1,69 @@
+"""
+Compares the column-indexed raw file extraction with the per-cell scan it replaced
+on a synthetic MetaboLights assay table.
+
+    python benchmarks/bench_assay_extraction.py [--rows 20000] [--columns 200] [--file-columns 3] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils import extract_raw_file_names
+
+
+def make_assay_table(rows: int, columns: int, file_columns: int):
+    """
+    :return: the header in the MetaboLights 'fields' layout and the rows of the table
+    """
+    step = max(columns // (file_columns + 1), 1)
+    file_column_indexes = {step * (i + 1) for i in range(file_columns)}
+    fields = {
+        f'{c}~{header}': {'index': c, 'header': header}
+        for c, header in ((c, 'Raw Spectral Data File' if c in file_column_indexes else f'Parameter Value[{c}]')
+                          for c in range(columns))
+    }
+    data = [
+        [f'FILES/sample_{r}_{c}.mzML' if c in file_column_indexes else f'value {r % 97} {c}' for c in range(columns)]
+        for r in range(rows)
+    ]
+    return fields, data
+
+
+def cell_scan(rows: list) -> list:
+    return [[el[len('FILES/'):] for el in row if el.startswith('FILES/')] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--columns', type=int, default=200)
+    parser.add_argument('--file-columns', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fields, rows = make_assay_table(args.rows, args.columns, args.file_columns)
+    expected = cell_scan(rows)
+    assert extract_raw_file_names(rows) == expected, "extractors disagree"
+    assert extract_raw_file_names(rows, fields=fields) == expected, "extractors disagree"
+
+    candidates = {
+        'per-cell scan': lambda: cell_scan(rows),
+        'columns from contents, rows': lambda: extract_raw_file_names(rows),
+        'columns from header, rows': lambda: extract_raw_file_names(rows, fields=fields),
+        'columns from header, flat': lambda: extract_raw_file_names(rows, mode='flat', fields=fields),
+        'columns from header, unique': lambda: extract_raw_file_names(rows, mode='unique', fields=fields),
+    }
+
+    print(f"assay table: {args.rows} rows x {args.columns} columns, {args.file_columns} file columns")
+    baseline = None
+    for name, func in candidates.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:34s} {best * 1000:8.1f} ms  x{baseline / best:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the autoindex link extractor with the BeautifulSoup parsing it replaced
+on a synthetic Metabobank study root listing.
+
+    python benchmarks/bench_autoindex.py [--entries 5000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bs4 import BeautifulSoup
+
+from autoindex import parse_autoindex
+
+
+def make_listing(entries: int) -> str:
+    rows = [
+        f'<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a href="MTBKS{i}/">MTBKS{i}/</a>'
+        f'</td><td align="right">2023-05-01 10:{i % 60:02d}  </td><td align="right">  - </td></tr>'
+        for i in range(entries)
+    ]
+    return (
+        '<html><head><title>Index of /public/metabobank/study</title></head><body>\n<table>\n'
+        '<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>\n'
+        + '\n'.join(rows) + '\n</table>\n</body></html>\n'
+    )
+
+
+def bs4_hrefs(listing: str, features: str) -> list:
+    soup = BeautifulSoup(listing, features)
+    return [link.get("href") for link in soup.find_all("a") if link.get("href")]
+
+
+def autoindex_hrefs(listing: str) -> list:
+    return [entry.href for entry in parse_autoindex(listing) if entry.href]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    listing = make_listing(args.entries)
+    expected = bs4_hrefs(listing, "html.parser")
+    assert autoindex_hrefs(listing) == expected, "parsers disagree"
+
+    candidates = {
+        'BeautifulSoup(html.parser)': lambda: bs4_hrefs(listing, "html.parser"),
+        'BeautifulSoup(lxml)': lambda: bs4_hrefs(listing, "lxml"),
+        'autoindex.parse_autoindex': lambda: autoindex_hrefs(listing),
+    }
+
+    print(f"listing: {args.entries} entries, {len(listing) / 1024:.0f} KiB")
+    baseline = None
+    for name, func in candidates.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:30s} {best * 1000:8.1f} ms  x{baseline / best:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Measures the memory retained per cached study by the parsed dictionaries and by the compact study models
+(study_models.py) that replaced them, on synthetic MetaboLights, Workbench and Metabobank studies decoded from
+JSON the way the service parses them.
+
+    python benchmarks/bench_study_memory.py [--assays 4] [--rows 20000] [--file-columns 2] [--metabolites 20000]
+                                            [--files 20000]
+"""
+import argparse
+import gc
+import json
+import os
+import pickle
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from study_models import study_model
+from utils import CACHE_MAX_BYTES, metabolights_fetch_metadata_and_raw_files, metabolights_parse_study_content
+
+MEASUREMENTS = ['metabolite profiling', 'targeted metabolite profiling']
+PLATFORMS = ['Q Exactive (Thermo Scientific)', 'Agilent 6550 iFunnel Q-TOF LC/MS']
+ANALYSES = [('AN000001', 'Reversed phase POSITIVE ION MODE'), ('AN000002', 'Reversed phase NEGATIVE ION MODE')]
+
+
+def metabolights_document(assays: int, rows: int, file_columns: int) -> str:
+    """
+    :return: a MetaboLights study document with assay tables of `rows` rows
+    """
+    headers = ['Sample Name', 'Extract Name'] + ['Raw Spectral Data File' for _ in range(file_columns)]
+    content = {
+        'title': 'Synthetic study', 'description': 'Measured by bench_study_memory.py',
+        'assays': [{
+            'assayNumber': number, 'measurement': MEASUREMENTS[number % 2], 'technology': 'mass spectrometry',
+            'platform': PLATFORMS[number % 2], 'fileName': f'a_assay{number}.txt',
+            'metaboliteAssignment': {'metaboliteAssignmentLines': [f'metabolite {i}' for i in range(rows // 10)]},
+            'assayTable': {
+                'fields': [{'index': i, 'header': header} for i, header in enumerate(headers)],
+                'data': [[f'sample_{r}', f'extract_{r}'] + [f'FILES/sample_{number}_{r}_{c}.mzML'
+                                                            for c in range(file_columns)] for r in range(rows)],
+            },
+        } for number in range(1, assays + 1)],
+    }
+    return json.dumps({'content': content})
+
+
+def metabolights_study(document: str) -> dict:
+    return metabolights_fetch_metadata_and_raw_files(metabolights_parse_study_content([document.encode()]))
+
+
+def workbench_document(metabolites: int) -> str:
+    """
+    :return: the metabolites document of a Workbench study
+    """
+    return json.dumps({str(i): {
+        'study_id': 'ST000001', 'analysis_id': ANALYSES[i % 2][0], 'analysis_summary': ANALYSES[i % 2][1],
+        'metabolite_name': f'metabolite {i // 2}', 'refmet_name': f'RefMet {i // 2}',
+    } for i in range(1, metabolites + 1)})
+
+
+def workbench_study(document: str) -> dict:
+    # the layout of utils.metabolomics_workbench_get_study_details
+    study = {'study_id': 'ST000001', 'study_title': 'Synthetic study', 'species': 'Homo sapiens'}
+    study['assays'] = [{key: {'metadata': {
+        'analysis_id': record.get('analysis_id'),
+        'analysis_summary': record.get('analysis_summary'),
+        'reported_metabolite_name': record.get('metabolite_name'),
+        'refmet_name': record.get('refmet_name'),
+    }}} for key, record in json.loads(document).items()]
+    return study
+
+
+def metabobank_document(files: int) -> str:
+    base_url = 'https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS1/'
+    return json.dumps({
+        'results_files': [f'{base_url}E{i % 10}/OtherData/result_{i}.txt' for i in range(files // 10)],
+        'raw_files': [f'raw_{i}.zip' for i in range(files)],
+    })
+
+
+def retained(build) -> tuple:
+    """
+    :param build: callable returning a parsed study
+    :return: the parsed study, and the bytes retained by it
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        value = build()
+        gc.collect()
+        return value, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--assays', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--file-columns', type=int, default=2)
+    parser.add_argument('--metabolites', type=int, default=20000)
+    parser.add_argument('--files', type=int, default=20000)
+    args = parser.parse_args()
+
+    studies = {
+        'metabolights': (metabolights_document(args.assays, args.rows, args.file_columns), metabolights_study),
+        'workbench': (workbench_document(args.metabolites), workbench_study),
+        'metabobank': (metabobank_document(args.files), json.loads),
+    }
+
+    print(f"{'source':14s} {'dict MiB':>9s} {'model MiB':>10s} {'ratio':>6s} {'studies/cache':>14s} "
+          f"{'pickle dict':>12s} {'pickle model':>13s}")
+    for source, (document, parse) in studies.items():
+        data, dict_bytes = retained(lambda: parse(document))
+        data_pickle = len(pickle.dumps(data, protocol=5))
+        # the model is built from its own copy, so the decoded strings it keeps are counted
+        model, model_bytes = retained(lambda: study_model(source, parse(document)))
+        model_pickle = len(pickle.dumps(model, protocol=5))
+        del data, model
+        print(f"{source:14s} {dict_bytes / 2 ** 20:9.1f} {model_bytes / 2 ** 20:10.1f} "
+              f"{dict_bytes / model_bytes:5.1f}x {CACHE_MAX_BYTES // dict_bytes:6d} -> {CACHE_MAX_BYTES // model_bytes:<6d}"
+              f"{data_pickle / 2 ** 20:10.1f}MiB {model_pickle / 2 ** 20:10.1f}MiB")
+
+
+if __name__ == '__main__':
+    main()
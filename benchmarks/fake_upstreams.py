@@ -0,0 +1,335 @@
+"""
+Local stand-ins for the MetaboLights, Metabolomics Workbench and DDBJ (Metabobank autoindex) servers,
+serving synthetic studies of configurable size with configurable latency and failures.
+Used by `loadtest.py`; can also be started on its own to point a development server at them:
+
+    python benchmarks/fake_upstreams.py --assay-rows 100000 --latency 0.05
+    METABOLOMICS_UPSTREAM_OVERRIDES=<printed value> flask run
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILE_BLOCK = bytes(range(256)) * 256
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class UpstreamProfile:
+    """
+    Size of the synthetic studies and behaviour of the stand-in servers.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, failure_mode: str = 'status',
+                 studies: int = 100, assays: int = 2, assay_rows: int = 1000, assay_columns: int = 30,
+                 metabolites: int = 200, experiments: int = 4, raw_batches: int = 0, files_per_directory: int = 50,
+                 file_size: int = 1024 * 1024):
+        """
+        :param latency: seconds before the response headers of every request
+        :param failure_rate: fraction of the requests that fail
+        :param failure_mode: 'status' (503 responses) or 'reset' (connections closed without a response)
+        :param studies: number of studies in the study lists
+        :param assays: number of assays of a MetaboLights study
+        :param assay_rows: rows of each MetaboLights assay table
+        :param assay_columns: columns of each MetaboLights assay table (4 of them are file columns)
+        :param metabolites: metabolites of a Workbench study
+        :param experiments: E* directories of a Metabobank study
+        :param raw_batches: batch directories under Rawdata/ (0: raw files directly in Rawdata/)
+        :param files_per_directory: entries of the OtherData/, Rawdata/ and batch directories
+        :param file_size: size in bytes of every downloadable file (may be several GB, it is never held in memory)
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.studies = studies
+        self.assays = assays
+        self.assay_rows = assay_rows
+        self.assay_columns = max(assay_columns, 5)
+        self.metabolites = metabolites
+        self.experiments = experiments
+        self.raw_batches = raw_batches
+        self.files_per_directory = files_per_directory
+        self.file_size = file_size
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+@lru_cache(maxsize=4)
+def metabolights_study(assays: int, assay_rows: int, assay_columns: int) -> bytes:
+    """
+    :return: a MetaboLights study document; the same body is served for every study id
+    """
+    file_columns = {1, 5, 9, 13}
+    fields = {
+        f"{i}": {'index': i, 'header': f"Raw Spectral Data File {i}" if i in file_columns else f"Parameter {i}"}
+        for i in range(assay_columns)
+    }
+    content = {
+        'title': 'Synthetic study',
+        'description': 'Served by the load test stand-in server. ' * 20,
+        'assays': [],
+    }
+    for number in range(1, assays + 1):
+        rows = [[f"FILES/assay{number}/sample{row}_{i}.mzML" if i in file_columns else f"value {row} {i}"
+                 for i in range(assay_columns)] for row in range(assay_rows)]
+        content['assays'].append({
+            'assayNumber': number,
+            'measurement': 'metabolite profiling',
+            'technology': 'mass spectrometry',
+            'platform': 'LC-MS',
+            'fileName': f"a_assay{number}.txt",
+            'assayTable': {'fields': fields, 'data': rows},
+            'metaboliteAssignment': {
+                'metaboliteAssignmentLines': [f"metabolite {i}" for i in range(assay_rows // 10)],
+            },
+        })
+    return json.dumps({'content': content}).encode()
+
+
+def autoindex(path: str, entries: list) -> bytes:
+    """
+    :param entries: names of the entries, directories with a trailing slash
+    :return: an Apache directory listing
+    """
+    rows = [
+        f'<tr><td valign="top"><img src="/icons/{"folder" if name.endswith("/") else "unknown"}.gif" alt="[ ]">'
+        f'</td><td><a href="{name}">{name}</a></td><td align="right">2024-01-01 10:00  </td>'
+        f'<td align="right">  - </td></tr>'
+        for name in entries
+    ]
+    return (f'<html><head><title>Index of {path}</title></head><body>\n<table>\n'
+            '<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>\n'
+            + '\n'.join(rows) + '\n</table>\n</body></html>\n').encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set on the subclass of each server
+    profile = UpstreamProfile()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        profile = self.profile
+        if profile.latency:
+            time.sleep(profile.latency)
+        if profile.failure_rate and random.random() < profile.failure_rate:
+            if profile.failure_mode == 'reset':
+                self.close_connection = True
+                return
+            return self.send_body(b'{"error": "injected failure"}', status=503)
+
+        path, _, query = self.path.partition('?')
+        routed = self.route(path, query)
+        if routed is None:
+            return self.send_body(b'not found', status=404, content_type='text/plain')
+        if isinstance(routed, int):
+            return self.send_file(routed)
+        body, content_type = routed
+        self.send_body(body, content_type=content_type)
+
+    def route(self, path: str, query: str):
+        """
+        :return: None (404), (body, content type), or the size of a file to stream
+        """
+        raise NotImplementedError
+
+    def send_body(self, body: bytes, status: int = 200, content_type: str = 'application/json'):
+        etag = f'"{len(body)}"'
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, size: int):
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        remaining = end - start + 1
+        offset = start % len(FILE_BLOCK)
+        while remaining > 0:
+            chunk = FILE_BLOCK[offset:offset + min(remaining, FILE_CHUNK_SIZE)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+            offset = (offset + len(chunk)) % len(FILE_BLOCK)
+
+
+class MetabolightsHandler(StandInHandler):
+    def route(self, path: str, query: str):
+        profile = self.profile
+        if path == '/metabolights/ws/studies':
+            return json.dumps({'content': [f"MTBLS{i}" for i in range(1, profile.studies + 1)]}).encode(), \
+                'application/json'
+        if path.startswith('/metabolights/ws/studies/public/study/'):
+            return metabolights_study(profile.assays, profile.assay_rows, profile.assay_columns), 'application/json'
+        if re.fullmatch(r'/metabolights/ws/studies/[^/]+/download', path):
+            return profile.file_size
+        if re.fullmatch(r'/metabolights/ws/studies/[^/]+/files', path):
+            files = [{'file': f"m_result{i}.tsv"} for i in range(profile.files_per_directory)]
+            return json.dumps({'study': files}).encode(), 'application/json'
+        return None
+
+
+class WorkbenchHandler(StandInHandler):
+    def route(self, path: str, query: str):
+        profile = self.profile
+        if path == '/rest/study/study_id/ST/summary':
+            studies = {str(i): {'study_id': f"ST{i:06d}", 'study_title': f"Study {i}"}
+                       for i in range(1, profile.studies + 1)}
+            return json.dumps(studies).encode(), 'application/json'
+        match = re.fullmatch(r'/rest/study/study_id/([^/]+)/(summary|metabolites)', path)
+        if match is None:
+            return None
+        study_id, kind = match.groups()
+        if kind == 'summary':
+            return json.dumps({'study_id': study_id, 'study_title': 'Synthetic study',
+                               'study_summary': 'Served by the load test stand-in server. ' * 20}).encode(), \
+                'application/json'
+        metabolites = {str(i): {'analysis_id': 'AN000001', 'analysis_summary': 'LC-MS',
+                                'metabolite_name': f"metabolite {i}", 'refmet_name': f"refmet {i}"}
+                       for i in range(1, profile.metabolites + 1)}
+        return json.dumps(metabolites).encode(), 'application/json'
+
+
+class DdbjHandler(StandInHandler):
+    ROOT = '/public/metabobank/study/'
+
+    def route(self, path: str, query: str):
+        profile = self.profile
+        if not path.startswith(self.ROOT):
+            return None
+        parts = path[len(self.ROOT):].split('/')
+        if not path.endswith('/'):
+            return profile.file_size
+        parts = parts[:-1]
+        files = profile.files_per_directory
+
+        if not parts:
+            entries = [f"MTBKS{i}/" for i in range(1, profile.studies + 1)]
+        elif len(parts) == 1:
+            entries = [f"E{i}/" for i in range(1, profile.experiments + 1)] + ['readme.txt']
+        elif len(parts) == 2:
+            entries = ['OtherData/', 'Rawdata/']
+        elif parts[2] == 'OtherData':
+            entries = [f"result{i}.txt" for i in range(files)]
+        elif len(parts) == 3 and parts[2] == 'Rawdata' and profile.raw_batches:
+            # raw files one level down, in Rawdata/<batch>/ of the study root
+            entries = [f"batch{i}/" for i in range(1, profile.raw_batches + 1)]
+        else:
+            entries = [f"{'_'.join(parts)}_{i}.zip" for i in range(files)]
+        return autoindex(path, entries), 'text/html'
+
+
+class FakeUpstreams:
+    """
+    The three stand-in servers, each on its own local port and serving requests in threads.
+    """
+    HANDLERS = {
+        'www.ebi.ac.uk': MetabolightsHandler,
+        'www.metabolomicsworkbench.org': WorkbenchHandler,
+        'ddbj.nig.ac.jp': DdbjHandler,
+    }
+
+    def __init__(self, profile: UpstreamProfile = None, host: str = '127.0.0.1'):
+        self.profile = profile or UpstreamProfile()
+        self.host = host
+        self.servers = {}
+
+    def start(self):
+        for upstream_host, handler in self.HANDLERS.items():
+            handler_class = type(handler.__name__, (handler,), {'profile': self.profile})
+            server = ThreadingHTTPServer((self.host, 0), handler_class)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers[upstream_host] = server
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        self.servers.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def overrides(self) -> str:
+        """
+        :return: the value of METABOLOMICS_UPSTREAM_OVERRIDES pointing the service at the stand-in servers
+        """
+        return ','.join(f"{upstream_host}=http://{self.host}:{server.server_address[1]}"
+                        for upstream_host, server in self.servers.items())
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    defaults = UpstreamProfile()
+    parser.add_argument('--latency', type=float, default=defaults.latency, help="upstream latency in seconds")
+    parser.add_argument('--failure-rate', type=float, default=defaults.failure_rate)
+    parser.add_argument('--failure-mode', choices=('status', 'reset'), default=defaults.failure_mode)
+    parser.add_argument('--studies', type=int, default=defaults.studies)
+    parser.add_argument('--assays', type=int, default=defaults.assays)
+    parser.add_argument('--assay-rows', type=int, default=defaults.assay_rows)
+    parser.add_argument('--assay-columns', type=int, default=defaults.assay_columns)
+    parser.add_argument('--metabolites', type=int, default=defaults.metabolites)
+    parser.add_argument('--experiments', type=int, default=defaults.experiments)
+    parser.add_argument('--raw-batches', type=int, default=defaults.raw_batches)
+    parser.add_argument('--files-per-directory', type=int, default=defaults.files_per_directory)
+    parser.add_argument('--file-size', type=int, default=defaults.file_size, help="size of downloads in bytes")
+
+
+def profile_from_arguments(args) -> UpstreamProfile:
+    return UpstreamProfile(
+        latency=args.latency, failure_rate=args.failure_rate, failure_mode=args.failure_mode, studies=args.studies,
+        assays=args.assays, assay_rows=args.assay_rows, assay_columns=args.assay_columns,
+        metabolites=args.metabolites, experiments=args.experiments, raw_batches=args.raw_batches,
+        files_per_directory=args.files_per_directory, file_size=args.file_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with FakeUpstreams(profile_from_arguments(args)) as upstreams:
+        print(f"METABOLOMICS_UPSTREAM_OVERRIDES={upstreams.overrides()}", flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
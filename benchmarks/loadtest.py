@@ -0,0 +1,275 @@
+"""
+Drives the real routes of the service with concurrent clients against local stand-in upstream servers
+(see fake_upstreams.py) and reports requests/s, p50/p99 latency and the peak RSS of the service per route.
+Every route runs in a fresh service process with an empty cache directory. Each distinct study is requested
+once before the measurement (--warmup 0 measures the cold requests too, at the cost of noisier p99 values).
+
+    python benchmarks/loadtest.py [--routes metabolights_page,metabobank_page] [--concurrency 16] [--requests 400]
+                                  [--latency 0.05] [--assay-rows 100000] [--file-size 2000000000] ...
+    python benchmarks/loadtest.py --save-baseline   # writes benchmarks/baselines/loadtest.json
+    python benchmarks/loadtest.py --baseline        # exits with 1 on a regression
+    python benchmarks/loadtest.py --server async    # the service in the async serving mode (aio_server.py)
+
+Baselines are specific to the machine and to the stand-in profile they were recorded with.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_upstreams import FakeUpstreams, add_profile_arguments, profile_from_arguments
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'loadtest.json')
+DDBJ_STUDY_URL = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS{n}"
+
+# route name: path of the n-th request (n cycles through the distinct studies)
+ROUTES = {
+    'metabolights_page': '/metabolights_get_study_details_info/MTBLS{n}',
+    'metabolights_raw_files': '/study_section/metabolights/MTBLS{n}/raw_files?assay=1&limit=500',
+    'workbench_page': '/metabolomics_workbench_get_study_details_info/ST{n:06d}',
+    'metabobank_page': '/metabobank_get_study_details_info/MTBKS{n}',
+    'metabolights_download': '/metabolights_download_file/MTBLS{n}/raw{n}.mzML',
+    'metabobank_download': '/metabobank_download_file/' + DDBJ_STUDY_URL + '/E1/Rawdata/MTBKS{n}_E1_Rawdata_0.zip',
+    'study_list': '/fetch_metabolights_studies',
+}
+# relative changes tolerated before a route is reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, server: str = 'sync'):
+    """
+    Runs the service like `flask run` (threaded development server) or, with server='async',
+    like `python aio_server.py` in this process.
+    """
+    sys.path.insert(0, ROOT)
+    if server == 'async':
+        from aiohttp import web
+        from aio_server import create_app
+
+        web.run_app(create_app(), host='127.0.0.1', port=port, print=None)
+        return
+
+    from werkzeug.serving import make_server
+    from api import app
+
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def peak_rss(pid: int):
+    """
+    :return: the peak resident set size of a process in MiB (None where /proc is not available)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    :param values: sorted values
+    :return: the nearest-rank percentile
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values), max(1, math.ceil(fraction * len(values)))) - 1]
+
+
+class ServiceProcess:
+    """
+    The service started in a subprocess with its own cache directory, pointed at the stand-in servers.
+    """
+
+    def __init__(self, overrides: str, workdir: str, server: str = 'sync'):
+        self.port = free_port()
+        self.workdir = workdir
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ, METABOLOMICS_UPSTREAM_OVERRIDES=overrides, METABOLOMICS_WARMUP='0',
+                   METABOLOMICS_CACHE_DIR=os.path.join(workdir, 'cache'))
+        self.log = open(os.path.join(workdir, 'service.log'), 'wb')
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(self.port),
+                                         '--server', server],
+                                        cwd=workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if requests.get(f"{self.base_url}/metrics", timeout=1).ok:
+                    return
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+        self.stop()
+        with open(os.path.join(self.workdir, 'service.log'), errors='replace') as f:
+            raise RuntimeError(f"the service did not start:\n{f.read()[-4000:]}")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def drive(base_url: str, path: str, distinct: int, total: int, concurrency: int) -> dict:
+    """
+    Sends `total` requests from `concurrency` clients, each reading the whole response body.
+    :return: number of requests and errors, duration, latencies and bytes received
+    """
+    counter = itertools.count()
+    latencies, errors, received = [], [], [0]
+
+    def client():
+        with requests.Session() as http:
+            for i in iter(lambda: next(counter), None):
+                if i >= total:
+                    return
+                url = base_url + path.format(n=i % distinct + 1)
+                started = time.perf_counter()
+                try:
+                    with http.get(url, stream=True, timeout=300) as response:
+                        size = sum(len(chunk) for chunk in response.iter_content(1024 * 1024))
+                    if response.status_code >= 400:
+                        errors.append(response.status_code)
+                except requests.exceptions.RequestException as e:
+                    errors.append(type(e).__name__)
+                    continue
+                latencies.append(time.perf_counter() - started)
+                received[0] += size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return {'requests': total, 'errors': errors, 'duration': time.perf_counter() - started,
+            'latencies': sorted(latencies), 'bytes': received[0]}
+
+
+def run_route(name: str, upstreams: FakeUpstreams, args) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        service = ServiceProcess(upstreams.overrides(), workdir, server=args.server)
+        try:
+            service.wait_ready()
+            if args.warmup:
+                drive(service.base_url, ROUTES[name], args.distinct, args.distinct, 1)
+            run = drive(service.base_url, ROUTES[name], args.distinct, args.requests, args.concurrency)
+            rss = peak_rss(service.process.pid)
+        finally:
+            service.stop()
+
+    latencies = run['latencies']
+    return {
+        'requests': run['requests'],
+        'errors': len(run['errors']),
+        'rps': round(run['requests'] / run['duration'], 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': round(rss, 1) if rss is not None else None,
+        'mb_received': round(run['bytes'] / 1024 ** 2, 1),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: descriptions of the regressions of the results against the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('routes', {}).get(name)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']} req/s, baseline {base['rps']}")
+        for key in ('p50_ms', 'p99_ms', 'peak_rss_mb'):
+            if result.get(key) is not None and base.get(key) and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {result[key]}, baseline {base[key]}")
+        if result['errors'] > base.get('errors', 0):
+            regressions.append(f"{name}: {result['errors']} errors, baseline {base.get('errors', 0)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--server', choices=('sync', 'async'), default='sync',
+                        help="serve with the threaded Flask server or the async serving mode")
+    parser.add_argument('--routes', default=','.join(ROUTES), help="comma-separated route names")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="requests per route")
+    parser.add_argument('--distinct', type=int, default=10, help="distinct studies requested per route")
+    parser.add_argument('--warmup', type=int, choices=(0, 1), default=1,
+                        help="request every distinct study once before measuring")
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_PATH,
+                        help="compare with this baseline file and fail on regressions")
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE_PATH,
+                        help="write the results to this baseline file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.server)
+
+    names = [name for name in args.routes.split(',') if name]
+    unknown = [name for name in names if name not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)} (known: {', '.join(ROUTES)})")
+
+    profile = profile_from_arguments(args)
+    settings = {'concurrency': args.concurrency, 'requests': args.requests, 'distinct': args.distinct,
+                'warmup': args.warmup, 'upstreams': profile.as_dict()}
+    if args.server != 'sync':
+        settings['server'] = args.server
+    results = {}
+    print(f"{'route':<24}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'RSS MiB':>10}{'errors':>8}")
+    with FakeUpstreams(profile) as upstreams:
+        for name in names:
+            result = results[name] = run_route(name, upstreams, args)
+            print(f"{name:<24}{result['rps']:>9}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+                  f"{str(result['peak_rss_mb']):>10}{result['errors']:>8}", flush=True)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'settings': settings, 'routes': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != settings:
+            print("warning: the baseline was recorded with other settings")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
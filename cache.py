@@ -0,0 +1,905 @@
+import os
+import pickle
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import unquote, urlsplit
+
+from logging_config import logger
+
+# compact and fast for the dicts, lists and strings of parsed studies; used by the shared backends only
+PICKLE_PROTOCOL = 5
+# how long a process may hold the lease of a key it is loading before another one takes over
+LEASE_TIMEOUT = 120
+LEASE_POLL_INTERVAL = 0.05
+# decoded copies of shared entries are checked against the store on every read, so they never expire on their own
+LOCAL_COPY_TTL = float('inf')
+STAMP_SIZE = 16
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'size', 'is_error')
+
+    def __init__(self, value, expires_at: float, size: int, is_error: bool = False):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+        self.is_error = is_error
+
+
+class _Flight:
+    """
+    A load in progress for one key; followers wait on the event and reuse the leader's outcome.
+    """
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def estimate_size(obj, _depth: int = 0) -> int:
+    """
+    Roughly estimates the memory footprint of a cached value.
+    :param obj: value to measure
+    :return: size in bytes of the object and (up to a fixed depth) of the containers' contents
+    """
+    size = sys.getsizeof(obj)
+    if _depth >= 6:
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key, _depth + 1) + estimate_size(value, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += estimate_size(value, _depth + 1)
+    elif hasattr(type(obj), '__slots__'):
+        # e.g. the study models
+        for name in type(obj).__slots__:
+            size += estimate_size(getattr(obj, name, None), _depth + 1)
+    return size
+
+
+class CacheBackend:
+    """
+    Interface of the stores behind the `cached` decorator (see `create_cache`).
+    Values are kept for a TTL; a stored exception is re-raised when it is read.
+    """
+    # True if the stored values are seen by the other processes using the same store
+    shared = False
+
+    def __contains__(self, key):
+        """
+        Checks whether an unexpired value is stored under the key, without counting a hit or a miss.
+        """
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored under the key, or the default if it is missing or expired.
+        A cached error is re-raised.
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl: float, is_error: bool = False):
+        """
+        Stores the value under the key for ttl seconds.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str) -> int:
+        """
+        Removes all entries whose (string) key starts with the prefix.
+        :return: the number of removed entries
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_or_load(self, key, loader, ttl: float, negative_ttl: float = None, error_ttl: float = None,
+                    is_negative=None):
+        """
+        Returns the cached value for the key, calling the loader on a miss.
+        Only one loader runs per key at a time; concurrent callers wait for its result.
+        :param key: cache key
+        :param loader: callable without arguments producing the value
+        :param ttl: lifetime of a regular result in seconds
+        :param negative_ttl: lifetime of a result for which is_negative() is true
+        :param error_ttl: lifetime of an exception raised by the loader; errors are not cached if None
+        :param is_negative: predicate marking results (e.g. empty lists, error codes) to be kept only briefly
+        :return: the cached or freshly loaded value
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """
+        :return: a dictionary with hit/miss/eviction counters and, if known, the current size of the cache
+        """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """
+    Thread-safe in-process LRU cache with per-entry TTL, an entry/byte limit and single-flight loading.
+    Concurrent misses for the same key share one call of the loader.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param max_entries: maximum number of entries kept in the cache
+        :param max_bytes: maximum estimated size of all entries in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        """
+        Checks whether an unexpired value is stored under the key, without counting a hit or a miss.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry.expires_at > time.monotonic()
+
+    def _lookup(self, key):
+        # must be called with the lock held
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        self._bytes -= entry.size
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored under the key, or the default if it is missing or expired.
+        A cached error is re-raised.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        if entry.is_error:
+            raise entry.value
+        return entry.value
+
+    def set(self, key, value, ttl: float, is_error: bool = False, size: int = None):
+        """
+        Stores the value under the key for ttl seconds, evicting least recently used entries if needed.
+        :param size: size of the value in bytes if it is known, estimated otherwise
+        """
+        if size is None:
+            size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._data[key] = _Entry(value, time.monotonic() + ttl, size, is_error)
+            self._bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def delete_prefix(self, prefix: str) -> int:
+        """
+        Removes all entries whose (string) key starts with the prefix.
+        :return: the number of removed entries
+        """
+        with self._lock:
+            keys = [key for key in self._data if isinstance(key, str) and key.startswith(prefix)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def get_or_load(self, key, loader, ttl: float, negative_ttl: float = None, error_ttl: float = None,
+                    is_negative=None):
+        """
+        Returns the cached value for the key, calling the loader on a miss.
+        Only one loader runs per key at a time; concurrent callers wait for its result.
+        :param key: cache key
+        :param loader: callable without arguments producing the value
+        :param ttl: lifetime of a regular result in seconds
+        :param negative_ttl: lifetime of a result for which is_negative() is true
+        :param error_ttl: lifetime of an exception raised by the loader; errors are not cached if None
+        :param is_negative: predicate marking results (e.g. empty lists, error codes) to be kept only briefly
+        :return: the cached or freshly loaded value
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                else:
+                    self.coalesced += 1
+
+        if entry is not None:
+            if entry.is_error:
+                raise entry.value
+            return entry.value
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = loader()
+        except Exception as e:
+            flight.error = e
+            if error_ttl:
+                self.set(key, e, error_ttl, is_error=True)
+            raise
+        else:
+            flight.value = value
+            if negative_ttl is not None and is_negative is not None and is_negative(value):
+                self.set(key, value, negative_ttl)
+            else:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def stats(self) -> dict:
+        """
+        :return: a dictionary with hit/miss/eviction counters and the current size of the cache
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'coalesced': self.coalesced,
+                'entries': len(self._data),
+                'bytes': self._bytes,
+            }
+
+
+class SharedCache(CacheBackend):
+    """
+    Base of the backends shared by several worker processes. Values are pickled, and a missing key is loaded
+    by one process at a time: the process holding the lease of the key calls the loader while the others
+    wait for its result. Within a process, concurrent misses share one load as in LRUCache.
+    Each process keeps the decoded values it has read in a local LRUCache: every stored value carries a random
+    stamp, and a read only fetches and unpickles the value if its stamp differs from the one of the local copy
+    (local copies are sized by their pickled length).
+    A failure of the store is logged and handled as a miss, so the service keeps working (without sharing)
+    while the store is unavailable.
+    Subclasses implement the storage operations `_read`, `_write`, `_exists`, `_discard`, `_discard_prefix`,
+    `_discard_all`, `_acquire`, `_release` and `_size`.
+    """
+    shared = True
+    # exceptions of the store that are handled as a miss
+    errors = ()
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param max_entries: maximum number of entries (of the store if it is limited, and of the local copies)
+        :param max_bytes: maximum size of the entries (of the store if it is limited, and of the local copies)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._copies = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def _failed(self, action: str, error: Exception):
+        logger.warning(f"{type(self).__name__} {action} failed: {error!r}")
+
+    def _lookup(self, key) -> tuple:
+        """
+        :return: (found, value, is_error) of the entry stored under the key
+        """
+        copy = self._copies.get(key)
+        try:
+            stored = self._read(key, copy[0] if copy is not None else None)
+        except self.errors as e:
+            self._failed('read', e)
+            return False, None, False
+        if stored is None:
+            if copy is not None:
+                self._copies.delete(key)
+            return False, None, False
+
+        stamp, blob = stored
+        if blob is None:
+            # unchanged since it was decoded by this process
+            return True, copy[2], copy[1]
+        try:
+            is_error, value = pickle.loads(blob)
+        except Exception as e:
+            # e.g. stored by another version of the code
+            logger.warning(f"Dropping the unreadable cache entry {key}: {e!r}")
+            self.delete(key)
+            return False, None, False
+        self._copies.set(key, (stamp, is_error, value), LOCAL_COPY_TTL, size=len(blob))
+        return True, value, is_error
+
+    def __contains__(self, key):
+        try:
+            return self._exists(key)
+        except self.errors as e:
+            self._failed('read', e)
+            return False
+
+    def get(self, key, default=None):
+        found, value, is_error = self._lookup(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not found:
+            return default
+        if is_error:
+            raise value
+        return value
+
+    def set(self, key, value, ttl: float, is_error: bool = False):
+        if ttl <= 0:
+            return
+        try:
+            blob = pickle.dumps((is_error, value), protocol=PICKLE_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"The value of {key} cannot be stored in the shared cache: {e!r}")
+            return
+        if len(blob) > self.max_bytes:
+            return
+        stamp = uuid.uuid4().bytes
+        try:
+            self._write(key, stamp, blob, ttl)
+        except self.errors as e:
+            self._failed('write', e)
+        else:
+            self._copies.set(key, (stamp, is_error, value), LOCAL_COPY_TTL, size=len(blob))
+
+    def delete(self, key):
+        self._copies.delete(key)
+        try:
+            self._discard(key)
+        except self.errors as e:
+            self._failed('delete', e)
+
+    def delete_prefix(self, prefix: str) -> int:
+        self._copies.delete_prefix(prefix)
+        try:
+            return self._discard_prefix(prefix)
+        except self.errors as e:
+            self._failed('delete', e)
+            return 0
+
+    def clear(self):
+        self._copies.clear()
+        try:
+            self._discard_all()
+        except self.errors as e:
+            self._failed('delete', e)
+
+    def get_or_load(self, key, loader, ttl: float, negative_ttl: float = None, error_ttl: float = None,
+                    is_negative=None):
+        found, value, is_error = self._lookup(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+                else:
+                    self.coalesced += 1
+
+        if found:
+            if is_error:
+                raise value
+            return value
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = self._load(key, loader, ttl, negative_ttl, error_ttl, is_negative)
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.value = value
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def _load(self, key, loader, ttl: float, negative_ttl: float, error_ttl: float, is_negative):
+        """
+        Loads a missing key once for all the processes: the holder of the lease of the key calls the loader and
+        stores its result, the other processes poll the store until the result appears or the lease is released
+        (or has expired, if its holder died).
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + LEASE_TIMEOUT
+        acquired = self._try_acquire(key, token)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            found, value, is_error = self._lookup(key)
+            if found:
+                with self._lock:
+                    self.coalesced += 1
+                if is_error:
+                    raise value
+                return value
+            acquired = self._try_acquire(key, token)
+
+        try:
+            if acquired:
+                # the previous holder of the lease may have stored the value just before releasing it
+                found, value, is_error = self._lookup(key)
+                if found:
+                    if is_error:
+                        raise value
+                    return value
+            try:
+                value = loader()
+            except Exception as e:
+                if error_ttl:
+                    self.set(key, e, error_ttl, is_error=True)
+                raise
+            if negative_ttl is not None and is_negative is not None and is_negative(value):
+                self.set(key, value, negative_ttl)
+            else:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if acquired:
+                self._try_release(key, token)
+
+    def _try_acquire(self, key, token: str) -> bool:
+        try:
+            return self._acquire(key, token, LEASE_TIMEOUT)
+        except self.errors as e:
+            # load without coordinating with the other processes
+            self._failed('lease', e)
+            return True
+
+    def _try_release(self, key, token: str):
+        try:
+            self._release(key, token)
+        except self.errors as e:
+            self._failed('lease', e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'coalesced': self.coalesced,
+            }
+        try:
+            size = self._size()
+        except self.errors as e:
+            self._failed('read', e)
+            size = None
+        if size is not None:
+            stats['entries'], stats['bytes'] = size
+        return stats
+
+    def _read(self, key, stamp: bytes = None):
+        """
+        :param stamp: stamp of the local copy of the value, if any
+        :return: None if the key is missing or expired, else (stamp, pickled value) with a None value if the
+                 stored stamp is the given one
+        """
+        raise NotImplementedError
+
+    def _write(self, key, stamp: bytes, blob: bytes, ttl: float):
+        raise NotImplementedError
+
+    def _exists(self, key) -> bool:
+        raise NotImplementedError
+
+    def _discard(self, key):
+        raise NotImplementedError
+
+    def _discard_prefix(self, prefix: str) -> int:
+        raise NotImplementedError
+
+    def _discard_all(self):
+        raise NotImplementedError
+
+    def _acquire(self, key, token: str, timeout: float) -> bool:
+        """
+        Takes the lease of a key for timeout seconds, unless another process holds it.
+        :return: True if the lease was taken
+        """
+        raise NotImplementedError
+
+    def _release(self, key, token: str):
+        """
+        Releases the lease of a key if it is still held with the token.
+        """
+        raise NotImplementedError
+
+    def _size(self):
+        """
+        :return: (number of entries, size in bytes) of the store, or None if it is not known
+        """
+        raise NotImplementedError
+
+
+class SQLiteCache(SharedCache):
+    """
+    Cache shared by the worker processes of a host, in a SQLite database in WAL mode (readers never wait for the
+    writer). Least recently read entries are evicted first; the read time of an entry is updated at most once
+    per ACCESS_RESOLUTION seconds, so most hits do not write to the database.
+    """
+    errors = (sqlite3.Error,)
+    ACCESS_RESOLUTION = 60
+    # the value comes last, so reading the other columns does not read its overflow pages
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        expires_at REAL NOT NULL,
+        accessed_at REAL NOT NULL,
+        size INTEGER NOT NULL,
+        stamp BLOB NOT NULL,
+        value BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS entries_by_access ON entries (accessed_at);
+    CREATE INDEX IF NOT EXISTS entries_by_expiry ON entries (expires_at);
+    CREATE TABLE IF NOT EXISTS leases (
+        key TEXT PRIMARY KEY,
+        token TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param path: database file, on a local file system shared by the processes
+        :param max_entries: maximum number of entries kept in the cache
+        :param max_bytes: maximum size of all (pickled) entries in bytes
+        """
+        super().__init__(max_entries, max_bytes)
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread and process (a connection must not be used after a fork)
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection, os.getpid()
+        return connection
+
+    def _read(self, key, stamp: bytes = None):
+        connection = self._connection()
+        row = connection.execute("SELECT expires_at, accessed_at, stamp, CASE WHEN stamp = ? THEN NULL ELSE value END "
+                                 "FROM entries WHERE key = ?", (stamp, key)).fetchone()
+        if row is None:
+            return None
+        expires_at, accessed_at, stamp, value = row
+        now = time.time()
+        if expires_at <= now:
+            with connection:
+                connection.execute("DELETE FROM entries WHERE key = ? AND expires_at <= ?", (key, now))
+            with self._lock:
+                self.expirations += 1
+            return None
+        if now - accessed_at >= self.ACCESS_RESOLUTION:
+            with connection:
+                connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return stamp, value
+
+    def _write(self, key, stamp: bytes, blob: bytes, ttl: float):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO entries (key, expires_at, accessed_at, size, stamp, value) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", (key, now + ttl, now, len(blob), stamp, blob))
+            expired = connection.execute("DELETE FROM entries WHERE expires_at <= ?", (now,)).rowcount
+            entries, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            evicted = []
+            if entries > self.max_entries or total > self.max_bytes:
+                rows = connection.execute("SELECT key, size FROM entries WHERE key != ? ORDER BY accessed_at",
+                                          (key,)).fetchall()
+                for old_key, size in rows:
+                    if entries <= self.max_entries and total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    entries -= 1
+                    total -= size
+                connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        with self._lock:
+            self.expirations += expired
+            self.evictions += len(evicted)
+
+    def _exists(self, key) -> bool:
+        row = self._connection().execute("SELECT 1 FROM entries WHERE key = ? AND expires_at > ?",
+                                         (key, time.time())).fetchone()
+        return row is not None
+
+    def _discard(self, key):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _discard_prefix(self, prefix: str) -> int:
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM entries WHERE substr(key, 1, ?) = ?",
+                                      (len(prefix), prefix)).rowcount
+
+    def _discard_all(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries")
+
+    def _acquire(self, key, token: str, timeout: float) -> bool:
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute("DELETE FROM leases WHERE key = ? AND expires_at <= ?", (key, now))
+            return connection.execute("INSERT OR IGNORE INTO leases (key, token, expires_at) VALUES (?, ?, ?)",
+                                      (key, token, now + timeout)).rowcount == 1
+
+    def _release(self, key, token: str):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM leases WHERE key = ? AND token = ?", (key, token))
+
+    def _size(self):
+        return tuple(self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE expires_at > ?", (time.time(),)).fetchone())
+
+
+class RedisError(Exception):
+    """
+    An error reply of a Redis server.
+    """
+
+
+class RedisCache(SharedCache):
+    """
+    Cache shared by the worker processes of several hosts, in a Redis server (or any server speaking its protocol),
+    through a minimal client of the protocol. Expiry and eviction are left to the server (configure a
+    maxmemory-policy such as allkeys-lru); entries and leases are namespaced by a key prefix.
+    An entry is stored as its stamp followed by the pickled value, so checking a local copy is a GETRANGE
+    of the stamp.
+    """
+    errors = (OSError, RedisError)
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', prefix: str = 'metabolomics:',
+                 max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024, timeout: float = 5):
+        """
+        :param url: redis://[:password@]host[:port][/db]
+        :param prefix: prefix of all the keys written by the cache
+        :param max_entries: maximum number of local copies of entries
+        :param max_bytes: maximum size of a stored (pickled) value and of the local copies in bytes
+        :param timeout: connect and read timeout in seconds
+        """
+        super().__init__(max_entries, max_bytes)
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def command(self, *args):
+        """
+        Sends a command on an idle connection (or a new one) and reads its reply.
+        :param args: command name and arguments (bytes, str or numbers)
+        :return: the reply: bytes, int, None or a list of replies
+        :raise RedisError: on an error reply
+        :raise OSError: if the server is unreachable
+        """
+        with self._idle_lock:
+            if self._pid != os.getpid():
+                # connections inherited from the parent process
+                self._idle, self._pid = [], os.getpid()
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            reply = self._call(connection, args)
+        except RedisError:
+            self._put_back(connection)
+            raise
+        except Exception:
+            connection[0].close()
+            raise
+        self._put_back(connection)
+        return reply
+
+    def _connect(self) -> tuple:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = sock, sock.makefile('rb')
+        try:
+            if self.password:
+                self._call(connection, ('AUTH', self.password))
+            if self.db:
+                self._call(connection, ('SELECT', self.db))
+        except Exception:
+            sock.close()
+            raise
+        return connection
+
+    def _put_back(self, connection: tuple):
+        with self._idle_lock:
+            self._idle.append(connection)
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts += [b'$%d\r\n' % len(arg), arg, b'\r\n']
+        return b''.join(parts)
+
+    def _call(self, connection: tuple, args):
+        sock, reader = connection
+        sock.sendall(self._encode(args))
+        return self._read_reply(reader)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("connection closed by the Redis server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode(errors='replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("connection closed by the Redis server")
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RedisError(f"unexpected reply {line[:32]!r}")
+
+    def _entry_key(self, key) -> str:
+        return f"{self.prefix}entry:{key}"
+
+    def _lease_key(self, key) -> str:
+        return f"{self.prefix}lease:{key}"
+
+    def _read(self, key, stamp: bytes = None):
+        if stamp is not None and self.command('GETRANGE', self._entry_key(key), 0, STAMP_SIZE - 1) == stamp:
+            return stamp, None
+        entry = self.command('GET', self._entry_key(key))
+        if entry is None:
+            return None
+        return entry[:STAMP_SIZE], memoryview(entry)[STAMP_SIZE:]
+
+    def _write(self, key, stamp: bytes, blob: bytes, ttl: float):
+        self.command('SET', self._entry_key(key), stamp + blob, 'PX', max(1, int(ttl * 1000)))
+
+    def _exists(self, key) -> bool:
+        return self.command('EXISTS', self._entry_key(key)) == 1
+
+    def _discard(self, key):
+        self.command('DEL', self._entry_key(key))
+
+    def _discard_prefix(self, prefix: str) -> int:
+        # escape the glob characters of the prefix in the SCAN pattern
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self._entry_key(prefix)) + '*'
+        removed, cursor = 0, b'0'
+        while True:
+            cursor, keys = self.command('SCAN', cursor, 'MATCH', pattern, 'COUNT', 1000)
+            if keys:
+                removed += self.command('DEL', *keys)
+            if cursor == b'0':
+                return removed
+
+    def _discard_all(self):
+        self._discard_prefix('')
+
+    def _acquire(self, key, token: str, timeout: float) -> bool:
+        return self.command('SET', self._lease_key(key), token, 'NX', 'PX', int(timeout * 1000)) is not None
+
+    def _release(self, key, token: str):
+        # not atomic: a lease that expired in between may be released early, which only allows a second load
+        if self.command('GET', self._lease_key(key)) == token.encode():
+            self.command('DEL', self._lease_key(key))
+
+    def _size(self):
+        # counting the entries would scan the whole keyspace of the server
+        return None
+
+
+def create_cache(spec: str = 'memory', max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024,
+                 sqlite_path: str = None) -> CacheBackend:
+    """
+    :param spec: 'memory' (an LRUCache in each process), 'sqlite' or 'sqlite:<path>' (shared by the processes
+                 of a host) or a 'redis://[:password@]host[:port][/db]' url (shared by several hosts)
+    :param max_entries: maximum number of entries (of the local copies for Redis)
+    :param max_bytes: maximum size of the cache (of one value and of the local copies for Redis) in bytes
+    :param sqlite_path: database file of the 'sqlite' backend
+    :return: the cache backend
+    """
+    if spec in ('', 'memory'):
+        return LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+    if spec == 'sqlite' or spec.startswith('sqlite:'):
+        return SQLiteCache(spec[len('sqlite:'):] or sqlite_path, max_entries=max_entries, max_bytes=max_bytes)
+    if spec.startswith('redis://'):
+        return RedisCache(spec, max_entries=max_entries, max_bytes=max_bytes)
+    raise ValueError(f"Unknown cache backend: {spec!r}")
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from payload_store import CACHE_DIR
+
+CATALOG_PATH = os.environ.get('METABOLOMICS_CATALOG', os.path.join(CACHE_DIR, "catalog.sqlite3"))
+# 'prefer': studies in the catalog are served from it, 'fallback': only when the upstream fails
+CATALOG_MODE = os.environ.get('METABOLOMICS_CATALOG_MODE', 'prefer')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    source TEXT NOT NULL,
+    study_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    http_status INTEGER,
+    version TEXT,
+    data TEXT,
+    synced_at REAL,
+    PRIMARY KEY (source, study_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS studies_by_status ON studies (source, status);
+"""
+
+
+class StudyCatalog:
+    """
+    Local SQLite mirror of the study details of all sources, filled by `mirror.py`.
+    Every listed study has a row: 'pending' until its details are fetched, then 'ok' (with the details in the form
+    used by the study pages and the version they were parsed from) or 'error' (with the HTTP status code).
+    The database runs in WAL mode, so the service reads it while a sync writes to it.
+    """
+    PENDING, OK, ERROR = 'pending', 'ok', 'error'
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread; a connection used as a context manager commits or rolls back a transaction
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def add_ids(self, source: str, study_ids) -> int:
+        """
+        Adds the studies that are not in the catalog yet as 'pending'.
+        :return: the number of added studies
+        """
+        with self._connection() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO studies (source, study_id, status) VALUES (?, ?, ?)",
+                ((source, study_id, self.PENDING) for study_id in study_ids))
+            return connection.total_changes - before
+
+    def ids(self, source: str, statuses=None) -> list:
+        """
+        :param statuses: statuses of the returned studies, all studies if None
+        :return: the sorted study ids of a source
+        """
+        query, params = "SELECT study_id FROM studies WHERE source = ?", [source]
+        if statuses:
+            query += f" AND status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        rows = self._connection().execute(query + " ORDER BY study_id", params).fetchall()
+        return [study_id for study_id, in rows]
+
+    def versions(self, source: str) -> dict:
+        """
+        :return: dictionary {study id: version} of the studies of a source that were mirrored successfully
+        """
+        rows = self._connection().execute("SELECT study_id, version FROM studies WHERE source = ? AND status = ?",
+                                          (source, self.OK)).fetchall()
+        return dict(rows)
+
+    def get(self, source: str, study_id: str):
+        """
+        :return: the mirrored study details and their version, or None if the study was not mirrored successfully
+        """
+        row = self._connection().execute(
+            "SELECT data, version FROM studies WHERE source = ? AND study_id = ? AND status = ?",
+            (source, study_id, self.OK)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def iter_synced_since(self, timestamp: float):
+        """
+        :param timestamp: time of the previous call
+        :return: a generator of (source, study id, version, callable returning the details) of the studies
+                 mirrored successfully and synced since the timestamp
+        """
+        rows = self._connection().execute(
+            "SELECT source, study_id, version, data FROM studies WHERE status = ? AND synced_at >= ?",
+            (self.OK, timestamp))
+        for source, study_id, version, data in rows:
+            yield source, study_id, version, lambda data=data: json.loads(data)
+
+    def put(self, source: str, study_id: str, data: dict, version: str):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO studies (source, study_id, status, http_status, version, data, synced_at) "
+                "VALUES (?, ?, ?, 200, ?, ?, ?)",
+                (source, study_id, self.OK, version, json.dumps(data, separators=(',', ':')), time.time()))
+
+    def touch(self, source: str, study_id: str):
+        """
+        Records that a mirrored study was checked and has not changed.
+        """
+        with self._connection() as connection:
+            connection.execute("UPDATE studies SET synced_at = ? WHERE source = ? AND study_id = ?",
+                               (time.time(), source, study_id))
+
+    def mark_error(self, source: str, study_id: str, http_status: int):
+        """
+        Records a failed fetch. The details of a study mirrored before are kept and still served.
+        """
+        with self._connection() as connection:
+            connection.execute(
+                "UPDATE studies SET status = ?, http_status = ?, synced_at = ? "
+                "WHERE source = ? AND study_id = ? AND status != ?",
+                (self.ERROR, http_status, time.time(), source, study_id, self.OK))
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary {source: {status: number of studies}}
+        """
+        stats = {}
+        rows = self._connection().execute("SELECT source, status, COUNT(*) FROM studies GROUP BY source, status")
+        for source, status, count in rows:
+            stats.setdefault(source, {})[status] = count
+        return stats
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """
+    :return: the catalog at METABOLOMICS_CATALOG if a sync has created it, otherwise None
+    """
+    global _catalog
+    if _catalog is None and os.path.exists(CATALOG_PATH):
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = StudyCatalog(CATALOG_PATH)
+    return _catalog
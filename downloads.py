@@ -0,0 +1,310 @@
+import io
+import mimetypes
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response
+
+from logging_config import logger
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+BUNDLE_WORKERS = 4
+# entry of a bundle listing the files that could not be downloaded
+BUNDLE_ERRORS_NAME = 'ERRORS.txt'
+
+# request headers forwarded to the upstream for resumable and partial downloads
+FORWARDED_REQUEST_HEADERS = ('Range', 'If-Range')
+# response headers passed from the upstream to the client
+FORWARDED_RESPONSE_HEADERS = ('Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified', 'ETag')
+
+
+def upstream_request_headers(request_headers) -> dict:
+    """
+    Builds headers for an upstream download request from the headers of the client request.
+    The body is requested without content encoding, so Content-Length and Content-Range stay valid.
+    :param request_headers: headers of the current client request
+    :return: a dictionary of headers for the upstream request
+    """
+    headers = {'Accept-Encoding': 'identity'}
+    for name in FORWARDED_REQUEST_HEADERS:
+        if name in request_headers:
+            headers[name] = request_headers[name]
+    return headers
+
+
+class UpstreamStream:
+    """
+    Iterates over the body of a streamed upstream response chunk by chunk.
+    The upstream connection is released when the body is exhausted or when the WSGI server closes
+    the iterable (e.g. after the client disconnected), even if iteration has never started.
+    """
+
+    def __init__(self, response, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            for chunk in self.response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
+
+
+def stream_upstream_response(response, filename: str) -> Response:
+    """
+    Passes a streamed upstream response through to the client with constant memory.
+    :param response: upstream response requested with stream=True
+    :param filename: name of the downloaded file
+    :return: a streamed attachment response with the upstream status code (200 or 206) and headers
+    """
+    headers = response.headers
+    content_type = (headers.get('Content-Type') or mimetypes.guess_type(filename)[0]
+                    or 'application/octet-stream')
+
+    client_response = Response(
+        UpstreamStream(response),
+        status=response.status_code,
+        content_type=content_type,
+        direct_passthrough=True
+    )
+    for name in FORWARDED_RESPONSE_HEADERS:
+        if name in headers:
+            client_response.headers[name] = headers[name]
+    client_response.headers.add('Content-Disposition', 'attachment', filename=filename)
+    return client_response
+
+
+class _ZipSink(io.RawIOBase):
+    """
+    Unseekable write target of a ZipFile; written bytes are collected until drained.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _close(iterable):
+    close = getattr(iterable, 'close', None)
+    if close is not None:
+        close()
+
+
+class ZipStream:
+    """
+    Writes a ZIP archive entry by entry and chunk by chunk, returning the bytes of the archive as soon as they
+    are produced. Entries are written with data descriptors and ZIP64 headers, so neither their sizes
+    nor a seekable output are needed.
+    """
+
+    def __init__(self, compression: int = zipfile.ZIP_DEFLATED):
+        self._sink = _ZipSink()
+        self._zip_file = zipfile.ZipFile(self._sink, 'w', compression)
+        self._entry = None
+
+    def open_entry(self, arcname: str):
+        self._entry = self._zip_file.open(arcname, 'w', force_zip64=True)
+
+    def write(self, chunk: bytes) -> bytes:
+        self._entry.write(chunk)
+        return self._sink.drain()
+
+    def close_entry(self) -> bytes:
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            entry.close()
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        """
+        :return: the rest of the archive (the end of the current entry and the central directory)
+        """
+        data = self.close_entry()
+        self._zip_file.close()
+        return data + self._sink.drain()
+
+
+def iter_zip(entries, compression: int = zipfile.ZIP_DEFLATED):
+    """
+    Builds a ZIP archive on the fly and yields it piece by piece as it is written,
+    holding only one chunk in memory at a time.
+    :param entries: iterable of (archive name, iterable of bytes chunks)
+    :param compression: compression method of the entries
+    :return: a generator of bytes chunks of the archive
+    """
+    archive = ZipStream(compression)
+    try:
+        for arcname, chunks in entries:
+            try:
+                archive.open_entry(arcname)
+                for chunk in chunks:
+                    data = archive.write(chunk)
+                    if data:
+                        yield data
+                data = archive.close_entry()
+            finally:
+                _close(chunks)
+            if data:
+                yield data
+        yield archive.close()
+    finally:
+        _close(entries)
+
+
+def bundle_errors(failures: list) -> bytes:
+    """
+    :param failures: list of (file reference, reason) pairs
+    :return: the content of the bundle entry listing the files that could not be downloaded
+    """
+    lines = ["The following files could not be downloaded:"]
+    lines.extend(f"{file_ref}: {reason}" for file_ref, reason in failures)
+    return "\n".join(lines).encode() + b"\n"
+
+
+class BundleFiles:
+    """
+    The files of a bundle, opened ahead of time with bounded concurrency and taken in order, independently of
+    how upstream requests are sent (threads in `iter_upstream_files`, the event loop in aio_server.py).
+    Files whose download fails are logged and listed in a last entry named BUNDLE_ERRORS_NAME.
+    """
+
+    def __init__(self, files, open_file, submit, max_workers: int = BUNDLE_WORKERS):
+        """
+        :param files: list of (archive name, file reference) pairs
+        :param open_file: callable opening an upstream response for a file reference
+        :param submit: callable starting open_file(file reference) and returning its future (or task)
+        :param max_workers: maximum number of upstream requests in flight
+        """
+        self._files = iter(files)
+        self._open_file = open_file
+        self._submit = submit
+        self._pending = deque()
+        self.failures = []
+        for _ in range(max_workers):
+            self._submit_next()
+
+    def _submit_next(self):
+        for arcname, file_ref in self._files:
+            self._pending.append((arcname, file_ref, self._submit(self._open_file, file_ref)))
+            return
+
+    def next(self):
+        """
+        Takes the next file and starts opening the one after the files in flight.
+        :return: (archive name, file reference, future of the upstream response), or None after the last file
+        """
+        if not self._pending:
+            return None
+        item = self._pending.popleft()
+        self._submit_next()
+        return item
+
+    def failed(self, file_ref, reason):
+        logger.error(f"Error downloading file for a bundle: {file_ref}: {reason}")
+        self.failures.append((file_ref, reason))
+
+    def errors_entry(self):
+        """
+        :return: the (archive name, chunks) entry listing the files that could not be downloaded, or None
+        """
+        return (BUNDLE_ERRORS_NAME, [bundle_errors(self.failures)]) if self.failures else None
+
+    def close(self, release):
+        """
+        Cancels the requests in flight, releasing with `release` the responses already received.
+        """
+        for _, _, future in self._pending:
+            if not future.cancel() and future.exception() is None:
+                release(future.result())
+
+
+def iter_upstream_files(files, open_file, max_workers: int = BUNDLE_WORKERS):
+    """
+    Opens upstream downloads ahead of time with bounded concurrency and yields their bodies in order.
+    While one body is streamed, the requests for the next max_workers files are already in flight;
+    bodies are read lazily, so memory stays constant regardless of the file sizes.
+    Files whose download fails are logged and listed in a last entry named BUNDLE_ERRORS_NAME.
+    :param files: list of (archive name, file reference) pairs
+    :param open_file: callable opening a streamed upstream response for a file reference
+    :param max_workers: maximum number of upstream requests in flight
+    :return: a generator of (archive name, UpstreamStream) pairs
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bundle = BundleFiles(files, open_file, executor.submit, max_workers)
+        try:
+            for arcname, file_ref, future in iter(bundle.next, None):
+                try:
+                    response = future.result()
+                except Exception as e:
+                    bundle.failed(file_ref, e)
+                    continue
+                if not response.ok:
+                    bundle.failed(file_ref, f"HTTP {response.status_code}")
+                    response.close()
+                    continue
+                yield arcname, UpstreamStream(response)
+        finally:
+            bundle.close(lambda response: response.close())
+
+    errors_entry = bundle.errors_entry()
+    if errors_entry is not None:
+        yield errors_entry
+
+
+def _prepend(first, entries):
+    try:
+        yield first
+        yield from entries
+    finally:
+        _close(entries)
+
+
+def bundle_entries(entries):
+    """
+    Waits for the first file of a bundle, so a bundle none of whose files could be downloaded is reported
+    as an error instead of a ZIP archive holding only the list of failures.
+    :param entries: the generator returned by `iter_upstream_files`
+    :return: the entries to pass to `stream_zip_response`, or None if no file could be downloaded
+    """
+    first = next(entries, None)
+    if nothing_downloaded(first):
+        _close(entries)
+        return None
+    return _prepend(first, entries)
+
+
+def nothing_downloaded(first_entry) -> bool:
+    """
+    :param first_entry: the first entry of a bundle, or None if it has none
+    :return: whether none of the files of the bundle could be downloaded
+    """
+    return first_entry is None or first_entry[0] == BUNDLE_ERRORS_NAME
+
+
+def stream_zip_response(entries, filename: str) -> Response:
+    """
+    :param entries: iterable of (archive name, iterable of bytes chunks)
+    :param filename: name of the downloaded archive
+    :return: a streamed ZIP attachment response
+    """
+    response = Response(iter_zip(entries), mimetype='application/zip', direct_passthrough=True)
+    response.headers.add('Content-Disposition', 'attachment', filename=filename)
+    return response
@@ -0,0 +1,636 @@
+import glob
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+from flask import Response, send_file
+
+from downloads import DOWNLOAD_CHUNK_SIZE, stream_upstream_response, upstream_request_headers
+from logging_config import logger
+from payload_store import CACHE_DIR, STALE_TMP_AGE
+
+try:
+    import fcntl
+except ImportError:
+    # without file locks (Windows), workers sharing the directory may evict more than needed
+    fcntl = None
+
+DOWNLOAD_CACHE_DIR = os.path.join(CACHE_DIR, "downloads")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('METABOLOMICS_DOWNLOAD_CACHE_BYTES', 10 * 1024 ** 3))
+DOWNLOAD_CACHE_MAX_AGE = 3600
+
+# states of a fill
+PENDING, FILLING, DONE, FAILED, ABANDONED = 'pending', 'filling', 'done', 'failed', 'abandoned'
+# actions yielded by `DownloadCache.serve_steps`, and the progress of a client following a fill
+WAIT, FILE, FOLLOW, OPEN, CLOSE, STREAM, FILL, RESPONSE = (
+    'wait', 'file', 'follow', 'open', 'close', 'stream', 'fill', 'response')
+MORE, END = 'more', 'end'
+
+
+class _CachedFile:
+    __slots__ = ('url', 'key', 'path', 'size', 'content_type', 'etag', 'last_modified', 'checked_at')
+
+    def __init__(self, url: str, key: str, path: str, size: int, content_type: str = None, etag: str = None,
+                 last_modified: str = None, checked_at: float = 0.0):
+        self.url = url
+        self.key = key
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+
+    def to_meta(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'path'}
+
+
+class Fill:
+    """
+    A download being written into the cache; readers follow the partial file until it is complete.
+    How readers wait for it to change depends on the caller: threads (`_Fill`) or tasks of the event loop
+    (aio_server.py), woken by `notify`.
+    """
+
+    def __init__(self):
+        self.state = PENDING
+        self.path = None
+        self.written = 0
+        self.content_type = None
+        self.content_length = None
+        # held while the partial file is renamed once complete
+        self.lock = threading.Lock()
+
+    def notify(self, state: str = None):
+        """
+        Wakes the readers after data was written or the state changed. May be called from any thread.
+        :param state: new state of the fill
+        """
+        raise NotImplementedError
+
+    def start(self, headers, path: str):
+        """
+        :param headers: headers of the upstream response
+        :param path: the partial file, see `DownloadCache.create_partial`
+        """
+        self.content_type = headers.get('Content-Type')
+        self.content_length = headers.get('Content-Length')
+        self.path = path
+        self.notify(FILLING)
+
+    def append(self, f, chunk: bytes):
+        """
+        Writes a chunk of the download to the partial file opened by the writer.
+        """
+        f.write(chunk)
+        f.flush()
+        self.written += len(chunk)
+        self.notify()
+
+    def open(self):
+        """
+        :return: the partial (or complete) file opened for reading
+        """
+        with self.lock:
+            return open(self.path, 'rb')
+
+    def progress(self, position: int) -> str:
+        """
+        :param position: number of bytes of the file read by a client
+        :return: MORE if more bytes can be read, WAIT if the client has to wait for the fill, END if it has read
+                 the whole file
+        :raise IOError: if the upstream download failed
+        """
+        if self.state == FAILED:
+            raise IOError("upstream download failed while streaming from the cache")
+        if self.written > position:
+            return MORE
+        return END if self.state == DONE else WAIT
+
+
+class _Fill(Fill):
+    """
+    A fill followed by threads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cond = threading.Condition()
+
+    def notify(self, state: str = None):
+        with self.cond:
+            if state is not None:
+                self.state = state
+            self.cond.notify_all()
+
+
+def next_step(steps, result=None, error: Exception = None):
+    """
+    Resumes the generator returned by `DownloadCache.serve_steps` with the result (or error) of its last action.
+    :return: its next (action, argument), or (RESPONSE, (response, HTTP status code)) once it is done
+    """
+    try:
+        return steps.throw(error) if error is not None else steps.send(result)
+    except StopIteration as stop:
+        return RESPONSE, stop.value
+
+
+class DownloadCache:
+    """
+    On-disk cache of downloaded upstream files with a byte budget and LRU eviction.
+    Bodies are stored under the SHA-256 of the url and its validator (ETag or Last-Modified) and written
+    atomically. Concurrent requests for a file that is being downloaded read the partial file while it
+    fills, so one upstream transfer serves all of them.
+    The budget is shared by the workers using the directory: the size of the directory is known from the last
+    scan plus the files added since, and when a new file takes it over the budget, the index is rebuilt from the
+    directory under a file lock and the least recently used files (the modification time of a body is refreshed
+    when it is served) are evicted. A file evicted by another worker is served as a miss.
+    """
+
+    def __init__(self, directory: str = DOWNLOAD_CACHE_DIR, max_bytes: int = DOWNLOAD_CACHE_MAX_BYTES,
+                 max_age: float = DOWNLOAD_CACHE_MAX_AGE):
+        """
+        :param directory: directory of the cached files
+        :param max_bytes: maximum total size of the cached files in bytes
+        :param max_age: number of seconds a cached file is served without revalidation
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._fills = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.directory, key[:2], key)
+        return f"{base}.body", f"{base}.json"
+
+    @contextmanager
+    def _directory_lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _scan(self) -> list:
+        """
+        :return: the files of the directory, least recently used first
+        """
+        entries = []
+        for meta_path in glob.glob(os.path.join(self.directory, '*', '*.json')):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                entry = _CachedFile(path=self._paths(meta['key'])[0], **meta)
+                used_at = os.path.getmtime(entry.path)
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            entries.append((used_at, entry))
+        entries.sort(key=lambda item: item[0])
+        return [entry for _, entry in entries]
+
+    def _sync(self):
+        """
+        Rebuilds the index from the directory shared with the other workers and evicts the least recently
+        used files until they fit in the budget.
+        """
+        with self._directory_lock():
+            entries = OrderedDict()
+            total = 0
+            for entry in self._scan():
+                old_entry = entries.pop(entry.url, None)
+                if old_entry is not None:
+                    # an older version of the file
+                    total -= old_entry.size
+                    self._remove_files(old_entry)
+                entries[entry.url] = entry
+                total += entry.size
+            evicted_keys = set()
+            while total > self.max_bytes and entries:
+                _, evicted = entries.popitem(last=False)
+                total -= evicted.size
+                self._remove_files(evicted)
+                evicted_keys.add(evicted.key)
+        with self._lock:
+            # files added by other threads of this process since the scan
+            for url, entry in self._entries.items():
+                if url not in entries and entry.key not in evicted_keys and os.path.exists(entry.path):
+                    entries[url] = entry
+                    total += entry.size
+            self._entries = entries
+            self._bytes = total
+            self.evictions += len(evicted_keys)
+
+    def _load(self):
+        self._sync()
+        # partial files of other workers are being written; only those of crashed workers are removed
+        now = time.time()
+        for tmp_path in glob.glob(os.path.join(self.directory, '*', '*.tmp')):
+            try:
+                if now - os.path.getmtime(tmp_path) > STALE_TMP_AGE:
+                    os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _remove_files(self, entry: _CachedFile):
+        for path in self._paths(entry.key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _index(self, entry: _CachedFile):
+        with self._lock:
+            old_entry = self._entries.pop(entry.url, None)
+            if old_entry is not None:
+                self._bytes -= old_entry.size
+            self._entries[entry.url] = entry
+            self._bytes += entry.size
+
+    def _evict(self):
+        """
+        Evicts files once the cache is over its budget; the directory is only scanned then.
+        """
+        with self._lock:
+            if self._bytes <= self.max_bytes:
+                return
+        self._sync()
+
+    def _drop(self, entry: _CachedFile):
+        """
+        Forgets a cached file removed from the directory by another worker.
+        """
+        with self._lock:
+            if self._entries.get(entry.url) is entry:
+                del self._entries[entry.url]
+                self._bytes -= entry.size
+
+    def record(self, hit: bool):
+        """
+        Counts a request served from the cache (or from a fill) or from the upstream.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def touch(self, entry: _CachedFile) -> bool:
+        """
+        Marks a cached file as used, for the eviction order shared by the workers.
+        :return: False if the file has been evicted by another worker (it is then forgotten)
+        """
+        try:
+            os.utime(entry.path)
+        except OSError:
+            self._drop(entry)
+            return False
+        return True
+
+    def _write_meta(self, entry: _CachedFile):
+        meta_path = self._paths(entry.key)[1]
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(meta_path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry.to_meta(), f)
+        os.replace(tmp_path, meta_path)
+
+    def _file_response(self, entry: _CachedFile, filename: str):
+        """
+        :return: the response sending a cached file, or None if it has been evicted by another worker
+        """
+        # conditional=True lets Werkzeug answer Range requests; the file itself is sent with
+        # wsgi.file_wrapper, which servers implement with sendfile()
+        try:
+            return send_file(
+                entry.path,
+                mimetype=entry.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                as_attachment=True,
+                attachment_filename=filename,
+                conditional=True
+            )
+        except FileNotFoundError:
+            self._drop(entry)
+            return None
+
+    def _iter_fill(self, fill: _Fill, f):
+        try:
+            while True:
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                with fill.cond:
+                    progress = fill.progress(f.tell())
+                    while progress == WAIT:
+                        fill.cond.wait()
+                        progress = fill.progress(f.tell())
+                if progress == END:
+                    return
+        finally:
+            f.close()
+
+    def _fill_response(self, fill: _Fill, filename: str) -> Response:
+        f = fill.open()
+        content_type = fill.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = Response(self._iter_fill(fill, f), content_type=content_type, direct_passthrough=True)
+        if fill.content_length is not None:
+            response.headers['Content-Length'] = fill.content_length
+        response.headers.add('Content-Disposition', 'attachment', filename=filename)
+        return response
+
+    def _new_entry(self, url: str, headers, size: int) -> _CachedFile:
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        key = hashlib.sha256(f"{url}\n{etag or last_modified or ''}".encode()).hexdigest()
+        return _CachedFile(url=url, key=key, path=self._paths(key)[0], size=size,
+                           content_type=headers.get('Content-Type'), etag=etag, last_modified=last_modified,
+                           checked_at=time.time())
+
+    def _store(self, partial_path: str, entry: _CachedFile):
+        os.makedirs(os.path.dirname(entry.path), exist_ok=True)
+        os.replace(partial_path, entry.path)
+        self._write_meta(entry)
+
+    def _run_fill(self, url: str, fill: _Fill, response, f):
+        try:
+            with f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        fill.append(f, chunk)
+            self.complete_fill(url, fill, self._fills, response.headers)
+        except Exception as e:
+            self.fail_fill(url, fill, self._fills, e)
+        finally:
+            response.close()
+
+    def complete_fill(self, url: str, fill: Fill, fills: dict, headers):
+        """
+        Adds the completely written file of a fill to the cache.
+        :param url: url identifying the upstream file
+        :param fill: the fill
+        :param fills: the fills of the caller, see `serve_steps`
+        :param headers: headers of the upstream response (Content-Type and the validators are kept)
+        """
+        entry = self._new_entry(url, headers, fill.written)
+        with fill.lock:
+            self._store(fill.path, entry)
+            # indexed before the fill ends, so a request always finds one of them
+            self._index(entry)
+            fill.path = entry.path
+        fill.notify(DONE)
+        self._end_fill(url, fills)
+        self._evict()
+
+    def fail_fill(self, url: str, fill: Fill, fills: dict, error: Exception):
+        """
+        Ends a fill whose upstream download (or storage) failed; its readers get an error.
+        """
+        logger.error(f"Error caching download {url}: {error!r}")
+        self._end_fill(url, fills)
+        if fill.state == DONE:
+            # the file is cached, only the eviction failed
+            return
+        fill.notify(FAILED)
+        with fill.lock:
+            if fill.path is not None and os.path.exists(fill.path):
+                os.remove(fill.path)
+
+    def _end_fill(self, url: str, fills: dict):
+        with self._lock:
+            fills.pop(url, None)
+
+    def create_partial(self):
+        """
+        :return: the path of a new temporary file for a download being cached, and the file opened for writing
+        """
+        os.makedirs(os.path.join(self.directory, 'tmp'), exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'), suffix='.tmp')
+        return path, os.fdopen(fd, 'wb')
+
+    def commit(self, url: str, partial_path: str, size: int, headers):
+        """
+        Adds a completely downloaded file to the cache.
+        :param url: url identifying the upstream file
+        :param partial_path: the file written, see `create_partial`
+        :param size: size of the file in bytes
+        :param headers: headers of the upstream response (Content-Type and the validators are kept)
+        :return: the cached file
+        """
+        entry = self._new_entry(url, headers, size)
+        self._store(partial_path, entry)
+        self._index(entry)
+        self._evict()
+        return entry
+
+    def lookup(self, url: str):
+        """
+        :param url: url identifying the upstream file
+        :return: the cached file (or None) and whether it can be served without revalidation
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+        return entry, entry is not None and time.time() - entry.checked_at < self.max_age
+
+    def revalidated(self, entry: _CachedFile):
+        """
+        Marks a cached file as fresh again after the upstream confirmed it is unchanged.
+        """
+        entry.checked_at = time.time()
+        self._write_meta(entry)
+
+    def abandon(self, url: str, fill: Fill, fills: dict):
+        """
+        Ends a fill that is not started (the file is served another way); its readers look up the cache again.
+        """
+        self._end_fill(url, fills)
+        fill.notify(ABANDONED)
+
+    def _file_steps(self, entry: _CachedFile):
+        response = (yield FILE, entry) if self.touch(entry) else None
+        if response is None:
+            self._drop(entry)
+        return response
+
+    def serve_steps(self, url: str, request_headers, fills: dict, new_fill):
+        """
+        Describes how a download is served from the cache independently of how the caller waits, sends upstream
+        requests and builds responses (threads in `serve`, the event loop in aio_server.py). Resume it with
+        `next_step`: it yields (action, argument) pairs and is sent back their results:
+        - (WAIT, fill): nothing, once the fill is no longer PENDING;
+        - (FILE, cached file): the response sending the file, or None if it does not exist anymore;
+        - (FOLLOW, fill): the response following the fill;
+        - (OPEN, request headers): (upstream response, HTTP status code), or a RequestException thrown in;
+        - (CLOSE, upstream response): nothing, once the upstream response is released;
+        - (STREAM, upstream response): the response passing the upstream response through;
+        - (FILL, (fill, upstream response, partial file)): the response following the fill, once a writer that
+          appends the upstream body to the partial file and calls `complete_fill` or `fail_fill` is started.
+        Decisions that read or write the disk are taken in the generator, so an event loop resumes it in a thread.
+        :param url: url identifying the upstream file
+        :param request_headers: headers of the current client request
+        :param fills: the fills of the caller {url: fill}, only read and written under the lock of the cache
+        :param new_fill: callable creating a fill followed by the caller
+        :return: (via StopIteration) the response (or None if the upstream failed) and the HTTP status code
+        """
+        partial = 'Range' in request_headers
+
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            fresh = entry is not None and time.time() - entry.checked_at < self.max_age
+            fill = fills.get(url)
+            leader = fill is None and not fresh
+            if leader and not (partial and entry is None):
+                fill = fills[url] = new_fill()
+            else:
+                leader = False
+
+        if fill is not None and not leader and not partial:
+            yield WAIT, fill
+            if fill.state in (FILLING, DONE):
+                self.record(hit=True)
+                return (yield FOLLOW, fill), 200
+            fill = None
+            with self._lock:
+                entry = self._entries.get(url)
+
+        if entry is not None and (not leader or fresh):
+            response = yield from self._file_steps(entry)
+            if response is None:
+                # evicted by another worker: the entry is forgotten, so it is downloaded again
+                return (yield from self.serve_steps(url, request_headers, fills, new_fill))
+            self.record(hit=True)
+            return response, 200
+
+        self.record(hit=False)
+        if not leader:
+            # partial download of a file that is not cached: forward the Range request
+            upstream, status = yield OPEN, upstream_request_headers(request_headers)
+            if status >= 400:
+                yield CLOSE, upstream
+                return None, status
+            return (yield STREAM, upstream), status
+
+        headers = {'Accept-Encoding': 'identity'}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            upstream, status = yield OPEN, headers
+        except requests.exceptions.RequestException:
+            self.abandon(url, fill, fills)
+            stale_response = (yield from self._file_steps(entry)) if entry is not None else None
+            if stale_response is None:
+                raise
+            logger.error(f"Connection error occurred, serving stale cached file for {url}")
+            return stale_response, 200
+        except GeneratorExit:
+            # the caller gave up (e.g. its client disconnected)
+            self.abandon(url, fill, fills)
+            raise
+
+        if status == 304 and entry is not None:
+            yield CLOSE, upstream
+            self.abandon(url, fill, fills)
+            file_response = yield from self._file_steps(entry)
+            if file_response is None:
+                return (yield from self.serve_steps(url, request_headers, fills, new_fill))
+            self.revalidated(entry)
+            return file_response, 200
+
+        if status >= 400:
+            yield CLOSE, upstream
+            self.abandon(url, fill, fills)
+            stale_response = None
+            if entry is not None and status >= 500:
+                stale_response = yield from self._file_steps(entry)
+            if stale_response is None:
+                return None, status
+            logger.error(f"Upstream error {status}, serving stale cached file for {url}")
+            return stale_response, 200
+
+        content_length = upstream.headers.get('Content-Length')
+        if content_length is not None and int(content_length) > self.max_bytes:
+            self.abandon(url, fill, fills)
+            return (yield STREAM, upstream), status
+
+        path, f = self.create_partial()
+        fill.start(upstream.headers, path)
+        return (yield FILL, (fill, upstream, f)), 200
+
+    def serve(self, url: str, filename: str, open_upstream, request_headers):
+        """
+        Serves a download from the cache, filling the cache from the upstream on a miss.
+        :param url: url identifying the upstream file
+        :param filename: name of the downloaded file
+        :param open_upstream: callable taking request headers and returning a streamed upstream response
+        :param request_headers: headers of the current client request
+        :return: a Flask response (or None if the upstream failed) and the HTTP status code
+        """
+        steps = self.serve_steps(url, request_headers, self._fills, _Fill)
+        result, error = None, None
+        try:
+            while True:
+                action, argument = next_step(steps, result, error)
+                result, error = None, None
+                if action == RESPONSE:
+                    return argument
+                if action == WAIT:
+                    with argument.cond:
+                        while argument.state == PENDING:
+                            argument.cond.wait()
+                elif action == FILE:
+                    result = self._file_response(argument, filename)
+                elif action == FOLLOW:
+                    result = self._fill_response(argument, filename)
+                elif action == OPEN:
+                    try:
+                        response = open_upstream(argument)
+                    except requests.exceptions.RequestException as e:
+                        error = e
+                    else:
+                        result = response, response.status_code
+                elif action == CLOSE:
+                    argument.close()
+                elif action == STREAM:
+                    result = stream_upstream_response(argument, filename=filename)
+                elif action == FILL:
+                    fill, response, f = argument
+                    threading.Thread(target=self._run_fill, args=(url, fill, response, f), daemon=True).start()
+                    result = self._fill_response(fill, filename)
+        finally:
+            steps.close()
+
+    def stats(self) -> dict:
+        """
+        :return: a dictionary with hit/miss/eviction counters and the current size of the cache
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+download_cache = DownloadCache()
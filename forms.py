@@ -1,6 +1,24 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, SelectField, PasswordField
-from wtforms.validators import DataRequired, Email
+from wtforms import StringField, SubmitField, PasswordField
+from wtforms.validators import DataRequired, Email, ValidationError
+
+from study_index import StudyIndex
+
+
+class StudyIdField(StringField):
+    """
+    Text field for a study id validated against a StudyIndex (an O(1) membership check)
+    instead of a list of choices rendered into the page.
+    The id is not checked while the index is empty (the study list has not been loaded yet).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = StudyIndex()
+
+    def pre_validate(self, form):
+        if self.data and len(self.index) and self.data not in self.index:
+            raise ValidationError('Unknown study id')
 
 
 class MetabolightsLoginForm(FlaskForm):
@@ -9,22 +27,19 @@ class MetabolightsLoginForm(FlaskForm):
     submit = SubmitField('Login')
 
 class MetabolightsForm(FlaskForm):
-    study = SelectField('Study',
-                        validators=[DataRequired()],
-                        choices=[],
-                        render_kw={'rows': 1, 'cols': 5})
+    study = StudyIdField('Study',
+                         validators=[DataRequired()],
+                         render_kw={'autocomplete': 'off', 'list': 'metabolights-options'})
     submit = SubmitField('Get study info')
 
 class MetabolomicsWorkbenchForm(FlaskForm):
-    study = SelectField('Study',
-                        validators=[DataRequired()],
-                        choices=[],
-                        render_kw={'rows': 1, 'cols': 5})
+    study = StudyIdField('Study',
+                         validators=[DataRequired()],
+                         render_kw={'autocomplete': 'off', 'list': 'workbench-options'})
     submit = SubmitField('Get study info')
 
 class MetabobankForm(FlaskForm):
-    study = SelectField('Study',
-                        validators=[DataRequired()],
-                        choices=[],
-                        render_kw={'rows': 1, 'cols': 5})
+    study = StudyIdField('Study',
+                         validators=[DataRequired()],
+                         render_kw={'autocomplete': 'off', 'list': 'metabobank-options'})
     submit = SubmitField('Get study info')
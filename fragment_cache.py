@@ -0,0 +1,91 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from cache import LRUCache
+
+FRAGMENT_CACHE_MAX_ENTRIES = 512
+FRAGMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FRAGMENT_CACHE_TTL = 3600
+# fragments with per-user content (MetaboLights result files) are re-rendered more often
+FRAGMENT_CACHE_AUTH_TTL = 300
+
+
+def auth_digest(api_token: str = None) -> str:
+    """
+    :param api_token: the API token of the session, or None for anonymous requests
+    :return: a digest identifying the token in cache keys (the token itself is never stored), or '' if anonymous
+    """
+    return hashlib.sha256(api_token.encode()).hexdigest()[:16] if api_token else ''
+
+
+class FragmentCache:
+    """
+    LRU cache of rendered study pages and of their heavy fragments (section items).
+    Keys are made of the source, the study id, the version of the parsed study and a digest of the API token,
+    so per-user fragments are never served to another session. When a study is seen with a new version,
+    all fragments of its previous version are dropped.
+    """
+
+    def __init__(self, max_entries: int = FRAGMENT_CACHE_MAX_ENTRIES, max_bytes: int = FRAGMENT_CACHE_MAX_BYTES,
+                 ttl: float = FRAGMENT_CACHE_TTL, auth_ttl: float = FRAGMENT_CACHE_AUTH_TTL):
+        self.ttl = ttl
+        self.auth_ttl = auth_ttl
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        # the last seen version of each study, bounded like the cache itself
+        self._versions = OrderedDict()
+        self._max_versions = max_entries * 4
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _study_prefix(source: str, study_id: str) -> str:
+        return f"{source}:{study_id}:"
+
+    def _track_version(self, source: str, study_id: str, version: str):
+        key = (source, study_id)
+        with self._lock:
+            previous = self._versions.get(key)
+            self._versions[key] = version
+            self._versions.move_to_end(key)
+            while len(self._versions) > self._max_versions:
+                self._versions.popitem(last=False)
+        if previous is not None and previous != version:
+            self.invalidate(source, study_id)
+
+    def get_or_render(self, source: str, study_id: str, version: str, name: str, render, api_token: str = None,
+                      cacheable=None):
+        """
+        :param source: 'metabolights', 'workbench' or 'metabobank'
+        :param study_id: current study id
+        :param version: version of the parsed study the fragment is rendered from
+        :param name: name of the fragment including its parameters, e.g. 'page:rows'
+        :param render: callable without arguments producing the fragment
+        :param api_token: the API token of the session if the fragment depends on it
+        :param cacheable: predicate on the rendered fragment; fragments for which it is false
+                          (e.g. rendered after a failed upstream call) are not kept
+        :return: the cached or freshly rendered fragment
+        """
+        self._track_version(source, study_id, version)
+        digest = auth_digest(api_token)
+        key = f"{self._study_prefix(source, study_id)}{version}:{digest}:{name}"
+        is_negative = (lambda fragment: not cacheable(fragment)) if cacheable is not None else None
+        return self._cache.get_or_load(key, render, ttl=self.auth_ttl if digest else self.ttl,
+                                       negative_ttl=0, is_negative=is_negative)
+
+    def invalidate(self, source: str, study_id: str) -> int:
+        """
+        Drops all cached fragments of a study.
+        :return: the number of dropped fragments
+        """
+        return self._cache.delete_prefix(self._study_prefix(source, study_id))
+
+    def clear(self):
+        self._cache.clear()
+        with self._lock:
+            self._versions.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+fragment_cache = FragmentCache()
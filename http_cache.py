@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import os
+
+from flask import Response, make_response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript', 'application/json',
+}
+# the encodings offered to clients, preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _release_version(base_dir: str) -> str:
+    """
+    Identifies the deployed modules, templates and static files, so a new release changes the ETags of all pages.
+    Only names and modification times are read, which are the same in all workers of a release.
+    """
+    paths = [os.path.join(base_dir, name) for name in os.listdir(base_dir) if name.endswith('.py')]
+    for directory in ('templates', 'static'):
+        for root, _, files in os.walk(os.path.join(base_dir, directory)):
+            paths.extend(os.path.join(root, name) for name in files)
+
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(f"{os.path.relpath(path, base_dir)}|{os.path.getmtime(path)}".encode())
+    return digest.hexdigest()[:8]
+
+
+RELEASE = _release_version(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_etag(*parts) -> str:
+    """
+    Builds a strong ETag from the versions a response is derived from (payload versions, list versions,
+    query parameters), so it can be checked before the response is rendered.
+    :param parts: values identifying the content of the response
+    :return: the ETag value (without quotes)
+    """
+    key = '|'.join(str(part) for part in (RELEASE,) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def not_modified(etag: str):
+    """
+    :param etag: the ETag of the response that would be sent
+    :return: a 304 response if the client already holds this representation (in any content coding), otherwise None
+    """
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return None
+    if if_none_match.contains(etag) or any(if_none_match.contains(f"{etag}-{encoding}") for encoding in ENCODINGS):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(rv, etag: str):
+    """
+    :param rv: the return value of a view for a successful request
+    :param etag: its ETag
+    :return: the response with the ETag set
+    """
+    response = make_response(rv)
+    response.set_etag(etag)
+    return response
+
+
+def conditional_response(etag: str, render):
+    """
+    Answers a conditional request with a 304 without rendering anything, or renders the response and sets its ETag.
+    :param etag: the ETag of the response, see `make_etag`
+    :param render: callable without arguments returning the view result
+    :return: the response
+    """
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    return with_etag(render(), etag)
+
+
+def _negotiate_encoding():
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_response(response):
+    """
+    Compresses a buffered text response with brotli (if installed) or gzip, as negotiated with Accept-Encoding.
+    Streamed and file responses (downloads, NDJSON) are passed through unchanged.
+    The content coding is appended to a strong ETag, which `not_modified` accepts.
+    :param response: the response of a view
+    :return: the (possibly compressed) response
+    """
+    if (response.status_code < 200 or response.status_code in (204, 206, 304) or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
@@ -0,0 +1,197 @@
+import codecs
+import json
+import re
+
+ANY = '*'
+JSON_CHUNK_SIZE = 256 * 1024
+
+_WS_RE = re.compile(r'[ \t\n\r]*')
+# everything up to the next bracket, consuming complete strings (which may contain brackets) as a whole
+_SKIP_RE = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR_RE = re.compile(r'[^,\]}\s]+')
+_decoder = json.JSONDecoder()
+
+
+class _IncompleteJSON(ValueError):
+    pass
+
+
+def _matches(path: tuple, pattern: tuple) -> bool:
+    return len(path) == len(pattern) and all(p == ANY or p == k for k, p in zip(path, pattern))
+
+
+def _is_prefix(path: tuple, pattern: tuple) -> bool:
+    return len(path) < len(pattern) and all(p == ANY or p == k for k, p in zip(path, pattern))
+
+
+class _StreamParser:
+    """
+    Walks a JSON document read chunk by chunk, descending only into containers that lead to a selected path.
+    Selected values are decoded with the C decoder; everything else is skipped with regular expressions
+    without creating objects, so memory is bounded by the largest selected value plus one chunk.
+    """
+
+    def __init__(self, chunks, patterns):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.patterns = [tuple(pattern) for pattern in patterns]
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, min_chars: int = 1) -> bool:
+        """
+        Reads until at least min_chars more characters are buffered or the document ends,
+        dropping what has already been consumed.
+        :return: False if nothing was left to read
+        """
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        available = len(self.buf)
+        target = available + min_chars
+        while len(self.buf) < target and not self.eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.eof = True
+                self.buf += self._utf8.decode(b'', final=True)
+            else:
+                self.buf += self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return len(self.buf) > available
+
+    def _peek(self) -> str:
+        while True:
+            self.pos = _WS_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise _IncompleteJSON("unexpected end of JSON document")
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"expected one of {chars!r} at {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def _buffer_scalar(self):
+        """
+        Makes sure the number or literal at the current position is completely buffered.
+        :return: the end of the scalar in the buffer
+        """
+        while True:
+            match = _SCALAR_RE.match(self.buf, self.pos)
+            if match and match.end() < len(self.buf):
+                return match.end()
+            if not self._fill():
+                if match:
+                    return match.end()
+                raise _IncompleteJSON("unexpected end of JSON document")
+
+    def _decode(self):
+        if self._peek() not in '{["':
+            self._buffer_scalar()
+        while True:
+            try:
+                value, self.pos = _decoder.raw_decode(self.buf, self.pos)
+                return value
+            except json.JSONDecodeError:
+                # the value is not complete yet: at least double the unread part of the buffer
+                if not self._fill(max(len(self.buf) - self.pos, JSON_CHUNK_SIZE)):
+                    raise
+
+    def _skip_string(self) -> str:
+        """
+        :return: the raw (still escaped and quoted) string
+        """
+        while True:
+            match = _STRING_RE.match(self.buf, self.pos)
+            if match:
+                self.pos = match.end()
+                return match.group()
+            if not self._fill(JSON_CHUNK_SIZE):
+                raise _IncompleteJSON("unterminated string")
+
+    def _skip(self):
+        char = self._peek()
+        if char == '"':
+            self._skip_string()
+        elif char in '[{':
+            depth = 0
+            while True:
+                self.pos = _SKIP_RE.match(self.buf, self.pos).end()
+                if self.pos >= len(self.buf):
+                    if not self._fill(JSON_CHUNK_SIZE):
+                        raise _IncompleteJSON("unterminated container")
+                    continue
+                char = self.buf[self.pos]
+                if char == '"':
+                    # a string crossing the end of the buffer
+                    self._skip_string()
+                    continue
+                self.pos += 1
+                depth += 1 if char in '[{' else -1
+                if depth == 0:
+                    return
+        else:
+            self.pos = self._buffer_scalar()
+
+    def _read_key(self) -> str:
+        return json.loads(self._skip_string())
+
+    def values(self, path: tuple = ()):
+        if any(_matches(path, pattern) for pattern in self.patterns):
+            yield path, self._decode()
+            return
+        if not any(_is_prefix(path, pattern) for pattern in self.patterns):
+            self._skip()
+            return
+
+        char = self._peek()
+        if char == '{':
+            self.pos += 1
+            if self._peek() == '}':
+                self.pos += 1
+                return
+            while True:
+                self._peek()
+                key = self._read_key()
+                self._expect(':')
+                yield from self.values(path + (key,))
+                if self._expect(',}') == '}':
+                    return
+        elif char == '[':
+            self.pos += 1
+            if self._peek() == ']':
+                self.pos += 1
+                return
+            index = 0
+            while True:
+                yield from self.values(path + (index,))
+                index += 1
+                if self._expect(',]') == ']':
+                    return
+        else:
+            # a scalar where a container was expected: nothing below it can match
+            self._skip()
+
+
+def iter_values(chunks, patterns):
+    """
+    Incrementally parses a JSON document and yields only the values at the selected paths.
+    A path is a tuple of object keys and array indexes; ANY in a pattern matches any key or index,
+    e.g. ('content', 'assays', ANY, 'assayNumber').
+    :param chunks: iterable of bytes (UTF-8) or str chunks of the document
+    :param patterns: iterable of path patterns
+    :return: a generator of (path, value) pairs in document order
+    """
+    return _StreamParser(chunks, patterns).values()
+
+
+def iter_file_chunks(f, chunk_size: int = JSON_CHUNK_SIZE):
+    """
+    :param f: a file opened in binary mode
+    :return: a generator of chunks of the file
+    """
+    return iter(lambda: f.read(chunk_size), b'')
@@ -0,0 +1,205 @@
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from functools import lru_cache
+
+from catalog import get_catalog
+from logging_config import logger
+
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+MIN_QUERY_LENGTH = 2
+# seconds between two scans of the catalog for studies mirrored or refreshed by a sync
+CATALOG_SCAN_INTERVAL = 60
+
+_TOKEN_RE = re.compile(r'[^\W_]+')
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalizes a metabolite name for matching: case, accents, punctuation and spacing are ignored,
+    e.g. 'L-Glutamic acid', 'l glutamic-acid' and 'L-Glutamic Acid ' are all 'l glutamic acid'.
+    :param name: a reported metabolite or RefMet name
+    :return: the lowercase words of the name separated by single spaces
+    """
+    name = str(name).casefold()
+    if not name.isascii():
+        decomposed = unicodedata.normalize('NFKD', name)
+        name = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(_TOKEN_RE.findall(name))
+
+
+def study_metabolite_names(source: str, data: dict) -> set:
+    """
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param data: a parsed study in the form used by its page
+    :return: the reported metabolite names (and RefMet names for Workbench studies) of the study
+    """
+    names = set()
+    for assay_el in data.get('assays') or []:
+        for details in assay_el.values():
+            if source == 'metabolights':
+                names.update(details.get('reported_metabolite_names') or [])
+            elif source == 'workbench':
+                metadata = details.get('metadata') or {}
+                names.update(metadata.get(key) for key in ('reported_metabolite_name', 'refmet_name'))
+    return {name for name in names if isinstance(name, str) and name.strip()}
+
+
+class MetaboliteIndex:
+    """
+    Inverted index from normalized metabolite names to the studies reporting them, across all sources.
+    Postings only hold the studies; the names matching a query are looked up for the studies of a result page.
+    Every name is indexed under its full normalized form and under each of its word suffixes,
+    so 'glucose' finds 'D-Glucose' and 'gluc' finds both by prefix.
+    Studies are (re)indexed one at a time whenever their parsed details change.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._keys = []
+        self._studies = {}
+        self._lock = threading.RLock()
+        self.version = 0
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def _index_keys(name: str) -> frozenset:
+        # the same names are reported by many studies
+        tokens = normalize_name(name).split(' ')
+        return frozenset(' '.join(tokens[i:]) for i in range(len(tokens)) if tokens[i])
+
+    def update_study(self, source: str, study_id: str, version: str, names) -> bool:
+        """
+        Replaces the indexed names of a study.
+        :param version: version of the parsed study; an already indexed version is skipped
+        :param names: the metabolite names of the study
+        :return: True if the index changed
+        """
+        study = (source, study_id)
+        with self._lock:
+            indexed = self._studies.get(study)
+            if indexed is not None and indexed[0] == version:
+                return False
+            if indexed is not None:
+                self._remove(study, indexed[1])
+            names = frozenset(names)
+            self._studies[study] = (version, names)
+            keys = set()
+            for name in names:
+                keys.update(self._index_keys(name))
+            for key in keys:
+                posting = self._postings.get(key)
+                if posting is None:
+                    posting = self._postings[key] = set()
+                    insort(self._keys, key)
+                posting.add(study)
+            self.version += 1
+            return True
+
+    def _remove(self, study, names):
+        keys = set()
+        for name in names:
+            keys.update(self._index_keys(name))
+        for key in keys:
+            posting = self._postings.get(key)
+            if posting is None:
+                continue
+            posting.discard(study)
+            if not posting:
+                del self._postings[key]
+                del self._keys[bisect_left(self._keys, key)]
+
+    def indexed_version(self, source: str, study_id: str):
+        """
+        :return: the version of a study in the index, or None if it is not indexed
+        """
+        indexed = self._studies.get((source, study_id))
+        return indexed[0] if indexed is not None else None
+
+    def remove_study(self, source: str, study_id: str):
+        with self._lock:
+            indexed = self._studies.pop((source, study_id), None)
+            if indexed is not None:
+                self._remove((source, study_id), indexed[1])
+                self.version += 1
+
+    def search(self, query: str, source: str = None, limit: int = SEARCH_LIMIT, cursor: str = None):
+        """
+        :param query: beginning of a metabolite name or of one of its words (normalized like the names)
+        :param source: only return studies of this source if given
+        :param limit: maximum number of returned studies
+        :param cursor: the 'next_cursor' of the previous page
+        :return: a page of hits {'source', 'study_id', 'names'} sorted by source and study id,
+                 the cursor of the next page (or None) and the total number of matching studies
+        """
+        key = normalize_name(query)
+        if len(key) < MIN_QUERY_LENGTH:
+            return [], None, 0
+
+        hits = set()
+        with self._lock:
+            start = bisect_left(self._keys, key)
+            end = bisect_left(self._keys, key + '\uffff')
+            for index_key in self._keys[start:end]:
+                hits.update(self._postings[index_key])
+            if source is not None:
+                hits = {study for study in hits if study[0] == source}
+
+            studies = sorted(hits)
+            offset = int(cursor) if cursor and cursor.isdigit() else 0
+            # the matching names are only collected for the studies of the page
+            page = [{'source': study[0], 'study_id': study[1], 'names': self._matching_names(study, key)}
+                    for study in studies[offset:offset + limit]]
+        next_cursor = str(offset + limit) if offset + limit < len(studies) else None
+        return page, next_cursor, len(studies)
+
+    def _matching_names(self, study, key: str) -> list:
+        names = self._studies[study][1]
+        return sorted(name for name in names
+                      if any(index_key.startswith(key) for index_key in self._index_keys(name)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'studies': len(self._studies), 'keys': len(self._keys)}
+
+
+metabolite_index = MetaboliteIndex()
+_catalog_scan = {'synced_since': 0.0, 'scanned_at': 0.0}
+_catalog_scan_lock = threading.Lock()
+
+
+def index_study(source: str, study_id: str, version: str, data: dict):
+    """
+    (Re)indexes the metabolite names of a study that was just parsed or read from the catalog.
+    """
+    metabolite_index.update_study(source, study_id, version, study_metabolite_names(source, data))
+
+
+def refresh_from_catalog(max_age: float = CATALOG_SCAN_INTERVAL) -> int:
+    """
+    Indexes the studies mirrored or refreshed in the catalog since the last scan, at most once per `max_age`
+    seconds. A scan already running in another thread is not waited for.
+    :return: the number of studies (re)indexed
+    """
+    catalog = get_catalog()
+    if catalog is None or time.time() - _catalog_scan['scanned_at'] < max_age:
+        return 0
+    if not _catalog_scan_lock.acquire(blocking=False):
+        return 0
+    try:
+        started = time.time()
+        count = 0
+        for source, study_id, version, load in catalog.iter_synced_since(_catalog_scan['synced_since']):
+            # studies checked by a sync without changes are not decoded again
+            if metabolite_index.indexed_version(source, study_id) != version:
+                index_study(source, study_id, version, load())
+                count += 1
+        _catalog_scan.update(synced_since=started, scanned_at=time.time())
+        if count:
+            logger.info(f"Indexed the metabolites of {count} studies from the catalog")
+        return count
+    finally:
+        _catalog_scan_lock.release()
@@ -0,0 +1,233 @@
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing value per combination of label values.
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.label_names), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Counts observations (e.g. latencies in seconds) in cumulative buckets per combination of label values.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(str(labels[name]) for name in self.label_names))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}"
+
+
+class CallbackMetric:
+    """
+    A metric whose values are read from a callable when the metrics are scraped,
+    e.g. the counters a cache keeps anyway.
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str, label_names, read):
+        """
+        :param read: callable returning a list of (label values, value) pairs
+        """
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.label_names = tuple(label_names)
+        self.read = read
+
+    def samples(self):
+        for key, value in self.read():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Registry:
+    """
+    The metrics of the service, rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names=()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    'metabolomics_request_duration_seconds', 'Time to produce the response of a route',
+    ('route', 'method'))
+REQUESTS = registry.counter(
+    'metabolomics_requests_total', 'Responses by route and status code',
+    ('route', 'method', 'status'))
+UPSTREAM_LATENCY = registry.histogram(
+    'metabolomics_upstream_request_duration_seconds', 'Time until the response headers of an upstream call',
+    ('host',))
+UPSTREAM_RESPONSES = registry.counter(
+    'metabolomics_upstream_responses_total',
+    "Upstream calls by host and status code ('error' for connection errors and timeouts, "
+    "'circuit_open' for calls refused by the circuit breaker)",
+    ('host', 'status'))
+# per crawl rather than per study id: study ids come from the request path, so they would be unbounded label values
+METABOBANK_CRAWL_REQUESTS = registry.counter(
+    'metabolomics_metabobank_crawl_requests_total', 'Directory listings requested by the Metabobank crawler')
+METABOBANK_CRAWL_LISTINGS = registry.histogram(
+    'metabolomics_metabobank_crawl_listings', 'Directory listings requested per crawl of a Metabobank study',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+DOWNLOAD_BYTES = registry.counter(
+    'metabolomics_download_bytes_total', 'Bytes streamed to clients by the download routes',
+    ('route',))
+
+
+_caches = {}
+CACHE_FIELDS = (
+    ('hits', 'counter', 'Cache hits'),
+    ('misses', 'counter', 'Cache misses'),
+    ('evictions', 'counter', 'Entries evicted to respect the size limits'),
+    ('expirations', 'counter', 'Entries dropped after their TTL'),
+    ('coalesced', 'counter', 'Concurrent misses that waited for a load already in progress'),
+    ('entries', 'gauge', 'Entries in the cache'),
+    ('bytes', 'gauge', 'Estimated size of the cache in bytes'),
+)
+
+
+def _read_cache_field(field: str):
+    def read():
+        samples = []
+        for cache_name, stats in sorted(_caches.items()):
+            values = stats()
+            if field in values:
+                samples.append(((cache_name,), values[field]))
+        return samples
+    return read
+
+
+for _field, _metric_type, _documentation in CACHE_FIELDS:
+    registry.register(CallbackMetric(
+        f"metabolomics_cache_{_field}" + ('_total' if _metric_type == 'counter' else ''),
+        _documentation, _metric_type, ('cache',), _read_cache_field(_field)))
+
+
+def register_cache(cache_name: str, stats):
+    """
+    Exposes the counters of a cache (hits, misses, evictions and, if available, expirations and coalesced loads)
+    and its current size, read when the metrics are scraped.
+    :param cache_name: value of the 'cache' label
+    :param stats: callable returning the statistics dictionary of the cache
+    """
+    _caches[cache_name] = stats
+
+
+class CountingIterable:
+    """
+    Wraps the body of a streamed response and counts the bytes sent to the client.
+    """
+
+    def __init__(self, iterable, on_bytes):
+        """
+        :param iterable: the response body
+        :param on_bytes: callable receiving the size of every chunk sent
+        """
+        self._iterable = iterable
+        self._on_bytes = on_bytes
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            self._on_bytes(len(chunk))
+            yield chunk
+
+    def close(self):
+        close = getattr(self._iterable, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,154 @@
+"""
+Mirrors the study details of MetaboLights, Metabolomics Workbench and Metabobank into the local SQLite catalog
+(METABOLOMICS_CATALOG, ./cache/catalog.sqlite3 by default), from which the service answers without the upstreams.
+
+    python mirror.py [--sources metabolights,workbench,metabobank] [--workers 8] [--revalidate]
+
+A sync adds the new study ids of each list and fetches the studies that are new or failed before.
+With --revalidate, the mirrored studies are revalidated with conditional requests and re-parsed only if their
+validators changed (Metabobank studies are re-crawled and rewritten only if their file lists changed).
+Every study is committed as soon as it is fetched: an interrupted sync resumes where it stopped.
+"""
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from batch import STUDY_ID_PREFIXES, get_study_details
+from catalog import CATALOG_PATH, StudyCatalog
+from logging_config import logger
+from study_lists import STUDY_LIST_URLS
+from study_sections import STUDY_PAYLOAD_URLS, study_version
+from upstream import UpstreamSession
+from utils import fetch_study_list, guarded_conditional_get
+
+MIRROR_WORKERS = 8
+PROGRESS_INTERVAL = 100
+
+
+def fetch_study_ids(source: str, api_session: requests.Session) -> list:
+    """
+    :return: the current study ids of a source (empty if the list is not available)
+    """
+    study_lst = fetch_study_list.__wrapped__(api_url=STUDY_LIST_URLS[source], source=source,
+                                             api_session=api_session)
+    return [value for value, _ in study_lst]
+
+
+def sync_study(source: str, study_id: str, api_session: requests.Session, known_version: str = None):
+    """
+    Fetches the details of a study unless the upstream payloads it was parsed from are unchanged.
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param study_id: current study id
+    :param api_session: current session
+    :param known_version: version of the mirrored details, None if the study was not mirrored yet
+    :return: 'ok', 'unchanged' or 'error', the study details (None unless 'ok'), their version
+             and the HTTP status code
+    """
+    urls = STUDY_PAYLOAD_URLS.get(source)
+    if known_version and urls:
+        # a conditional request per payload: unchanged payloads cost a 304 and are not parsed again
+        for url in urls:
+            _, resp_code = guarded_conditional_get(url.format(study_id=study_id), api_session, max_age=0)
+            if resp_code != 200:
+                return 'error', None, None, resp_code
+        if study_version(source, study_id, None) == known_version:
+            return 'unchanged', None, known_version, 200
+
+    # the payloads have just been stored or revalidated: they are parsed without another request
+    data, resp_code = get_study_details(source, study_id, api_session)
+    if resp_code != 200:
+        return 'error', None, None, resp_code
+    version = study_version(source, study_id, data)
+    if version == known_version:
+        return 'unchanged', None, version, 200
+    return 'ok', data, version, 200
+
+
+def sync_source(catalog: StudyCatalog, source: str, api_session: requests.Session, revalidate: bool = False,
+                max_workers: int = MIRROR_WORKERS, fetch_ids=None, fetch_study=None) -> dict:
+    """
+    Mirrors one source into the catalog with at most `max_workers` studies fetched at the same time.
+    :param catalog: the catalog to update
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param api_session: session used for the upstream requests
+    :param revalidate: also check the studies that were mirrored before
+    :param max_workers: maximum number of studies fetched at the same time
+    :param fetch_ids: callable (source, api_session) -> list of study ids; `fetch_study_ids` by default
+    :param fetch_study: callable (source, study_id, api_session, known_version) -> see `sync_study`
+    :return: dictionary {'added', 'ok', 'unchanged', 'error'} with the number of studies
+    """
+    fetch_ids = fetch_ids or fetch_study_ids
+    fetch_study = fetch_study or sync_study
+    counts = {'added': 0, 'ok': 0, 'unchanged': 0, 'error': 0}
+
+    study_ids = fetch_ids(source, api_session)
+    if study_ids:
+        counts['added'] = catalog.add_ids(source, study_ids)
+    else:
+        logger.error(f"The {source} study list is not available, syncing the studies already in the catalog")
+
+    todo = dict.fromkeys(catalog.ids(source, (StudyCatalog.PENDING, StudyCatalog.ERROR)))
+    if revalidate:
+        todo.update(catalog.versions(source))
+    logger.info(f"Syncing {len(todo)} {source} studies ({counts['added']} new)")
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    try:
+        for study_id, known_version in todo.items():
+            futures[executor.submit(fetch_study, source, study_id, api_session, known_version)] = study_id
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            study_id = futures[future]
+            try:
+                status, data, version, resp_code = future.result()
+            except Exception as e:
+                logger.error(f"Error syncing {source} study {study_id}: {e}")
+                status, data, version, resp_code = 'error', None, None, 500
+
+            # every study is committed on its own, so an interrupted sync loses nothing
+            if status == 'ok':
+                catalog.put(source, study_id, data, version)
+            elif status == 'unchanged':
+                catalog.touch(source, study_id)
+            else:
+                catalog.mark_error(source, study_id, resp_code)
+            counts[status] += 1
+            if done % PROGRESS_INTERVAL == 0:
+                logger.info(f"Synced {done}/{len(futures)} {source} studies")
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sources', default=','.join(STUDY_ID_PREFIXES), help="comma-separated sources")
+    parser.add_argument('--workers', type=int, default=MIRROR_WORKERS, help="studies fetched at the same time")
+    parser.add_argument('--revalidate', action='store_true', help="also check the studies mirrored before")
+    parser.add_argument('--catalog', default=CATALOG_PATH, help="path of the SQLite catalog")
+    args = parser.parse_args()
+
+    sources = [source for source in args.sources.split(',') if source]
+    unknown = [source for source in sources if source not in STUDY_ID_PREFIXES]
+    if unknown:
+        parser.error(f"unknown sources: {', '.join(unknown)}")
+
+    catalog = StudyCatalog(args.catalog)
+    api_session = UpstreamSession()
+    try:
+        for source in sources:
+            counts = sync_source(catalog, source, api_session, revalidate=args.revalidate, max_workers=args.workers)
+            print(f"{source}: {counts['added']} new, {counts['ok']} updated, {counts['unchanged']} unchanged, "
+                  f"{counts['error']} failed", flush=True)
+    except KeyboardInterrupt:
+        print("Interrupted: run the sync again to resume it", file=sys.stderr)
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.environ.get('METABOLOMICS_CACHE_DIR', os.path.join(os.getcwd(), "cache"))
+PAYLOAD_DIR = os.path.join(CACHE_DIR, "payloads")
+PAYLOAD_MAX_BYTES = int(os.environ.get('METABOLOMICS_PAYLOAD_CACHE_BYTES', 2 * 1024 ** 3))
+# a sweep evicts down to this fraction of the budget, so the directory is not scanned on every store
+PAYLOAD_SWEEP_TARGET = 0.9
+# temporary files older than this are left over by a crashed worker
+STALE_TMP_AGE = 3600
+
+
+class StoredPayload:
+    """
+    An upstream response body kept on disk together with its validators.
+    """
+
+    def __init__(self, url: str, body_path: str, etag: str = None, last_modified: str = None,
+                 content_type: str = None, fetched_at: float = 0.0):
+        self.url = url
+        self.body_path = body_path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.fetched_at = fetched_at
+
+    @property
+    def version(self) -> str:
+        """
+        :return: a short identifier that changes whenever the upstream content changes
+        """
+        validator = self.etag or self.last_modified or str(self.fetched_at)
+        return hashlib.sha1(f"{self.url}|{validator}".encode()).hexdigest()[:16]
+
+    def is_fresh(self, max_age: float) -> bool:
+        return time.time() - self.fetched_at < max_age
+
+    def open(self):
+        """
+        :return: the body opened for reading in binary mode
+        """
+        return open(self.body_path, 'rb')
+
+    def read(self) -> bytes:
+        with open(self.body_path, 'rb') as f:
+            return f.read()
+
+    def text(self) -> str:
+        return self.read().decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.read())
+
+    def to_meta(self) -> dict:
+        return {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'content_type': self.content_type,
+            'fetched_at': self.fetched_at,
+        }
+
+
+class PayloadStore:
+    """
+    Persistent file-per-key store of upstream payloads that survives restarts.
+    Each entry is a body file and a JSON metadata file named after the SHA-256 of the URL;
+    both are written atomically, so concurrent workers never see a partial entry.
+    The store is kept under a byte budget: reading an entry refreshes the modification time of its body, and
+    once the bodies written exceed the budget, the least recently used entries of the directory (shared by
+    all workers) are removed.
+    """
+
+    def __init__(self, directory: str = PAYLOAD_DIR, max_bytes: int = PAYLOAD_MAX_BYTES):
+        """
+        :param directory: directory of the stored payloads
+        :param max_bytes: maximum total size of the stored bodies in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        # size of the directory at the last sweep plus the bodies stored since, None before the first sweep
+        self._bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.directory, key[:2], key)
+        return f"{base}.body", f"{base}.json"
+
+    def _write_atomic(self, path: str, data):
+        """
+        :param data: bytes, or an iterable of bytes chunks written as they arrive
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    for chunk in data:
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, url: str):
+        """
+        :param url: upstream url
+        :return: the stored payload or None if the url has never been stored
+        """
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # the modification time of the body is its last use, see `sweep`
+            os.utime(body_path)
+        except OSError:
+            return None
+        if meta.get('url') != url:
+            return None
+        return StoredPayload(body_path=body_path, **meta)
+
+    def put(self, url: str, body, headers=None) -> StoredPayload:
+        """
+        Stores the body of a successful upstream response with its validators.
+        :param url: upstream url
+        :param body: response body, as bytes or as an iterable of chunks (so it never has to fit in memory)
+        :param headers: response headers (ETag, Last-Modified and Content-Type are kept)
+        :return: the stored payload
+        """
+        headers = headers or {}
+        body_path, meta_path = self._paths(url)
+        payload = StoredPayload(
+            url=url,
+            body_path=body_path,
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            content_type=headers.get('Content-Type'),
+            fetched_at=time.time()
+        )
+        self._write_atomic(body_path, body)
+        self._write_atomic(meta_path, json.dumps(payload.to_meta()).encode())
+        self._stored(os.path.getsize(body_path))
+        return payload
+
+    def touch(self, payload: StoredPayload) -> StoredPayload:
+        """
+        Marks a stored payload as fresh again after the upstream confirmed it is unchanged.
+        """
+        _, meta_path = self._paths(payload.url)
+        payload.fetched_at = time.time()
+        self._write_atomic(meta_path, json.dumps(payload.to_meta()).encode())
+        return payload
+
+    def _stored(self, size: int):
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+                if self._bytes <= self.max_bytes:
+                    return
+            self.sweep()
+
+    def sweep(self):
+        """
+        Removes the least recently used entries until the stored bodies fit in the budget again,
+        and the temporary files left over by crashed writers.
+        Other workers may sweep the same directory at the same time; removing a missing file is ignored.
+        """
+        now = time.time()
+        bodies = []
+        for body_path in glob.glob(os.path.join(self.directory, '*', '*.body')):
+            try:
+                stat = os.stat(body_path)
+            except OSError:
+                continue
+            bodies.append((stat.st_mtime, stat.st_size, body_path))
+        total = sum(size for _, size, _ in bodies)
+
+        if total > self.max_bytes:
+            target = self.max_bytes * PAYLOAD_SWEEP_TARGET
+            for _, size, body_path in sorted(bodies):
+                if total <= target:
+                    break
+                for path in (f"{body_path[:-len('.body')]}.json", body_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                self.evictions += 1
+
+        for tmp_path in glob.glob(os.path.join(self.directory, '*', '*.tmp')):
+            try:
+                if now - os.path.getmtime(tmp_path) > STALE_TMP_AGE:
+                    os.remove(tmp_path)
+            except OSError:
+                pass
+        self._bytes = total
+
+    def stats(self) -> dict:
+        """
+        :return: a dictionary with the eviction counter and the size of the store at the last sweep
+        """
+        with self._lock:
+            stats = {'evictions': self.evictions}
+            if self._bytes is not None:
+                stats['bytes'] = self._bytes
+            return stats
+
+
+payload_store = PayloadStore()
@@ -0,0 +1,203 @@
+import contextvars
+import cProfile
+import hmac
+import marshal
+import os
+import threading
+import time
+from contextlib import nullcontext
+from functools import wraps
+
+from flask import Response, current_app, g, request
+
+from logging_config import logger
+
+# header of trusted clients: its value must be the configured PROFILING_TOKEN
+PROFILE_HEADER = 'X-Profile'
+# header asking for the cProfile statistics of the request instead of its response
+PROFILE_DUMP_HEADER = 'X-Profile-Dump'
+
+# the phase timings of the current request, None when it is not profiled
+_timings = contextvars.ContextVar('phase_timings', default=None)
+_NO_PHASE = nullcontext()
+# request-scoped context variables (None outside of a request) inherited by worker threads started with `bind`
+_request_vars = [_timings]
+# cProfile can only profile one request at a time
+_profiler_lock = threading.Lock()
+
+
+class PhaseTimings:
+    """
+    Wall-clock time spent in each phase of a request (upstream calls, JSON decoding, extraction, rendering...).
+    A phase entered several times is summed. Phases may be nested and, when they run in worker threads,
+    overlap: the sum of the phases can exceed the duration of the request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            total, count = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (total + seconds, count + 1)
+
+    def server_timing(self) -> str:
+        """
+        :return: the value of the Server-Timing header, durations in milliseconds
+        """
+        with self._lock:
+            phases = list(self.phases.items())
+        metrics = [f'{name};dur={total * 1000:.1f};desc="{count} call{"s" if count > 1 else ""}"'
+                   for name, (total, count) in phases]
+        metrics.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(metrics)
+
+
+class _Phase:
+    def __init__(self, timings: PhaseTimings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def phase(name: str):
+    """
+    Times a block as a phase of the current request. Outside of a profiled request it is a shared no-op
+    context manager, so instrumented code costs a context variable lookup.
+    :param name: name of the phase in the Server-Timing header
+    """
+    timings = _timings.get()
+    return _NO_PHASE if timings is None else _Phase(timings, name)
+
+
+def timed(name: str):
+    """
+    Decorator timing every call of a function as a phase of the current request, see `phase`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _timings.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            with _Phase(timings, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_phase(name: str, seconds: float):
+    """
+    Adds a duration measured by the caller (e.g. an upstream attempt) to a phase of the current request.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def propagate(var: contextvars.ContextVar):
+    """
+    Makes worker threads started with `bind` inherit a request-scoped context variable whose default is None.
+    """
+    _request_vars.append(var)
+
+
+def bind(func):
+    """
+    :param func: a callable to be run in a worker thread
+    :return: the callable, recording its phases in the current request and seeing the other request-scoped
+             context variables (worker threads do not inherit them)
+    """
+    values = [(var, value) for var, value in ((var, var.get()) for var in _request_vars) if value is not None]
+    if not values:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        tokens = [(var, var.set(value)) for var, value in values]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+    return wrapper
+
+
+def _is_trusted() -> bool:
+    if current_app.config.get('PROFILING'):
+        return True
+    token = current_app.config.get('PROFILING_TOKEN')
+    provided = request.headers.get(PROFILE_HEADER)
+    return bool(token and provided) and hmac.compare_digest(provided.encode(), token.encode())
+
+
+def start_profiling():
+    """
+    before_request hook: starts timing the phases of the request if profiling is enabled for all requests
+    (config PROFILING) or the client sent the configured PROFILING_TOKEN in the X-Profile header.
+    With an X-Profile-Dump header, the request also runs under cProfile.
+    """
+    if not _is_trusted():
+        return
+    g.phase_timings_token = _timings.set(PhaseTimings())
+    if request.headers.get(PROFILE_DUMP_HEADER):
+        if _profiler_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            logger.info(f"Profiler busy, {request.path} is only timed")
+
+
+def _stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+    return profiler
+
+
+def finish_profiling(response):
+    """
+    after_request hook: adds the Server-Timing header to a profiled request and, if a dump was asked for,
+    replaces the response with the cProfile statistics in the pstats format
+    (readable with `pstats`, snakeviz, flameprof or gprof2dot).
+    """
+    timings = _timings.get()
+    if timings is None:
+        return response
+    profiler = _stop_profiler()
+    if profiler is not None:
+        profiler.create_stats()
+        response = Response(marshal.dumps(profiler.stats), mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename="{request.endpoint or "request"}.pstats"'})
+    response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+def teardown_profiling(exc=None):
+    """
+    teardown_request hook: stops the profiler and forgets the timings even if the request failed.
+    """
+    _stop_profiler()
+    token = g.pop('phase_timings_token', None)
+    if token is not None:
+        _timings.reset(token)
+
+
+def configure_profiling(config: dict):
+    """
+    Reads the profiling settings from the environment:
+    METABOLOMICS_PROFILING=1 times every request (development only),
+    METABOLOMICS_PROFILING_TOKEN enables profiling for clients sending it in the X-Profile header.
+    """
+    config.setdefault('PROFILING', os.environ.get('METABOLOMICS_PROFILING', '0') == '1')
+    config.setdefault('PROFILING_TOKEN', os.environ.get('METABOLOMICS_PROFILING_TOKEN') or None)
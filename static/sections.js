@@ -0,0 +1,74 @@
+// Loads the sections of a study page (assays, metabolites, file lists) page by page from /study_section.
+
+function sectionLoader(url, container, renderItem) {
+  // returns a function that appends the next page of the section to the container;
+  // a "Load more" button after the container requests the following pages
+  let cursor = null;
+  const more = document.createElement('button');
+  more.textContent = 'Load more';
+  more.style.display = 'none';
+  container.after(more);
+
+  function loadPage() {
+    const pageUrl = new URL(url, window.location.origin);
+    if (cursor) pageUrl.searchParams.set('cursor', cursor);
+    more.disabled = true;
+    return fetch(pageUrl)
+      .then(response => {
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+      })
+      .then(data => {
+        data.items.forEach(item => container.appendChild(renderItem(item)));
+        cursor = data.next_cursor;
+        more.style.display = cursor ? '' : 'none';
+        more.disabled = false;
+        return data;
+      })
+      .catch(error => {
+        console.error(`Error loading ${url}:`, error);
+        const message = document.createElement('p');
+        message.textContent = 'Failed to load this section.';
+        container.appendChild(message);
+        more.style.display = 'none';
+      });
+  }
+
+  more.addEventListener('click', loadPage);
+  return loadPage;
+}
+
+function textElement(tag, text) {
+  const element = document.createElement(tag);
+  element.textContent = text === null || text === undefined ? '' : text;
+  return element;
+}
+
+function tableRow(values) {
+  const row = document.createElement('tr');
+  values.forEach(value => row.appendChild(value instanceof Node ? wrapCell(value) : textElement('td', value)));
+  return row;
+}
+
+function wrapCell(node) {
+  const cell = document.createElement('td');
+  cell.appendChild(node);
+  return cell;
+}
+
+function onDemandList(label, url, renderItem) {
+  // a button that loads a (long) list into a scrollable box the first time it is clicked
+  const box = document.createElement('div');
+  const button = textElement('button', label);
+  const list = document.createElement('div');
+  list.style.maxHeight = '150px';
+  list.style.overflowY = 'auto';
+  box.appendChild(button);
+  box.appendChild(list);
+  const load = sectionLoader(url, list, renderItem);
+  button.addEventListener('click', () => {
+    button.remove();
+    load();
+  });
+  return box;
+}
@@ -0,0 +1,40 @@
+from bisect import bisect_left, bisect_right
+
+TYPEAHEAD_LIMIT = 20
+TYPEAHEAD_MAX_LIMIT = 100
+
+
+class StudyIndex:
+    """
+    Immutable index over the study ids of one source: O(1) membership checks and
+    cursor-paginated, case-insensitive prefix search over the sorted ids.
+    """
+
+    def __init__(self, study_ids=()):
+        ids = sorted(set(study_ids), key=str.upper)
+        self._keys = [study_id.upper() for study_id in ids]
+        self._ids = ids
+        self._members = frozenset(ids)
+
+    def __contains__(self, study_id) -> bool:
+        return study_id in self._members
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def search(self, prefix: str = '', limit: int = TYPEAHEAD_LIMIT, cursor: str = None):
+        """
+        :param prefix: beginning of the study ids (case-insensitive)
+        :param limit: maximum number of returned ids
+        :param cursor: the last id of the previous page; the search continues after it
+        :return: a list of at most limit ids in sorted order and the cursor of the next page (or None)
+        """
+        key = prefix.upper()
+        start = bisect_left(self._keys, key)
+        if cursor:
+            start = max(start, bisect_right(self._keys, cursor.upper()))
+        end = bisect_left(self._keys, key + '\uffff') if key else len(self._keys)
+
+        page = self._ids[start:min(start + limit, end)]
+        next_cursor = page[-1] if page and start + limit < end else None
+        return page, next_cursor
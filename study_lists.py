@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+
+import requests
+
+from catalog import get_catalog
+from logging_config import logger
+from study_index import StudyIndex
+from utils import fetch_study_list, load_shared
+
+STUDY_LIST_URLS = {
+    'metabolights': "https://www.ebi.ac.uk/metabolights/ws/studies",
+    'workbench': "https://www.metabolomicsworkbench.org/rest/study/study_id/ST/summary",
+    'metabobank': "https://ddbj.nig.ac.jp/public/metabobank/study/",
+}
+STUDY_LIST_REFRESH_INTERVAL = 3600
+STUDY_LIST_RETRY_INTERVAL = 30
+STUDY_LIST_WAIT = 60
+
+
+class StudyListRefresher:
+    """
+    Keeps the study lists of all sources in memory and refreshes them in the background.
+    The last good copy of a list is served while a refresh runs or while the upstream fails;
+    after a failed refresh the next attempts are spaced out with an exponential backoff.
+    """
+
+    def __init__(self, api_session: requests.Session, fetch=None, interval: float = STUDY_LIST_REFRESH_INTERVAL,
+                 retry_interval: float = STUDY_LIST_RETRY_INTERVAL):
+        """
+        :param api_session: session used for the upstream requests
+        :param fetch: callable (source) -> list of (value, label) tuples; fetches from STUDY_LIST_URLS by default
+        :param interval: number of seconds between two refreshes of a list
+        :param retry_interval: initial delay before retrying a failed refresh
+        """
+        self.api_session = api_session
+        self.fetch = fetch or self._fetch
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._lists = {}
+        self._indexes = {}
+        self._versions = {}
+        self._failures = {source: 0 for source in STUDY_LIST_URLS}
+        self._last_attempt = {source: 0.0 for source in STUDY_LIST_URLS}
+        self._ready = {source: threading.Event() for source in STUDY_LIST_URLS}
+        self._wakeup = {source: threading.Event() for source in STUDY_LIST_URLS}
+        self._refreshing = {source: threading.Lock() for source in STUDY_LIST_URLS}
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def _fetch(self, source: str) -> list:
+        # bypass the `cached` decorator: the refresher is what keeps the list fresh.
+        # With a shared cache backend, one worker process fetches the list for all of them.
+        study_lst = load_shared(f"study_list:{source}", lambda: fetch_study_list.__wrapped__(
+            api_url=STUDY_LIST_URLS[source], source=source, api_session=self.api_session), ttl=self.interval)
+        catalog = get_catalog()
+        if not study_lst and source not in self._lists and catalog is not None:
+            # the upstream is down before the first copy was loaded: start from the mirrored studies
+            study_lst = [(study_id, study_id) for study_id in catalog.ids(source)]
+        return study_lst
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads) and not self._stopped.is_set()
+
+    def refresh(self, source: str) -> bool:
+        """
+        Fetches a study list from the upstream; an empty or failed result keeps the previous copy.
+        :param source: 'metabolights', 'workbench' or 'metabobank'
+        :return: True if the list was refreshed
+        """
+        self._last_attempt[source] = time.time()
+        try:
+            study_lst = self.fetch(source)
+        except Exception as e:
+            logger.error(f"Error refreshing the {source} study list: {e}")
+            study_lst = []
+
+        if not study_lst:
+            self._failures[source] += 1
+            return False
+
+        self._indexes[source] = StudyIndex(value for value, _ in study_lst)
+        self._versions[source] = hashlib.sha1('\n'.join(value for value, _ in study_lst).encode()).hexdigest()[:16]
+        self._lists[source] = (study_lst, time.time())
+        self._failures[source] = 0
+        self._ready[source].set()
+        return True
+
+    def _next_delay(self, source: str) -> float:
+        failures = self._failures[source]
+        if failures == 0:
+            return self.interval
+        return min(self.retry_interval * 2 ** (failures - 1), self.interval)
+
+    def _due(self, source: str) -> bool:
+        """
+        :return: True if a list is missing or expired and not waiting for the backoff of a failed refresh
+        """
+        now = time.time()
+        entry = self._lists.get(source)
+        expired = entry is None or now - entry[1] >= self.interval
+        return expired and now - self._last_attempt[source] >= self._next_delay(source) * bool(self._failures[source])
+
+    def _run(self, source: str):
+        while not self._stopped.is_set():
+            self.refresh(source)
+            self._wakeup[source].wait(self._next_delay(source))
+            self._wakeup[source].clear()
+
+    def start(self):
+        """
+        Starts one background thread per source; each one warms its list up immediately.
+        """
+        if self._threads:
+            return
+        for source in STUDY_LIST_URLS:
+            thread = threading.Thread(target=self._run, args=(source,), name=f"study-list-{source}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        for event in self._wakeup.values():
+            event.set()
+
+    def get(self, source: str, wait: float = 0) -> list:
+        """
+        Returns the last good copy of a study list without contacting the upstream.
+        If the background refresher is not running, a missing or expired list is fetched synchronously
+        by one caller at a time: the others are served the expired copy, or wait for the first one.
+        :param source: 'metabolights', 'workbench' or 'metabobank'
+        :param wait: number of seconds to wait for the first copy if the list has not been loaded yet
+        :return: a list of tuples (value, label)
+        """
+        entry = self._lists.get(source)
+        if not self.running:
+            if self._due(source) and self._refreshing[source].acquire(blocking=entry is None):
+                try:
+                    # the list may have been refreshed while this caller waited
+                    if self._due(source):
+                        self.refresh(source)
+                finally:
+                    self._refreshing[source].release()
+                entry = self._lists.get(source)
+            return entry[0] if entry is not None else []
+
+        if entry is None and wait and self._ready[source].wait(wait):
+            entry = self._lists.get(source)
+        return entry[0] if entry is not None else []
+
+    def version(self, source: str) -> str:
+        """
+        :param source: 'metabolights', 'workbench' or 'metabobank'
+        :return: an identifier of the content of the current copy of a study list (computed once per refresh),
+                 or an empty string if the list is not available
+        """
+        return self._versions.get(source, '')
+
+    def index(self, source: str, wait: float = 0) -> StudyIndex:
+        """
+        Returns the index over the study ids of the last good copy of a study list.
+        :param source: 'metabolights', 'workbench' or 'metabobank'
+        :param wait: number of seconds to wait for the first copy if the list has not been loaded yet
+        :return: a StudyIndex (empty if the list is not available)
+        """
+        self.get(source, wait=wait)
+        return self._indexes.get(source, StudyIndex())
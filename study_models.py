@@ -0,0 +1,226 @@
+import sys
+from array import array
+
+from utils import RAW_FILE_MODES, reshape_raw_file_names
+
+
+def intern_str(value):
+    """
+    Interns strings repeated across assays, metabolites and studies (measurements, technologies, platforms,
+    analysis ids, metabolite names...), so each of them is stored once per process.
+    :param value: any value
+    :return: the interned string, or the value itself if it is not a string
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class StringColumn:
+    """
+    A sequence of strings stored as one string and an array of end offsets: a few bytes per item on top of the
+    characters, instead of a string object and a pointer per item in a list or tuple.
+    Slicing returns a list, so a page of a section is read without materializing the whole column.
+    """
+    __slots__ = ('text', 'ends')
+
+    def __init__(self, values=()):
+        """
+        :param values: strings
+        """
+        parts = []
+        ends = array('L')
+        end = 0
+        for value in values:
+            parts.append(value)
+            end += len(value)
+            ends.append(end)
+        self.text = ''.join(parts)
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("column index out of range")
+        return self.text[self.ends[index - 1] if index else 0:self.ends[index]]
+
+    def __iter__(self):
+        text, start = self.text, 0
+        for end in self.ends:
+            yield text[start:end]
+            start = end
+
+
+class FileRows:
+    """
+    The raw data file names of the rows of an assay table: all names in one StringColumn and the offset of
+    each row in an array, instead of one list per row.
+    """
+    __slots__ = ('names', 'offsets')
+
+    def __init__(self, rows=()):
+        """
+        :param rows: lists of file names per row
+        """
+        names = []
+        offsets = array('L', [0])
+        for row in rows:
+            names.extend(row)
+            offsets.append(len(names))
+        self.names = StringColumn(names)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def rows(self) -> list:
+        """
+        :return: a list of file names per row
+        """
+        names, offsets = self.names[:], self.offsets
+        return [names[offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
+    def reshape(self, mode: str):
+        """
+        :param mode: 'rows', 'flat' or 'unique', see `utils.extract_raw_file_names`
+        :return: the file names in the given shape ('flat' returns the stored column itself)
+        """
+        if mode not in RAW_FILE_MODES:
+            raise ValueError(f"Unknown raw file mode: {mode}")
+        if mode == 'rows':
+            return self.rows()
+        if mode == 'flat':
+            return self.names
+        return reshape_raw_file_names([self.names], mode)
+
+
+class MetabolightsAssay:
+    __slots__ = ('number', 'measurement', 'technology', 'platform', 'file_name', 'metabolite_names', 'raw_files')
+
+    def __init__(self, number, details: dict):
+        """
+        :param number: assay number
+        :param details: the details of the assay returned by `utils.metabolights_fetch_metadata_and_raw_files`
+        """
+        metadata = details.get('metadata') or {}
+        self.number = number
+        self.measurement = intern_str(metadata.get('measurement'))
+        self.technology = intern_str(metadata.get('technology'))
+        self.platform = intern_str(metadata.get('platform'))
+        self.file_name = metadata.get('file_name')
+        names = details.get('reported_metabolite_names')
+        self.metabolite_names = tuple(map(intern_str, names)) if names is not None else None
+        self.raw_files = FileRows(details.get('raw_data_file_names') or ())
+
+    def metadata(self) -> dict:
+        return {
+            'measurement': self.measurement,
+            'technology': self.technology,
+            'platform': self.platform,
+            'assay_number': self.number,
+            'file_name': self.file_name,
+        }
+
+
+class MetabolightsStudy:
+    """
+    A parsed MetaboLights study: title, description and assays.
+    """
+    __slots__ = ('title', 'description', 'assays', 'version')
+
+    def __init__(self, data: dict, version: str = None):
+        """
+        :param data: the study in the form returned by `utils.metabolights_fetch_metadata_and_raw_files`
+        :param version: version of the upstream content the study was parsed from
+        """
+        self.title = data.get('title')
+        self.description = data.get('description')
+        self.assays = tuple(MetabolightsAssay(number, details)
+                            for assay_el in data.get('assays') or [] for number, details in assay_el.items())
+        self.version = version
+
+    def assay(self, number: str) -> MetabolightsAssay:
+        """
+        :param number: assay number (as a string)
+        :raise LookupError: if the study has no such assay
+        """
+        for assay in self.assays:
+            if str(assay.number) == number:
+                return assay
+        raise LookupError(f"unknown assay: {number}")
+
+
+class WorkbenchStudy:
+    """
+    A parsed Metabolomics Workbench study: the fields of its summary and its metabolite records as columns
+    (one tuple per field instead of nested dictionaries per record).
+    """
+    __slots__ = ('summary', 'assay_numbers', 'analysis_ids', 'analysis_summaries', 'metabolite_names',
+                 'refmet_names', 'version')
+
+    def __init__(self, data: dict, version: str = None):
+        """
+        :param data: the study in the form returned by `utils.metabolomics_workbench_get_study_details`
+        :param version: version of the upstream content the study was parsed from
+        """
+        self.summary = {key: value for key, value in data.items() if key != 'assays'}
+        records = [(number, details.get('metadata') or {})
+                   for assay_el in data.get('assays') or [] for number, details in assay_el.items()]
+        self.assay_numbers = tuple(intern_str(number) for number, _ in records)
+        self.analysis_ids = tuple(intern_str(metadata.get('analysis_id')) for _, metadata in records)
+        self.analysis_summaries = tuple(intern_str(metadata.get('analysis_summary')) for _, metadata in records)
+        self.metabolite_names = tuple(intern_str(metadata.get('reported_metabolite_name')) for _, metadata in records)
+        self.refmet_names = tuple(intern_str(metadata.get('refmet_name')) for _, metadata in records)
+        self.version = version
+
+    def records(self):
+        """
+        :return: an iterator of the metabolite records as dictionaries, in the layout of the assays section
+        """
+        for number, analysis_id, analysis_summary, metabolite_name, refmet_name in zip(
+                self.assay_numbers, self.analysis_ids, self.analysis_summaries, self.metabolite_names,
+                self.refmet_names):
+            yield {
+                'analysis_id': analysis_id,
+                'analysis_summary': analysis_summary,
+                'reported_metabolite_name': metabolite_name,
+                'refmet_name': refmet_name,
+                'assay_number': number,
+            }
+
+
+class MetabobankStudy:
+    """
+    A crawled Metabobank study: the urls of its result files and the names of its raw files.
+    """
+    __slots__ = ('results_files', 'raw_files', 'version')
+
+    def __init__(self, data: dict, version: str = None):
+        """
+        :param data: the study in the form returned by `utils.metabobank_get_study_details`
+        :param version: version of the file lists
+        """
+        self.results_files = StringColumn(data.get('results_files') or ())
+        self.raw_files = StringColumn(data.get('raw_files') or ())
+        self.version = version
+
+
+STUDY_MODELS = {
+    'metabolights': MetabolightsStudy,
+    'workbench': WorkbenchStudy,
+    'metabobank': MetabobankStudy,
+}
+
+
+def study_model(source: str, data: dict, version: str = None):
+    """
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param data: a parsed study in the form used by the batch API and the catalog
+    :param version: version of the upstream content the study was parsed from
+    :return: the compact form of the study kept in the cache and read by its page and sections
+    """
+    return STUDY_MODELS[source](data, version)
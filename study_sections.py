@@ -0,0 +1,143 @@
+import hashlib
+import json
+
+import requests
+
+from batch import get_study_details
+from catalog import CATALOG_MODE, get_catalog
+from logging_config import logger
+from metabolite_index import index_study
+from payload_store import payload_store
+from study_models import study_model
+from utils import METABOLIGHTS_STUDY_URL, RAW_FILE_MODES, WORKBENCH_METABOLITES_URL, WORKBENCH_SUMMARY_URL, cached
+
+SECTION_PAGE_SIZE = 50
+SECTION_MAX_PAGE_SIZE = 500
+# the stored upstream payloads a study is parsed from
+STUDY_PAYLOAD_URLS = {
+    'metabolights': (METABOLIGHTS_STUDY_URL,),
+    'workbench': (WORKBENCH_SUMMARY_URL, WORKBENCH_METABOLITES_URL),
+}
+
+
+def study_version(source: str, study_id: str, data: dict) -> str:
+    """
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param study_id: current study id
+    :param data: the parsed study (only read for Metabobank studies)
+    :return: an identifier of the upstream content the study was parsed from
+    """
+    urls = STUDY_PAYLOAD_URLS.get(source)
+    if urls is None:
+        # a Metabobank study is crawled from many directory listings: its version is that of the file lists
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+    versions = []
+    for url in urls:
+        payload = payload_store.get(url.format(study_id=study_id))
+        versions.append(payload.version if payload is not None else '')
+    return hashlib.sha1('|'.join(versions).encode()).hexdigest()[:16]
+
+
+@cached()
+def get_study_data(source: str, study_id: str, api_session: requests.Session):
+    """
+    The parsed study shared by its page and the section endpoints, so loading a section
+    never re-fetches or re-parses the study. It is kept in the compact form of `study_models`.
+    Studies mirrored into the local catalog (see mirror.py) are served from it, or only when
+    the upstream fails with METABOLOMICS_CATALOG_MODE=fallback.
+    The result is shared between requests and must not be modified.
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param study_id: current study id
+    :param api_session: current session
+    :return: the study model (its `version` is computed once, when the study is parsed) and the HTTP status code;
+             an empty dictionary instead of the model if the status code is not 200
+    """
+    catalog = get_catalog()
+    mirrored = catalog.get(source, study_id) if catalog is not None else None
+    if mirrored is not None and CATALOG_MODE == 'prefer':
+        return _study_data(source, study_id, *mirrored), 200
+
+    data, resp_code = get_study_details(source, study_id, api_session)
+    if resp_code != 200:
+        if mirrored is not None:
+            logger.info(f"Serving {source} study {study_id} from the catalog (upstream status {resp_code})")
+            return _study_data(source, study_id, *mirrored), 200
+        return data, resp_code
+    return _study_data(source, study_id, data, study_version(source, study_id, data)), resp_code
+
+
+def _study_data(source: str, study_id: str, data: dict, version: str):
+    # the metabolite search follows the studies as they are parsed or refreshed
+    index_study(source, study_id, version, data)
+    return study_model(source, data, version)
+
+
+def _metabolights_assays(study, params) -> list:
+    return [
+        dict(assay.metadata(),
+             reported_metabolite_names=len(assay.metabolite_names or ()),
+             raw_data_file_names=len(assay.raw_files))
+        for assay in study.assays
+    ]
+
+
+def _metabolights_metabolites(study, params):
+    return study.assay(params.get('assay', '')).metabolite_names or ()
+
+
+def _metabolights_raw_files(study, params):
+    raw_files = study.assay(params.get('assay', '')).raw_files
+    mode = params.get('mode', 'rows')
+    if mode not in RAW_FILE_MODES:
+        raise LookupError(f"unknown raw file mode: {mode}")
+    return raw_files.reshape(mode)
+
+
+def _workbench_assays(study, params) -> list:
+    return list(study.records())
+
+
+# the sections of each study page that are loaded on demand
+SECTIONS = {
+    'metabolights': {
+        'assays': _metabolights_assays,
+        'metabolites': _metabolights_metabolites,
+        'raw_files': _metabolights_raw_files,
+    },
+    'workbench': {
+        'assays': _workbench_assays,
+    },
+    'metabobank': {
+        'results_files': lambda study, params: study.results_files,
+        'raw_files': lambda study, params: study.raw_files,
+    },
+}
+
+
+def section_items(source: str, section: str, study, params=None):
+    """
+    :param source: 'metabolights', 'workbench' or 'metabobank'
+    :param section: name of the section of the study page, see SECTIONS
+    :param study: the parsed study, see `study_models`
+    :param params: section parameters ('assay' for per-assay sections, 'mode' for MetaboLights raw files)
+    :return: all items of the section (a list or a tuple)
+    :raise LookupError: if the section, assay or mode is unknown
+    """
+    try:
+        items = SECTIONS[source][section]
+    except KeyError:
+        raise LookupError(f"unknown section: {source}/{section}") from None
+    return items(study, params or {})
+
+
+def paginate(items: list, cursor: str = None, limit: int = SECTION_PAGE_SIZE):
+    """
+    :param items: all items of a section (a list or a tuple)
+    :param cursor: the 'next_cursor' of the previous page, or None for the first page
+    :param limit: maximum number of items of the page
+    :return: the page and the cursor of the next page (or None)
+    """
+    start = int(cursor) if cursor and cursor.isdigit() else 0
+    end = start + limit
+    return items[start:end], str(end) if end < len(items) else None
@@ -0,0 +1,183 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('METABOLOMICS_CACHE_DIR', tempfile.mkdtemp(prefix='metabolomics-test-cache-'))
+os.environ.setdefault('METABOLOMICS_WARMUP', '0')
+
+import requests
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, TestServer
+
+from aio_server import AsyncServer
+from aio_upstream import AsyncUpstreamSession
+from api import api_session
+from file_cache import download_cache
+from upstream import UpstreamSession
+
+STUDY_FILES = {
+    'MTBKSA1/': ['E1/'],
+    'MTBKSA1/E1/': ['OtherData/', 'Rawdata/'],
+    'MTBKSA1/E1/OtherData/': ['result1.txt', 'result2.txt'],
+    'MTBKSA1/E1/Rawdata/': ['raw1.cdf'],
+    'MTBKSA2/': ['OtherData/', 'Rawdata/'],
+    'MTBKSA2/OtherData/': ['result1.txt', 'result2.txt'],
+    'MTBKSA2/Rawdata/': ['raw1.cdf'],
+    'MTBKSA3/': ['OtherData/', 'Rawdata/'],
+    'MTBKSA3/OtherData/': ['result1.txt', 'broken.txt'],
+    'MTBKSA3/Rawdata/': ['raw1.cdf'],
+}
+
+
+def stand_in_upstream(calls: list) -> web.Application:
+    async def workbench(request):
+        calls.append(request.path)
+        study_id = request.match_info['study_id']
+        if study_id == 'ST404':
+            return web.Response(status=404)
+        if request.match_info['part'] == 'summary':
+            return web.json_response({'study_id': study_id, 'study_title': f"Async study {study_id}"})
+        return web.json_response({'1': {'analysis_id': 'AN1', 'metabolite_name': 'Tryptamine', 'refmet_name': 'Tryptamine'}})
+
+    async def metabobank(request):
+        calls.append(request.path)
+        path = request.match_info['path']
+        if path in STUDY_FILES:
+            return web.Response(text="".join(f'<a href="{el}">{el}</a>' for el in STUDY_FILES[path]),
+                                content_type='text/html')
+        if path.endswith('broken.txt'):
+            return web.Response(status=404)
+        return web.Response(body=path.encode() * 100, headers={'ETag': '"v1"'})
+
+    async def metabolights_download(request):
+        calls.append(request.path_qs)
+        return web.Response(body=b"0123456789", content_type='text/plain')
+
+    application = web.Application()
+    application.router.add_get('/rest/study/study_id/{study_id}/{part}', workbench)
+    application.router.add_get('/public/metabobank/study/{path:.*}', metabobank)
+    application.router.add_get('/metabolights/ws/studies/{study_id}/download', metabolights_download)
+    return application
+
+
+class AsyncServerTestCase(AioHTTPTestCase):
+    async def asyncSetUp(self):
+        self.upstream_calls = []
+        self.upstream_server = TestServer(stand_in_upstream(self.upstream_calls))
+        await self.upstream_server.start_server()
+        # the sync code must never wait on an upstream itself
+        self.blocking = mock.patch.object(requests.Session, 'request',
+                                          side_effect=AssertionError("blocking upstream request"))
+        self.blocking.start()
+        # other test modules replace the session's get method
+        self.session_attributes = mock.patch.dict(api_session.__dict__)
+        self.session_attributes.start()
+        api_session.__dict__.pop('get', None)
+        await super().asyncSetUp()
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        self.session_attributes.stop()
+        self.blocking.stop()
+        await self.upstream_server.close()
+
+    async def get_application(self):
+        base_url = str(self.upstream_server.make_url('')).rstrip('/')
+        overrides = {host: base_url for host in ('www.ebi.ac.uk', 'www.metabolomicsworkbench.org', 'ddbj.nig.ac.jp')}
+        upstream = AsyncUpstreamSession(breakers=UpstreamSession(), host_overrides=overrides, backoff_base=0)
+        return AsyncServer(upstream=upstream, threads=4).application()
+
+    async def test_workbench_page_is_prefetched(self):
+        response = await self.client.get('/metabolomics_workbench_get_study_details_info/STA1')
+        self.assertEqual(response.status, 200)
+        self.assertIn('Async study STA1', await response.text())
+        self.assertEqual(sorted(self.upstream_calls), ['/rest/study/study_id/STA1/metabolites',
+                                                       '/rest/study/study_id/STA1/summary'])
+
+        response = await self.client.get('/study_section/workbench/STA1/assays')
+        self.assertEqual((await response.json())['items'][0]['refmet_name'], 'Tryptamine')
+        self.assertEqual(len(self.upstream_calls), 2)
+
+    async def test_upstream_error_status_is_kept(self):
+        response = await self.client.get('/metabolomics_workbench_get_study_details_info/ST404')
+        self.assertEqual(response.status, 404)
+
+    async def test_metabobank_crawl_is_prefetched(self):
+        response = await self.client.get('/metabobank_get_study_details_info/MTBKSA1')
+        self.assertEqual(response.status, 200)
+        response = await self.client.get('/study_section/metabobank/MTBKSA1/results_files')
+        items = (await response.json())['items']
+        self.assertEqual([el.split('/')[-1] for el in items], ['result1.txt', 'result2.txt'])
+
+    async def test_download_is_cached(self):
+        url = '/metabolights_download_file/MTBLSA1/data.txt'
+        stats = download_cache.stats()
+        response = await self.client.get(url)
+        self.assertEqual(await response.read(), b"0123456789")
+        self.assertIn('filename=data.txt', response.headers['Content-Disposition'])
+
+        response = await self.client.get(url, headers={'Range': 'bytes=2-4'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(await response.read(), b"234")
+        self.assertEqual(self.upstream_calls, ['/metabolights/ws/studies/MTBLSA1/download?study_id=MTBLSA1&file=data.txt'])
+        self.assertEqual(download_cache.stats()['misses'], stats['misses'] + 1)
+        self.assertEqual(download_cache.stats()['hits'], stats['hits'] + 1)
+
+    async def test_metadata_is_zipped(self):
+        response = await self.client.get('/metabolights_download_file/MTBLSA1/metadata')
+        self.assertEqual(response.content_type, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(await response.read())) as zip_file:
+            self.assertEqual(zip_file.read('metadata.zip'), b"0123456789")
+
+    async def test_metabobank_bundle(self):
+        response = await self.client.get('/metabobank_download_bundle/MTBKSA2?file=result2.txt')
+        self.assertEqual(response.status, 200)
+        with zipfile.ZipFile(io.BytesIO(await response.read())) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['OtherData/result2.txt'])
+            self.assertEqual(zip_file.read('OtherData/result2.txt'), b"MTBKSA2/OtherData/result2.txt" * 100)
+
+    async def test_metabobank_bundle_lists_failed_files(self):
+        response = await self.client.get('/metabobank_download_bundle/MTBKSA3')
+        self.assertEqual(response.status, 200)
+        with zipfile.ZipFile(io.BytesIO(await response.read())) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['OtherData/result1.txt', 'ERRORS.txt'])
+            self.assertIn('OtherData/broken.txt: HTTP 404', zip_file.read('ERRORS.txt').decode())
+
+        response = await self.client.get('/metabobank_download_bundle/MTBKSA3?file=broken.txt')
+        self.assertEqual(response.status, 502)
+
+    async def test_concurrent_downloads_share_one_transfer(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKSA2/OtherData/result2.txt"
+
+        async def download():
+            response = await self.client.get(f'/metabobank_download_file/{file_url}')
+            return await response.read()
+
+        bodies = await asyncio.gather(*(download() for _ in range(3)))
+        self.assertEqual(bodies, [b"MTBKSA2/OtherData/result2.txt" * 100] * 3)
+        self.assertEqual(self.upstream_calls, ['/public/metabobank/study/MTBKSA2/OtherData/result2.txt'])
+
+    async def test_metabobank_download_file(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKSA2/OtherData/result1.txt"
+        response = await self.client.get(f'/metabobank_download_file/{file_url}')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), b"MTBKSA2/OtherData/result1.txt" * 100)
+
+    async def test_other_routes_are_served_by_flask(self):
+        response = await self.client.get('/', allow_redirects=False)
+        self.assertEqual(response.status, 302)
+        self.assertTrue(response.headers['Location'].endswith('/metabolomics'))
+
+        response = await self.client.post('/batch_get_study_details', json={'study_ids': []})
+        self.assertEqual(response.status, 400)
+        self.assertIn('study_ids', json.loads(await response.text())['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
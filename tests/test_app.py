@@ -1,22 +1,48 @@
 import os
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import gzip
+import io
 import json
+import pstats
+import zipfile
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('METABOLOMICS_CACHE_DIR', tempfile.mkdtemp(prefix='metabolomics-test-cache-'))
+os.environ.setdefault('METABOLOMICS_WARMUP', '0')
 
 from api import app, api_session
+from file_cache import DownloadCache
+from forms import MetabolightsForm
+from fragment_cache import fragment_cache
+from metrics import CountingIterable, DOWNLOAD_BYTES, METABOBANK_CRAWL_LISTINGS, METABOBANK_CRAWL_REQUESTS
+from payload_store import PayloadStore, payload_store
+from study_index import StudyIndex
+from study_lists import StudyListRefresher
+from utils import (conditional_get, extract_raw_file_names, metabobank_fetch_result_and_raw_files,
+                   metabolomics_workbench_get_study_details)
 
 
 class DummyResponse:
-    def __init__(self, ok=True, status_code=200, content=b"", json_data=None):
+    def __init__(self, ok=True, status_code=200, content=b"", json_data=None, headers=None):
         self.ok = ok
         self.status_code = status_code
-        self.content = content
+        self.content = json.dumps(json_data).encode() if json_data is not None else content
         self._json_data = json_data
+        self.headers = headers or {}
 
     def json(self):
         return self._json_data if self._json_data is not None else {}
 
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
     @property
     def text(self):
         return json.dumps(self._json_data) if self._json_data is not None else ""
@@ -73,6 +99,105 @@ class FlaskEndpointsTestCase(unittest.TestCase):
         response = self.client.get('/metabolights_get_study_details_info/MTBLS105')
         self.assertEqual(response.status_code, 200)
 
+    def test_metabolights_result_files_of_logged_in_users(self):
+        def get(url=None, **kwargs):
+            if url.endswith('/files?include_raw_data=false'):
+                return DummyResponse(json_data={'study': [{'file': 'm_result.tsv'}]})
+            return dummy_get(url, **kwargs)
+
+        api_session.get = get
+        with self.client.session_transaction() as client_session:
+            client_session['api_token'] = 'token'
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'MetaboLights Study', response.data)
+        self.assertIn(b'/metabolights_download_file/MTBLS105/m_result.tsv', response.data)
+
+    def test_metabolights_study_details_unique_raw_files(self):
+        response = self.client.get('/study_section/metabolights/MTBLS105/raw_files?assay=1&mode=unique')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['items'], ['rawfile.cdf'])
+
+    def test_study_sections_are_paginated_from_the_parsed_study(self):
+        requested = []
+
+        def get_study(url, **kwargs):
+            requested.append(url)
+            fake_study = {
+                "title": "Sections Study", "description": "", "assays": [{
+                    "assayNumber": 7, "measurement": "m", "technology": "t", "platform": "p", "fileName": "a.txt",
+                    "assayTable": {"data": [[f"FILES/raw{i}.mzML"] for i in range(5)]},
+                    "metaboliteAssignment": {"metaboliteAssignmentLines": ["glucose", "alanine"]}
+                }]
+            }
+            return DummyResponse(json_data={'content': fake_study})
+
+        api_session.get = get_study
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS777')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'raw0.mzML', response.data)
+
+        url = '/study_section/metabolights/MTBLS777/raw_files?assay=7&mode=flat&limit=2'
+        page = self.client.get(url).get_json()
+        self.assertEqual(page['items'], ['raw0.mzML', 'raw1.mzML'])
+        self.assertEqual(page['total'], 5)
+        page = self.client.get(f"{url}&cursor={page['next_cursor']}").get_json()
+        self.assertEqual(page['items'], ['raw2.mzML', 'raw3.mzML'])
+
+        metabolites = self.client.get('/study_section/metabolights/MTBLS777/metabolites?assay=7').get_json()
+        self.assertEqual(metabolites['items'], ['glucose', 'alanine'])
+        self.assertEqual(len(requested), 1)
+
+        self.assertEqual(self.client.get('/study_section/metabolights/MTBLS777/samples').status_code, 404)
+        self.assertEqual(self.client.get('/study_section/metabolights/MTBLS777/metabolites?assay=8').status_code, 404)
+
+    def test_search_metabolites_of_parsed_studies(self):
+        def get_study(url, **kwargs):
+            fake_study = {
+                "title": "Search Study", "description": "", "assays": [{
+                    "assayNumber": 1, "measurement": "m", "technology": "t", "platform": "p", "fileName": "a.txt",
+                    "assayTable": {"data": []},
+                    "metaboliteAssignment": {"metaboliteAssignmentLines": ["D-Glucose 6-phosphate", "Citrulline"]}
+                }]
+            }
+            return DummyResponse(json_data={'content': fake_study})
+
+        api_session.get = get_study
+        self.assertEqual(self.client.get('/metabolights_get_study_details_info/MTBLS778').status_code, 200)
+
+        response = self.client.get('/search_metabolites?q=glucose-6&source=metabolights')
+        self.assertEqual(response.get_json()['results'],
+                         [{'source': 'metabolights', 'study_id': 'MTBLS778', 'names': ['D-Glucose 6-phosphate']}])
+        self.assertEqual(self.client.get('/search_metabolites?q=glucose&source=workbench').get_json()['total'], 0)
+        self.assertEqual(self.client.get('/search_metabolites?q=x&source=unknown').status_code, 404)
+
+    def test_study_page_revalidation_returns_304(self):
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105')
+        etag, _ = response.get_etag()
+        self.assertTrue(etag)
+
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105',
+                                   headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_responses_are_compressed_when_accepted(self):
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'MetaboLights Study', gzip.decompress(response.data))
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        # the ETag of the compressed representation validates as well
+        etag, _ = response.get_etag()
+        self.assertTrue(etag.endswith('-gzip'))
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105',
+                                   headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/metabolights_get_study_details_info/MTBLS105')
+        self.assertNotIn('Content-Encoding', response.headers)
+
     def test_metabolights_download_file(self):
         response = self.client.get('/metabolights_download_file/MTBLS105/somefile.txt')
         self.assertEqual(response.status_code, 200)
@@ -90,15 +215,518 @@ class FlaskEndpointsTestCase(unittest.TestCase):
         response = self.client.get(f'/metabobank_download_file/{file_url}')
         self.assertEqual(response.status_code, 200)
 
+    def test_metabobank_download_file_is_streamed_with_range(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS6/OtherData/partial.txt"
+        upstream_calls = []
+
+        def ranged_get(url, headers=None, **kwargs):
+            upstream_calls.append(headers)
+            return DummyResponse(status_code=206, content=b"content", headers={
+                'Content-Length': '7', 'Content-Range': 'bytes 10-16/100', 'Content-Type': 'text/plain'})
+
+        api_session.get = ranged_get
+        response = self.client.get(f'/metabobank_download_file/{file_url}', headers={'Range': 'bytes=10-16'})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-16/100')
+        self.assertEqual(response.headers['Content-Length'], '7')
+        self.assertEqual(response.data, b"content")
+        self.assertEqual(upstream_calls[0]['Range'], 'bytes=10-16')
+
+    def test_metrics_endpoint(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS6/OtherData/file1.txt"
+        before = DOWNLOAD_BYTES.value(route='/metabobank_download_file/<path:file_url>')
+        self.assertEqual(self.client.get(f'/metabobank_download_file/{file_url}').status_code, 200)
+        self.assertGreater(DOWNLOAD_BYTES.value(route='/metabobank_download_file/<path:file_url>'), before)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.get_data(as_text=True)
+        self.assertIn('# TYPE metabolomics_request_duration_seconds histogram', text)
+        self.assertIn('metabolomics_requests_total{route="/metabobank_download_file/<path:file_url>",method="GET",'
+                      'status="200"}', text)
+        self.assertIn('metabolomics_cache_hits_total{cache="fragments"}', text)
+
+    def test_profiling_is_opt_in(self):
+        url = '/metabolomics_workbench_get_study_details_info/ST_TEST'
+        self.assertNotIn('Server-Timing', self.client.get(url).headers)
+        app.config['PROFILING_TOKEN'] = 'secret'
+        try:
+            self.assertNotIn('Server-Timing', self.client.get(url, headers={'X-Profile': 'wrong'}).headers)
+            fragment_cache.clear()
+            response = self.client.get(url, headers={'X-Profile': 'secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('render;dur=', response.headers['Server-Timing'])
+            self.assertIn('total;dur=', response.headers['Server-Timing'])
+
+            response = self.client.get(url, headers={'X-Profile': 'secret', 'X-Profile-Dump': '1'})
+            self.assertEqual(response.mimetype, 'application/octet-stream')
+            with tempfile.NamedTemporaryFile(suffix='.pstats') as f:
+                f.write(response.data)
+                f.flush()
+                self.assertGreater(pstats.Stats(f.name).total_calls, 0)
+        finally:
+            app.config['PROFILING_TOKEN'] = None
+
+    def test_metabolights_download_metadata_is_zipped(self):
+        response = self.client.get('/metabolights_download_file/MTBLS105/metadata')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['metadata.zip'])
+
+    def test_metabobank_download_bundle(self):
+        base_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS901/"
+        listings = {
+            base_url: ["OtherData/", "Rawdata/"],
+            f"{base_url}OtherData/": ["a.txt", "b.txt", "c.txt"],
+            f"{base_url}Rawdata/": ["raw.cdf"],
+        }
+
+        def bundle_get(url, **kwargs):
+            if url in listings:
+                links = "".join(f'<a href="{el}">{el}</a>' for el in listings[url])
+                return DummyResponse(content=links.encode())
+            if url.endswith("c.txt"):
+                return DummyResponse(ok=False, status_code=404)
+            return DummyResponse(content=url.split('/')[-1].encode() * 1000)
+
+        api_session.get = bundle_get
+        response = self.client.get('/metabobank_download_bundle/MTBKS901')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['OtherData/a.txt', 'OtherData/b.txt', 'ERRORS.txt'])
+            self.assertEqual(zip_file.read('OtherData/b.txt'), b"b.txt" * 1000)
+            self.assertIn(f"{base_url}OtherData/c.txt: HTTP 404", zip_file.read('ERRORS.txt').decode())
+
+        response = self.client.get('/metabobank_download_bundle/MTBKS901?file=b.txt')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['OtherData/b.txt'])
+
+        response = self.client.get('/metabobank_download_bundle/MTBKS901?file=c.txt')
+        self.assertEqual(response.status_code, 502)
+
+    def test_metabobank_download_file_is_cached(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS7/OtherData/cached.txt"
+        upstream_calls = []
+
+        def counting_get(url, **kwargs):
+            upstream_calls.append(url)
+            return DummyResponse(content=b"0123456789", headers={'ETag': '"abc"'})
+
+        api_session.get = counting_get
+        first = self.client.get(f'/metabobank_download_file/{file_url}')
+        self.assertEqual(first.data, b"0123456789")
+        second = self.client.get(f'/metabobank_download_file/{file_url}')
+        self.assertEqual(second.data, b"0123456789")
+        partial = self.client.get(f'/metabobank_download_file/{file_url}', headers={'Range': 'bytes=2-4'})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.data, b"234")
+        self.assertEqual(len(upstream_calls), 1)
+
+        # cache hits keep the file wrapper of send_file (sendfile), their size is counted from Content-Length
+        route = '/metabobank_download_file/<path:file_url>'
+        before = DOWNLOAD_BYTES.value(route=route)
+        with app.test_request_context(f'/metabobank_download_file/{file_url}'):
+            response = app.full_dispatch_request()
+            self.assertNotIsInstance(response.response, CountingIterable)
+            response.close()
+        self.assertEqual(DOWNLOAD_BYTES.value(route=route), before + 10)
+
+    def test_concurrent_downloads_share_one_transfer(self):
+        file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS7/OtherData/concurrent.txt"
+        upstream_calls = []
+        release = threading.Event()
+
+        class SlowResponse(DummyResponse):
+            def iter_content(self, chunk_size=1):
+                yield b"first-"
+                release.wait(2)
+                yield b"second"
+
+        def slow_get(url, **kwargs):
+            upstream_calls.append(url)
+            return SlowResponse(content=b"")
+
+        api_session.get = slow_get
+        bodies = []
+
+        def download():
+            bodies.append(app.test_client().get(f'/metabobank_download_file/{file_url}').data)
+
+        threads = [threading.Thread(target=download) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        # let all clients reach the cache while the first transfer is still running
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(bodies, [b"first-second"] * 3)
+        self.assertEqual(len(upstream_calls), 1)
+
     def test_metabobank_download_file_fail(self):
         file_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS6/OtherData/060510root_noise3NIST_TEST.txt"
         with self.assertRaises(TypeError):
             self.client.get(f'/metabobank_download_file/{file_url}')
 
+    def test_batch_get_study_details(self):
+        response = self.client.post('/batch_get_study_details',
+                                    json={'study_ids': ['MTBLS105', 'ST_TEST', 'MTBKS6', 'UNKNOWN1']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = {record['study_id']: record for record in map(json.loads, response.data.decode().splitlines())}
+        self.assertEqual(set(records), {'MTBLS105', 'ST_TEST', 'MTBKS6', 'UNKNOWN1'})
+        self.assertEqual(records['MTBLS105']['status'], 200)
+        self.assertEqual(records['MTBLS105']['data']['title'], 'MetaboLights Study')
+        self.assertEqual(records['ST_TEST']['source'], 'workbench')
+        self.assertEqual(records['MTBKS6']['source'], 'metabobank')
+        self.assertEqual(records['UNKNOWN1']['status'], 400)
+
+    def test_batch_get_study_details_invalid_request(self):
+        response = self.client.post('/batch_get_study_details', json={'study_ids': 'MTBLS105'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_typeahead_studies(self):
+        response = self.client.get('/typeahead_studies/metabolights?prefix=mtbls10&limit=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'results': ['MTBLS105'], 'next_cursor': 'MTBLS105', 'total': 2})
+        response = self.client.get('/typeahead_studies/metabolights?prefix=mtbls10&limit=1&cursor=MTBLS105')
+        self.assertEqual(response.get_json()['results'], ['MTBLS106'])
+        self.assertEqual(self.client.get('/typeahead_studies/unknown').status_code, 404)
+
+    def test_study_list_revalidation_returns_304(self):
+        response = self.client.get('/fetch_metabolights_studies')
+        self.assertEqual(response.get_json(), [['MTBLS105', 'MTBLS105'], ['MTBLS106', 'MTBLS106']])
+        etag, _ = response.get_etag()
+        response = self.client.get('/fetch_metabolights_studies', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_study_selection_is_validated_against_the_index(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            response = self.client.post('/metabolomics', data={'form-name': 'metabolights-selection',
+                                                               'study': 'MTBLS105'})
+            self.assertEqual(response.status_code, 302)
+            self.assertIn('/metabolights_get_study_details_info/MTBLS105', response.headers['Location'])
+            response = self.client.post('/metabolomics', data={'form-name': 'metabolights-selection',
+                                                               'study': 'MTBLS999'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_study_selection_is_not_rejected_before_the_list_is_loaded(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            with app.test_request_context('/metabolomics', method='POST', data={'study': 'MTBLS999'}):
+                form = MetabolightsForm()
+                self.assertTrue(form.validate_on_submit())
+                form.study.index = StudyIndex(['MTBLS105'])
+                self.assertFalse(form.validate_on_submit())
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+
     def test_metabolomics_page(self):
         response = self.client.get('/metabolomics')
         self.assertEqual(response.status_code, 200)
 
 
+class ConditionalGetTestCase(unittest.TestCase):
+    def test_stale_payload_is_revalidated(self):
+        url = "https://example.org/conditional-get-test"
+        sent_headers = []
+
+        class Session:
+            def get(self, url, headers=None, **kwargs):
+                sent_headers.append(headers)
+                if headers and headers.get('If-None-Match') == '"v1"':
+                    return DummyResponse(ok=True, status_code=304)
+                return DummyResponse(json_data={'value': 1}, headers={'ETag': '"v1"'})
+
+        payload, resp_code = conditional_get(url, Session(), max_age=0)
+        self.assertEqual(resp_code, 200)
+        self.assertEqual(payload.json(), {'value': 1})
+
+        payload, resp_code = conditional_get(url, Session(), max_age=0)
+        self.assertEqual(resp_code, 200)
+        self.assertEqual(payload.json(), {'value': 1})
+        self.assertEqual(sent_headers[-1]['If-None-Match'], '"v1"')
+
+    def test_fresh_payload_skips_network(self):
+        url = "https://example.org/conditional-get-fresh"
+        payload_store.put(url, b'{"value": 2}')
+
+        class Session:
+            def get(self, url, **kwargs):
+                raise AssertionError("fresh payloads must not hit the network")
+
+        payload, resp_code = conditional_get(url, Session(), max_age=3600)
+        self.assertEqual(payload.json(), {'value': 2})
+
+
+class DownloadCacheTestCase(unittest.TestCase):
+    """
+    Two caches on the same directory stand for two workers.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='metabolomics-test-downloads-')
+
+    def add(self, cache: DownloadCache, url: str, size: int):
+        path, f = cache.create_partial()
+        with f:
+            f.write(b"x" * size)
+        return cache.commit(url, path, size, {})
+
+    def test_budget_is_shared_by_workers(self):
+        first = DownloadCache(self.directory, max_bytes=1000)
+        self.add(first, "https://example.org/a.txt", 600)
+        os.utime(first.lookup("https://example.org/a.txt")[0].path, (0, 0))
+        # the file of the first worker is counted by the scan of the second one
+        second = DownloadCache(self.directory, max_bytes=1000)
+        self.add(second, "https://example.org/b.txt", 600)
+        self.assertEqual(second.stats()['bytes'], 600)
+        self.assertIsNone(second.lookup("https://example.org/a.txt")[0])
+
+        # the first worker still indexes the evicted file: it is downloaded again instead of failing
+        upstream_calls = []
+
+        def open_upstream(headers):
+            upstream_calls.append(headers)
+            return DummyResponse(content=b"0123456789")
+
+        with app.test_request_context():
+            response, status = first.serve("https://example.org/a.txt", 'a.txt', open_upstream, {})
+            self.assertEqual((status, b"".join(response.response)), (200, b"0123456789"))
+        self.assertEqual(len(upstream_calls), 1)
+        self.assertEqual(first.stats()['misses'], 1)
+
+    def test_directory_is_scanned_only_over_budget(self):
+        cache = DownloadCache(self.directory, max_bytes=1000)
+        scans = []
+        scan = cache._scan
+        cache._scan = lambda: scans.append(1) or scan()
+        self.add(cache, "https://example.org/a.txt", 400)
+        self.add(cache, "https://example.org/b.txt", 400)
+        self.assertEqual(len(scans), 0)
+        self.add(cache, "https://example.org/c.txt", 400)
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(cache.stats()['bytes'], 800)
+        self.assertIsNone(cache.lookup("https://example.org/a.txt")[0])
+
+    def test_partial_files_of_other_workers_are_kept(self):
+        cache = DownloadCache(self.directory)
+        partial_path, f = cache.create_partial()
+        f.close()
+        stale_path, f = cache.create_partial()
+        f.close()
+        os.utime(stale_path, (0, 0))
+
+        DownloadCache(self.directory)
+        self.assertTrue(os.path.exists(partial_path))
+        self.assertFalse(os.path.exists(stale_path))
+
+
+class PayloadStoreTestCase(unittest.TestCase):
+    def test_least_recently_read_payloads_are_evicted(self):
+        store = PayloadStore(directory=tempfile.mkdtemp(prefix='metabolomics-test-payloads-'), max_bytes=3500)
+        for i in range(3):
+            store.put(f"https://example.org/payload/{i}", b"x" * 1000)
+            # modification times of the bodies order the uses
+            os.utime(store.get(f"https://example.org/payload/{i}").body_path, (i, i))
+        os.utime(store.get("https://example.org/payload/0").body_path, (10, 10))
+
+        store.put("https://example.org/payload/3", b"x" * 1000)
+        self.assertEqual(store.stats(), {'evictions': 1, 'bytes': 3000})
+        self.assertIsNone(store.get("https://example.org/payload/1"))
+        for i in (0, 2, 3):
+            self.assertEqual(store.get(f"https://example.org/payload/{i}").read(), b"x" * 1000)
+
+
+class ExtractRawFileNamesTestCase(unittest.TestCase):
+    rows = [
+        ['S1', 'FILES/a.mzML', 'x', 'FILES/a.raw', 'note\nFILES/not-a-cell'],
+        ['S2', 'FILES/b.mzML', 'FILES/c.mzML', '', ''],
+        ['S3', 'FILES/a.mzML', 'y', 'FILES/a.raw', ''],
+    ]
+
+    def test_same_rows_as_cell_scan(self):
+        expected = [[el[len('FILES/'):] for el in row if el.startswith('FILES/')] for row in self.rows]
+        self.assertEqual(extract_raw_file_names(self.rows), expected)
+        # ragged rows fall back to the per-cell scan
+        self.assertEqual(extract_raw_file_names(self.rows + [['FILES/d.mzML']]), expected + [['d.mzML']])
+
+    def test_columns_from_header(self):
+        fields = {'0~Sample Name': {'index': 0, 'header': 'Sample Name'},
+                  '1~Raw Spectral Data File': {'index': 1, 'header': 'Raw Spectral Data File'},
+                  '3~Derived Spectral Data File': {'index': 3, 'header': 'Derived Spectral Data File'}}
+        self.assertEqual(extract_raw_file_names(self.rows, fields=fields),
+                         [['a.mzML', 'a.raw'], ['b.mzML', 'c.mzML'], ['a.mzML', 'a.raw']])
+
+    def test_file_cells_outside_file_columns(self):
+        expected = extract_raw_file_names(self.rows)
+        # column 2 holds a file name although its header does not name a file
+        fields = [{'index': 0, 'header': 'Sample Name'}, {'index': 1, 'header': 'Raw Spectral Data File'},
+                  {'index': 2, 'header': 'Parameter Value[Scan]'}]
+        self.assertEqual(extract_raw_file_names(self.rows, fields=fields), expected)
+        # no column of the header names a file
+        fields = ['Sample Name', 'Parameter Value[Scan]', 'Comment', 'Comment', 'Comment']
+        self.assertEqual(extract_raw_file_names(self.rows, fields=fields), expected)
+
+    def test_flat_and_unique_modes(self):
+        self.assertEqual(extract_raw_file_names(self.rows, mode='flat'),
+                         ['a.mzML', 'a.raw', 'b.mzML', 'c.mzML', 'a.mzML', 'a.raw'])
+        self.assertEqual(extract_raw_file_names(self.rows, mode='unique'), ['a.mzML', 'a.raw', 'b.mzML', 'c.mzML'])
+        with self.assertRaises(ValueError):
+            extract_raw_file_names(self.rows, mode='columns')
+
+
+class MetabobankCrawlerTestCase(unittest.TestCase):
+    base_url = "https://ddbj.nig.ac.jp/public/metabobank/study/MTBKS900/"
+    tree = {
+        "": ["OtherData/", "Rawdata/", "E01/", "readme.txt"],
+        "OtherData/": ["a.txt", "b.tsv"],
+        "Rawdata/": ["batch1/", "batch2/"],
+        "Rawdata/batch1/": ["x.cdf"],
+        "Rawdata/batch2/": ["y.zip"],
+        "E01/": ["notes.txt", "raw/"],
+        "E01/raw/rawdata/": ["z.cdf"],
+    }
+
+    def test_crawl_result(self):
+        tree = self.tree
+        base_url = self.base_url
+
+        class Session:
+            def get(self, url, **kwargs):
+                entries = tree.get(url[len(base_url):])
+                if entries is None:
+                    return DummyResponse(ok=False, status_code=404)
+                links = "".join(f'<a href="{el}">{el}</a>' for el in entries)
+                return DummyResponse(content=f"<html><body>{links}</body></html>".encode())
+
+        crawls, listings = METABOBANK_CRAWL_LISTINGS.count(), METABOBANK_CRAWL_REQUESTS.value()
+        (results_files, raw_files), resp_code = metabobank_fetch_result_and_raw_files(
+            study_id="MTBKS900", api_session=Session())
+
+        self.assertEqual(resp_code, 200)
+        self.assertEqual(results_files, [f"{base_url}OtherData/a.txt", f"{base_url}E01/notes.txt"])
+        self.assertEqual(raw_files, ["x.cdf", "y.zip", "z.cdf"])
+        # the metrics are not labelled with the study id
+        self.assertEqual(METABOBANK_CRAWL_LISTINGS.count(), crawls + 1)
+        self.assertGreater(METABOBANK_CRAWL_REQUESTS.value(), listings)
+
+
+class WorkbenchConcurrentFetchTestCase(unittest.TestCase):
+    def test_summary_and_metabolites_are_fetched_together(self):
+        # both requests must be in flight at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=2)
+
+        class Session:
+            def get(self, url, **kwargs):
+                barrier.wait()
+                if url.endswith('/summary'):
+                    return DummyResponse(json_data={'study_id': 'ST_CONCURRENT'})
+                return DummyResponse(json_data={'1': {'analysis_id': 'AN1', 'metabolite_name': 'glucose'}})
+
+        data, resp_code = metabolomics_workbench_get_study_details(study_id='ST_CONCURRENT', api_session=Session())
+        self.assertEqual(resp_code, 200)
+        self.assertEqual(data['assays'][0]['1']['metadata']['reported_metabolite_name'], 'glucose')
+
+    def test_summary_error_wins(self):
+        class Session:
+            def get(self, url, **kwargs):
+                if url.endswith('/summary'):
+                    return DummyResponse(ok=False, status_code=404)
+                return DummyResponse(ok=False, status_code=503)
+
+        data, resp_code = metabolomics_workbench_get_study_details(study_id='ST_MISSING', api_session=Session())
+        self.assertEqual((data, resp_code), ({}, 404))
+
+
+class StudyIndexTestCase(unittest.TestCase):
+    def test_prefix_search_and_pagination(self):
+        index = StudyIndex(['ST000003', 'ST000001', 'MTBLS1', 'ST000002', 'ST000001'])
+        self.assertEqual(len(index), 4)
+        self.assertIn('ST000002', index)
+        self.assertNotIn('ST9', index)
+
+        page, cursor = index.search(prefix='st', limit=2)
+        self.assertEqual((page, cursor), (['ST000001', 'ST000002'], 'ST000002'))
+        page, cursor = index.search(prefix='st', limit=2, cursor=cursor)
+        self.assertEqual((page, cursor), (['ST000003'], None))
+        self.assertEqual(index.search(prefix='X'), ([], None))
+
+
+class StudyListRefresherTestCase(unittest.TestCase):
+    def test_last_good_copy_is_served_while_upstream_fails(self):
+        responses = [[('MTBLS1', 'MTBLS1')], []]
+
+        def fetch(source):
+            return responses.pop(0) if responses else []
+
+        refresher = StudyListRefresher(api_session=None, fetch=fetch, interval=3600)
+        self.assertTrue(refresher.refresh('metabolights'))
+        self.assertFalse(refresher.refresh('metabolights'))
+        self.assertEqual(refresher.get('metabolights'), [('MTBLS1', 'MTBLS1')])
+
+    def test_expired_list_is_refreshed_by_one_caller(self):
+        calls = []
+        release = threading.Event()
+
+        def fetch(source):
+            calls.append(source)
+            if len(calls) > 1:
+                release.wait(2)
+            return [(f'MTBLS{len(calls)}', f'MTBLS{len(calls)}')]
+
+        refresher = StudyListRefresher(api_session=None, fetch=fetch, interval=3600)
+        self.assertEqual(refresher.get('metabolights'), [('MTBLS1', 'MTBLS1')])
+        refresher._lists['metabolights'] = (refresher._lists['metabolights'][0], 0)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(refresher.get('metabolights'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # the callers that find a refresh running are served the expired copy
+        deadline = time.time() + 2
+        while len(results) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results.count([('MTBLS1', 'MTBLS1')]), 4)
+        self.assertEqual(refresher.get('metabolights'), [('MTBLS2', 'MTBLS2')])
+
+    def test_background_warm_up(self):
+        refresher = StudyListRefresher(api_session=None, fetch=lambda source: [(source, source)], interval=3600)
+        refresher.start()
+        try:
+            self.assertEqual(refresher.get('workbench', wait=2), [('workbench', 'workbench')])
+            self.assertEqual(refresher.get('metabobank', wait=2), [('metabobank', 'metabobank')])
+        finally:
+            refresher.stop()
+
+    def test_form_submission_does_not_wait_for_a_cold_list(self):
+        release = threading.Event()
+
+        def fetch(source):
+            release.wait(2)
+            return [(source, source)]
+
+        refresher = StudyListRefresher(api_session=None, fetch=fetch, interval=3600)
+        refresher.start()
+        try:
+            started = time.time()
+            self.assertEqual(refresher.get('metabolights'), [])
+            self.assertLess(time.time() - started, 0.5)
+        finally:
+            release.set()
+            refresher.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bs4 import BeautifulSoup
+
+from autoindex import AutoindexEntry, parse_autoindex, size_in_bytes
+
+TABLE_LISTING = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html>
+ <head>
+  <title>Index of /public/metabobank/study/MTBKS6</title>
+ </head>
+ <body>
+<h1>Index of /public/metabobank/study/MTBKS6</h1>
+  <table>
+   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+   <tr><th colspan="4"><hr></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/public/metabobank/study/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a href="OtherData/">OtherData/</a></td><td align="right">2021-03-04 12:01  </td><td align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td><td><a href="MTBKS6.idf.txt">MTBKS6.idf.txt</a></td><td align="right">2021-03-04 12:00  </td><td align="right">4.2K</td></tr>
+<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td><td><a href="a&amp;b.cdf">a&amp;b.cdf</a></td><td align="right">2021-03-05 08:30  </td><td align="right">1.5M</td></tr>
+   <tr><th colspan="4"><hr></th></tr>
+</table>
+</body></html>
+"""
+
+PRE_LISTING = """<html>
+<head><title>Index of /public/metabobank/study/</title></head>
+<body>
+<h1>Index of /public/metabobank/study/</h1><pre><img src="/icons/blank.gif" alt="Icon "> <a href="?C=N;O=D">Name</a>                    <a href="?C=M;O=A">Last modified</a>      <a href="?C=S;O=A">Size</a>
+<hr><img src="/icons/back.gif" alt="[PARENTDIR]"> <a href="/public/metabobank/">Parent Directory</a>                             -
+<img src="/icons/folder.gif" alt="[DIR]"> <a href="MTBKS1/">MTBKS1/</a>                 2020-01-10 09:15    -
+<img src="/icons/folder.gif" alt="[DIR]"> <a href='MTBKS2/'>MTBKS2/</a>                 10-Jan-2020 09:16    -
+<img src="/icons/text.gif" alt="[TXT]"> <a href="README.txt">README.txt</a>              2020-01-09 18:00  512
+<hr></pre>
+</body></html>
+"""
+
+
+class AutoindexTestCase(unittest.TestCase):
+    def assert_same_hrefs_as_beautifulsoup(self, listing):
+        soup = BeautifulSoup(listing, "html.parser")
+        expected = [link.get("href") for link in soup.find_all("a") if link.get("href")]
+        self.assertEqual([entry.href for entry in parse_autoindex(listing)], expected)
+
+    def test_table_layout(self):
+        self.assert_same_hrefs_as_beautifulsoup(TABLE_LISTING)
+        entries = {entry.href: entry for entry in parse_autoindex(TABLE_LISTING)}
+        self.assertEqual(entries['OtherData/'], AutoindexEntry('OtherData/', '2021-03-04 12:01', None))
+        self.assertEqual(entries['MTBKS6.idf.txt'], AutoindexEntry('MTBKS6.idf.txt', '2021-03-04 12:00', '4.2K'))
+        self.assertEqual(entries['a&b.cdf'].size, '1.5M')
+        self.assertIsNone(entries['?C=N;O=D'].last_modified)
+
+    def test_pre_layout(self):
+        self.assert_same_hrefs_as_beautifulsoup(PRE_LISTING)
+        entries = {entry.href: entry for entry in parse_autoindex(PRE_LISTING)}
+        self.assertEqual(entries['MTBKS1/'], AutoindexEntry('MTBKS1/', '2020-01-10 09:15', None))
+        self.assertEqual(entries['MTBKS2/'].last_modified, '10-Jan-2020 09:16')
+        self.assertEqual(entries['README.txt'].size, '512')
+
+    def test_size_in_bytes(self):
+        self.assertEqual(size_in_bytes('512'), 512)
+        self.assertEqual(size_in_bytes('1.5K'), 1536)
+        self.assertIsNone(size_in_bytes(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,343 @@
+import os
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cache import LRUCache, RedisCache, SQLiteCache, create_cache
+from fragment_cache import FragmentCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_lru_eviction_by_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1, ttl=60)
+        cache.set('b', 2, ttl=60)
+        cache.get('a')
+        cache.set('c', 3, ttl=60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_by_bytes(self):
+        cache = LRUCache(max_bytes=10000)
+        cache.set('a', 'x' * 6000, ttl=60)
+        cache.set('b', 'y' * 6000, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        self.assertLessEqual(cache.stats()['bytes'], 10000)
+
+    def test_ttl_expiry(self):
+        cache = LRUCache()
+        cache.set('a', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_single_flight(self):
+        cache = LRUCache()
+        calls = []
+        barrier = threading.Event()
+
+        def loader():
+            calls.append(1)
+            barrier.wait(1)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader, ttl=60)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        barrier.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_negative_and_error_results(self):
+        cache = LRUCache()
+        cache.get_or_load('empty', lambda: [], ttl=60, negative_ttl=0.01, is_negative=lambda v: not v)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('empty'))
+
+        def failing():
+            raise ValueError('upstream down')
+
+        with self.assertRaises(ValueError):
+            cache.get_or_load('err', failing, ttl=60, error_ttl=60)
+        with self.assertRaises(ValueError):
+            cache.get_or_load('err', lambda: 'never called', ttl=60, error_ttl=60)
+
+
+class Status(bytes):
+    """
+    A status (or error, if it starts with '-') reply of the stand-in Redis server.
+    """
+
+
+def glob_pattern(pattern: bytes):
+    """
+    :return: the regular expression of a Redis glob pattern with '*', '?' and backslash escapes
+    """
+    parts = re.findall(rb'\\.|.', pattern, re.S)
+    return re.compile(b''.join(b'.*' if part == b'*' else b'.' if part == b'?' else re.escape(part[-1:])
+                               for part in parts), re.S)
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """
+    In-memory server answering the subset of the Redis protocol used by RedisCache.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RedisStandInHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def get(self, key):
+        # must be called with the lock held
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, name: str, args: list):
+        self.commands.append(name)
+        with self.lock:
+            if name == 'PING':
+                return Status(b'+PONG')
+            if name == 'SELECT':
+                return Status(b'+OK')
+            if name == 'GET':
+                return self.get(args[0])
+            if name == 'GETRANGE':
+                value = self.get(args[0]) or b''
+                return value[int(args[1]):int(args[2]) + 1]
+            if name == 'EXISTS':
+                return sum(self.get(key) is not None for key in args)
+            if name == 'SET':
+                key, value, options = args[0], args[1], [el.upper() for el in args[2:]]
+                if b'NX' in options and self.get(key) is not None:
+                    return None
+                expires_at = None
+                if b'PX' in options:
+                    expires_at = time.monotonic() + int(options[options.index(b'PX') + 1]) / 1000
+                self.data[key] = value, expires_at
+                return Status(b'+OK')
+            if name == 'DEL':
+                return sum(self.data.pop(key, None) is not None for key in args)
+            if name == 'SCAN':
+                pattern = glob_pattern(args[args.index(b'MATCH') + 1])
+                return [b'0', [key for key in list(self.data) if pattern.fullmatch(key) and self.get(key) is not None]]
+            return Status(b'-ERR unknown command')
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.encode(self.server.execute(args[0].decode().upper(), args[1:])))
+
+    def encode(self, reply) -> bytes:
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, list):
+            return b'*%d\r\n' % len(reply) + b''.join(self.encode(el) for el in reply)
+        if isinstance(reply, Status):
+            return reply + b'\r\n'
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class SharedCacheTests:
+    """
+    Tests run against each shared backend; two cache objects on the same store stand for two worker processes.
+    """
+
+    def make_cache(self, **kwargs):
+        raise NotImplementedError
+
+    def test_values_are_shared(self):
+        first, second = self.make_cache(), self.make_cache()
+        first.set('study', {'title': 'Shared', 'assays': [('a', 1)]}, ttl=60)
+        self.assertEqual(second.get('study'), {'title': 'Shared', 'assays': [('a', 1)]})
+        self.assertIn('study', second)
+        self.assertNotIn('other', second)
+        self.assertEqual(second.stats()['hits'], 1)
+
+    def test_local_copies_follow_the_store(self):
+        first, second = self.make_cache(), self.make_cache()
+        first.set('study', {'version': 1}, ttl=60)
+        copy = second.get('study')
+        self.assertIs(second.get('study'), copy)
+        first.set('study', {'version': 2}, ttl=60)
+        self.assertEqual(second.get('study'), {'version': 2})
+        first.delete('study')
+        self.assertIsNone(second.get('study'))
+
+    def test_ttl_expiry(self):
+        cache = self.make_cache()
+        cache.set('a', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache)
+
+    def test_errors_are_shared(self):
+        first, second = self.make_cache(), self.make_cache()
+
+        def failing():
+            raise ValueError('upstream down')
+
+        with self.assertRaises(ValueError):
+            first.get_or_load('err', failing, ttl=60, error_ttl=60)
+        with self.assertRaises(ValueError):
+            second.get_or_load('err', lambda: 'never called', ttl=60, error_ttl=60)
+
+    def test_one_load_across_processes(self):
+        caches = [self.make_cache() for _ in range(3)]
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.2)
+            return ['MTBLS1', 'MTBLS2']
+
+        results = []
+        threads = [threading.Thread(target=lambda c=cache: results.append(c.get_or_load('studies', loader, ttl=60)))
+                   for cache in caches for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['MTBLS1', 'MTBLS2']] * 6)
+
+    def test_delete_prefix(self):
+        cache = self.make_cache()
+        cache.set('study:a[1]', 1, ttl=60)
+        cache.set('study:a[1]*', 2, ttl=60)
+        cache.set('study:b', 3, ttl=60)
+        self.assertEqual(cache.delete_prefix('study:a[1]'), 2)
+        self.assertIsNone(cache.get('study:a[1]'))
+        self.assertEqual(cache.get('study:b'), 3)
+        cache.clear()
+        self.assertIsNone(cache.get('study:b'))
+
+    def test_unpicklable_values_are_not_stored(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.get_or_load('lock', threading.Lock, ttl=60).__class__, threading.Lock().__class__)
+        self.assertNotIn('lock', cache)
+
+
+class SQLiteCacheTestCase(SharedCacheTests, unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='metabolomics-test-shared-cache-'), 'cache.sqlite3')
+
+    def make_cache(self, **kwargs):
+        return SQLiteCache(self.path, **kwargs)
+
+    def test_least_recently_read_entries_are_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        cache.set('a', 1, ttl=60)
+        cache.set('b', 2, ttl=60)
+        cache.ACCESS_RESOLUTION = 0
+        cache.get('a')
+        cache.set('c', 3, ttl=60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+class RedisCacheTestCase(SharedCacheTests, unittest.TestCase):
+    def setUp(self):
+        self.server = RedisStandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_cache(self, **kwargs):
+        return RedisCache(self.server.url, **kwargs)
+
+    def test_entries_are_namespaced(self):
+        self.make_cache().set('a', 1, ttl=60)
+        self.assertEqual(list(self.server.data), [b'metabolomics:entry:a'])
+
+    def test_unavailable_server_is_a_miss(self):
+        cache = RedisCache('redis://127.0.0.1:1/0', timeout=0.5)
+        self.assertEqual(cache.get_or_load('a', lambda: 'loaded', ttl=60), 'loaded')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class CreateCacheTestCase(unittest.TestCase):
+    def test_backends(self):
+        self.assertIsInstance(create_cache('memory'), LRUCache)
+        self.assertFalse(create_cache('memory').shared)
+        path = os.path.join(tempfile.mkdtemp(prefix='metabolomics-test-shared-cache-'), 'cache.sqlite3')
+        self.assertIsInstance(create_cache('sqlite', sqlite_path=path), SQLiteCache)
+        self.assertEqual(create_cache(f"sqlite:{path}").path, path)
+        cache = create_cache('redis://:secret@cache.local:6380/2')
+        self.assertEqual((cache.host, cache.port, cache.password, cache.db), ('cache.local', 6380, 'secret', 2))
+        with self.assertRaises(ValueError):
+            create_cache('memcached://localhost')
+
+
+class FragmentCacheTestCase(unittest.TestCase):
+    def test_fragments_are_isolated_per_token(self):
+        cache = FragmentCache()
+        render = lambda text: (lambda: text)
+        self.assertEqual(cache.get_or_render('metabolights', 'MTBLS1', 'v1', 'page', render('anonymous')), 'anonymous')
+        self.assertEqual(cache.get_or_render('metabolights', 'MTBLS1', 'v1', 'page', render('alice'),
+                                             api_token='token-a'), 'alice')
+        self.assertEqual(cache.get_or_render('metabolights', 'MTBLS1', 'v1', 'page', render('bob'),
+                                             api_token='token-b'), 'bob')
+        self.assertEqual(cache.get_or_render('metabolights', 'MTBLS1', 'v1', 'page', render('other')), 'anonymous')
+
+    def test_new_version_invalidates_the_study(self):
+        cache = FragmentCache()
+        cache.get_or_render('workbench', 'ST1', 'v1', 'page', lambda: 'old')
+        cache.get_or_render('workbench', 'ST10', 'v1', 'page', lambda: 'other study')
+        self.assertEqual(cache.get_or_render('workbench', 'ST1', 'v2', 'page', lambda: 'new'), 'new')
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.get_or_render('workbench', 'ST10', 'v1', 'page', lambda: 'missed'), 'other study')
+
+    def test_uncacheable_fragments_are_rendered_again(self):
+        cache = FragmentCache()
+        calls = []
+
+        def render():
+            calls.append(1)
+            return 'page', 502
+
+        for _ in range(2):
+            cache.get_or_render('metabolights', 'MTBLS1', 'v1', 'page', render, cacheable=lambda f: f[1] == 200)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
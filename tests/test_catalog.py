@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('METABOLOMICS_CACHE_DIR', tempfile.mkdtemp(prefix='metabolomics-test-cache-'))
+os.environ.setdefault('METABOLOMICS_WARMUP', '0')
+
+from catalog import StudyCatalog
+from mirror import sync_source
+import study_sections
+
+
+class StudyCatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.catalog = StudyCatalog(os.path.join(self.directory.name, 'catalog.sqlite3'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store(self):
+        self.assertEqual(self.catalog.add_ids('metabolights', ['MTBLS1', 'MTBLS2']), 2)
+        self.assertEqual(self.catalog.add_ids('metabolights', ['MTBLS2', 'MTBLS3']), 1)
+        self.assertIsNone(self.catalog.get('metabolights', 'MTBLS1'))
+
+        self.catalog.put('metabolights', 'MTBLS1', {'title': 'A study'}, 'v1')
+        self.assertEqual(self.catalog.get('metabolights', 'MTBLS1'), ({'title': 'A study'}, 'v1'))
+        # a failed refresh keeps the mirrored details
+        self.catalog.mark_error('metabolights', 'MTBLS1', 503)
+        self.catalog.mark_error('metabolights', 'MTBLS2', 404)
+        self.assertEqual(self.catalog.get('metabolights', 'MTBLS1'), ({'title': 'A study'}, 'v1'))
+        self.assertEqual(self.catalog.stats(), {'metabolights': {'ok': 1, 'error': 1, 'pending': 1}})
+
+    def test_sync_is_incremental_and_resumable(self):
+        listed = ['ST1', 'ST2', 'ST3']
+        fetched, failures = [], ['ST2']
+
+        def fetch_study(source, study_id, api_session, known_version):
+            fetched.append(study_id)
+            if study_id in failures:
+                failures.remove(study_id)
+                raise ConnectionError("interrupted")
+            if known_version == 'v1':
+                return 'unchanged', None, 'v1', 200
+            return 'ok', {'study_id': study_id}, 'v1', 200
+
+        sync = lambda **kwargs: sync_source(self.catalog, 'workbench', None, fetch_ids=lambda *args: listed,
+                                            fetch_study=fetch_study, max_workers=2, **kwargs)
+        self.assertEqual(sync(), {'added': 3, 'ok': 2, 'unchanged': 0, 'error': 1})
+
+        # only the failed study and the new one are fetched again
+        listed.append('ST4')
+        fetched.clear()
+        self.assertEqual(sync(), {'added': 1, 'ok': 2, 'unchanged': 0, 'error': 0})
+        self.assertEqual(sorted(fetched), ['ST2', 'ST4'])
+
+        fetched.clear()
+        self.assertEqual(sync(revalidate=True), {'added': 0, 'ok': 0, 'unchanged': 4, 'error': 0})
+        self.assertEqual(self.catalog.get('workbench', 'ST4'), ({'study_id': 'ST4'}, 'v1'))
+
+    def test_study_pages_are_served_from_the_catalog(self):
+        self.catalog.put('workbench', 'ST000001', {'study_title': 'Mirrored'}, 'v1')
+        with mock.patch.object(study_sections, 'get_catalog', return_value=self.catalog), \
+                mock.patch.object(study_sections, 'get_study_details') as get_study_details:
+            data, resp_code = study_sections.get_study_data.__wrapped__('workbench', 'ST000001', None)
+            self.assertEqual((data.summary, data.version, resp_code), ({'study_title': 'Mirrored'}, 'v1', 200))
+            get_study_details.assert_not_called()
+
+            with mock.patch.object(study_sections, 'CATALOG_MODE', 'fallback'):
+                get_study_details.return_value = ({}, 503)
+                data, resp_code = study_sections.get_study_data.__wrapped__('workbench', 'ST000001', None)
+                self.assertEqual((data.summary, resp_code), ({'study_title': 'Mirrored'}, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
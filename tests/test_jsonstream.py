@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from jsonstream import ANY, iter_values
+from utils import metabolights_fetch_metadata_and_raw_files, metabolights_parse_study_content
+
+STUDY = {
+    'content': {
+        'sampleTable': {'fields': {'a': 1}, 'data': [['x ]}"[{', 'y\\"'], [1.5e3, None, True]]},
+        'title': 'Study é ☃ title',
+        'assays': [
+            {
+                'assayNumber': 1,
+                'measurement': 'metabolite profiling',
+                'technology': 'mass spectrometry',
+                'platform': 'LC-MS',
+                'fileName': 'a_assay.txt',
+                'assayTable': {
+                    'fields': {'Raw Spectral Data File': 0},
+                    'data': [['FILES/raw1.mzML', 'S1', '12'], ['FILES/raw2.mzML', 'S2', '']],
+                },
+                'metaboliteAssignment': {'metaboliteAssignmentFileName': 'm.tsv',
+                                         'metaboliteAssignmentLines': [{'metabolite_identification': 'glucose'}]},
+            },
+            {
+                'assayNumber': 2,
+                'measurement': 'm',
+                'technology': 't',
+                'platform': 'p',
+                'fileName': 'b.txt',
+                'assayTable': {'data': []},
+            },
+        ],
+        'description': 'A "quoted" description',
+        'protocols': [{'name': '{not a bracket}'}],
+    }
+}
+
+
+def chunked(document: bytes, size: int):
+    return [document[start:start + size] for start in range(0, len(document), size)]
+
+
+class IterValuesTestCase(unittest.TestCase):
+    def test_selected_values_in_document_order(self):
+        document = json.dumps(STUDY, ensure_ascii=False).encode()
+        for size in (1, 3, 64, len(document)):
+            values = list(iter_values(chunked(document, size), [('content', 'title'), ('content', 'assays', ANY,
+                                                                                         'assayTable', 'data', ANY)]))
+            self.assertEqual(values, [
+                (('content', 'title'), STUDY['content']['title']),
+                (('content', 'assays', 0, 'assayTable', 'data', 0), ['FILES/raw1.mzML', 'S1', '12']),
+                (('content', 'assays', 0, 'assayTable', 'data', 1), ['FILES/raw2.mzML', 'S2', '']),
+            ], f"chunk size {size}")
+
+    def test_numbers_split_across_chunks(self):
+        values = list(iter_values([b'{"a": [12', b'34, 5', b'6.7', b'e1]}'], [('a', ANY)]))
+        self.assertEqual([value for _, value in values], [1234, 56.7e1])
+
+    def test_truncated_document(self):
+        with self.assertRaises(ValueError):
+            list(iter_values([b'{"content": ["MTBLS1", "MTBL'], [('content', ANY)]))
+
+
+class MetabolightsParseStudyContentTestCase(unittest.TestCase):
+    def test_same_result_as_full_parse(self):
+        document = json.dumps(STUDY).encode()
+        content = metabolights_parse_study_content(chunked(document, 7))
+        self.assertNotIn('sampleTable', content)
+        self.assertEqual(metabolights_fetch_metadata_and_raw_files(content),
+                         metabolights_fetch_metadata_and_raw_files(STUDY['content']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metabolite_index import MetaboliteIndex, normalize_name, study_metabolite_names
+
+
+class MetaboliteIndexTestCase(unittest.TestCase):
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('L-Glutamic  Acid'), 'l glutamic acid')
+        self.assertEqual(normalize_name('β-Alanine'), 'β alanine')
+        self.assertEqual(normalize_name('Caféine'), 'cafeine')
+        self.assertEqual(normalize_name('PC(16:0/18:1)'), 'pc 16 0 18 1')
+
+    def test_prefix_and_word_matching(self):
+        index = MetaboliteIndex()
+        index.update_study('metabolights', 'MTBLS1', 'v1', ['D-Glucose', 'L-Alanine'])
+        index.update_study('workbench', 'ST000002', 'v1', ['glucose', 'Glucosamine'])
+
+        results, _, total = index.search('GLUC')
+        self.assertEqual(total, 2)
+        self.assertEqual(results[1], {'source': 'workbench', 'study_id': 'ST000002',
+                                      'names': ['Glucosamine', 'glucose']})
+        self.assertEqual([hit['study_id'] for hit in index.search('d-glucose')[0]], ['MTBLS1'])
+        self.assertEqual(index.search('glucose', source='workbench')[2], 1)
+        self.assertEqual(index.search('g'), ([], None, 0))
+
+    def test_incremental_updates_and_pagination(self):
+        index = MetaboliteIndex()
+        for i in range(5):
+            index.update_study('workbench', f'ST{i:06d}', 'v1', ['Citrate'])
+        page, cursor, total = index.search('citr', limit=2)
+        self.assertEqual(([hit['study_id'] for hit in page], cursor, total), (['ST000000', 'ST000001'], '2', 5))
+        self.assertEqual(index.search('citr', limit=2, cursor='4')[0][0]['study_id'], 'ST000004')
+
+        # a refreshed study replaces its names, an unchanged version is skipped
+        self.assertFalse(index.update_study('workbench', 'ST000000', 'v1', ['Lactate']))
+        self.assertTrue(index.update_study('workbench', 'ST000000', 'v2', ['Lactate']))
+        self.assertEqual(index.search('citrate')[2], 4)
+        index.remove_study('workbench', 'ST000000')
+        self.assertEqual(index.search('lact')[2], 0)
+        self.assertEqual(index.stats(), {'studies': 4, 'keys': 1})
+
+    def test_study_metabolite_names(self):
+        metadata = {'reported_metabolite_name': 'citrate', 'refmet_name': 'Citric acid'}
+        workbench = {'assays': [{'1': {'metadata': metadata}}]}
+        self.assertEqual(study_metabolite_names('workbench', workbench), {'citrate', 'Citric acid'})
+        metabolights = {'assays': [{1: {'reported_metabolite_names': ['alanine', '']}}]}
+        self.assertEqual(study_metabolite_names('metabolights', metabolights), {'alanine'})
+
+
+if __name__ == '__main__':
+    unittest.main()
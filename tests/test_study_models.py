@@ -0,0 +1,124 @@
+import gc
+import json
+import os
+import pickle
+import sys
+import tracemalloc
+import unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from study_models import FileRows, MetabobankStudy, MetabolightsStudy, StringColumn, WorkbenchStudy, study_model
+
+
+def metabolights_study(assays: int = 2, rows: int = 3) -> dict:
+    return {
+        'title': 'Compact study',
+        'description': 'Parsed once',
+        'assays': [{number: {
+            'metadata': {'measurement': 'metabolite profiling', 'technology': 'mass spectrometry',
+                         'platform': 'Q Exactive', 'assay_number': number, 'file_name': f"a_assay{number}.txt"},
+            'reported_metabolite_names': ['glucose', 'alanine'],
+            'raw_data_file_names': [[f"raw{r}.mzML", 'blank.mzML'] for r in range(rows)],
+        }} for number in range(1, assays + 1)],
+    }
+
+
+def workbench_study(records: int = 3) -> dict:
+    return {
+        'study_id': 'ST000001',
+        'study_title': 'Compact study',
+        'assays': [{str(i): {'metadata': {'analysis_id': 'AN000001', 'analysis_summary': 'LC-MS positive',
+                                          'reported_metabolite_name': f"metabolite {i}",
+                                          'refmet_name': f"refmet {i}"}}}
+                   for i in range(1, records + 1)],
+    }
+
+
+def retained_memory(source: str, document: str):
+    """
+    :return: bytes retained by a study decoded from JSON, and by its model once the decoded study is dropped
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        data = json.loads(document)
+        parsed = tracemalloc.get_traced_memory()[0]
+        model = study_model(source, data)
+        del data
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+        del model
+        return parsed, retained
+    finally:
+        tracemalloc.stop()
+
+
+class StringColumnTestCase(unittest.TestCase):
+    def test_sequence(self):
+        column = StringColumn(['FILES/a.mzML', '', 'bé.raw'])
+        self.assertEqual(len(column), 3)
+        self.assertEqual(list(column), ['FILES/a.mzML', '', 'bé.raw'])
+        self.assertEqual((column[0], column[1], column[-1]), ('FILES/a.mzML', '', 'bé.raw'))
+        self.assertEqual(column[1:], ['', 'bé.raw'])
+        self.assertEqual(column[5:7], [])
+        with self.assertRaises(IndexError):
+            column[3]
+        self.assertFalse(StringColumn())
+
+
+class FileRowsTestCase(unittest.TestCase):
+    def test_shapes(self):
+        rows = [['a.mzML', 'b.mzML'], [], ['a.mzML']]
+        file_rows = FileRows(rows)
+        self.assertEqual(len(file_rows), 3)
+        self.assertEqual(file_rows.reshape('rows'), rows)
+        self.assertEqual(list(file_rows.reshape('flat')), ['a.mzML', 'b.mzML', 'a.mzML'])
+        self.assertEqual(file_rows.reshape('unique'), ['a.mzML', 'b.mzML'])
+        with self.assertRaises(ValueError):
+            file_rows.reshape('columns')
+
+
+class StudyModelsTestCase(unittest.TestCase):
+    def test_metabolights_study(self):
+        study = study_model('metabolights', metabolights_study(), version='v1')
+        self.assertIsInstance(study, MetabolightsStudy)
+        self.assertEqual((study.title, study.version), ('Compact study', 'v1'))
+        assay = study.assay('2')
+        self.assertEqual(assay.metadata()['file_name'], 'a_assay2.txt')
+        self.assertEqual(assay.metabolite_names, ('glucose', 'alanine'))
+        self.assertEqual(assay.raw_files.reshape('rows')[1], ['raw1.mzML', 'blank.mzML'])
+        # repeated strings are shared between the assays
+        self.assertIs(study.assays[0].platform, study.assays[1].platform)
+        with self.assertRaises(LookupError):
+            study.assay('3')
+
+    def test_workbench_study(self):
+        study = study_model('workbench', workbench_study(), version='v1')
+        self.assertIsInstance(study, WorkbenchStudy)
+        self.assertEqual(study.summary, {'study_id': 'ST000001', 'study_title': 'Compact study'})
+        records = list(study.records())
+        self.assertEqual(records[2], {'analysis_id': 'AN000001', 'analysis_summary': 'LC-MS positive',
+                                      'reported_metabolite_name': 'metabolite 3', 'refmet_name': 'refmet 3',
+                                      'assay_number': '3'})
+        self.assertIs(study.analysis_ids[0], study.analysis_ids[2])
+
+    def test_metabobank_study(self):
+        study = study_model('metabobank', {'results_files': ['r.txt'], 'raw_files': []})
+        self.assertIsInstance(study, MetabobankStudy)
+        self.assertEqual((list(study.results_files), list(study.raw_files)), (['r.txt'], []))
+
+    def test_models_are_picklable(self):
+        study = study_model('metabolights', metabolights_study(), version='v1')
+        copy = pickle.loads(pickle.dumps(study, protocol=5))
+        self.assertEqual(copy.version, 'v1')
+        self.assertEqual(copy.assay('1').raw_files.reshape('rows'), study.assay('1').raw_files.reshape('rows'))
+
+    def test_models_are_smaller_than_the_parsed_dictionaries(self):
+        # see benchmarks/bench_study_memory.py for realistic studies
+        for source, data in (('metabolights', metabolights_study(assays=4, rows=500)),
+                             ('workbench', workbench_study(records=1000))):
+            parsed, model = retained_memory(source, json.dumps(data))
+            self.assertLess(model, parsed / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
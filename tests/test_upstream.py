@@ -0,0 +1,130 @@
+import os
+import sys
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import requests
+
+from metrics import UPSTREAM_LATENCY, UPSTREAM_RESPONSES
+from upstream import RECORDED_BODY_MEMORY, CircuitOpenError, RecordedResponse, UpstreamSession, replaying, request_key
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class UpstreamSessionTestCase(unittest.TestCase):
+    def make_session(self, **kwargs):
+        kwargs.setdefault('backoff_base', 0)
+        return UpstreamSession(**kwargs)
+
+    def test_default_timeout_is_applied(self):
+        session = self.make_session()
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(200)) as request:
+            session.get("https://www.ebi.ac.uk/metabolights/ws/studies")
+        self.assertEqual(request.call_args.kwargs['timeout'], session.timeout)
+
+    def test_retries_transient_failures(self):
+        session = self.make_session(max_retries=2)
+        outcomes = [requests.exceptions.ConnectionError("reset"), FakeResponse(503), FakeResponse(200)]
+        with mock.patch.object(requests.Session, 'request', side_effect=outcomes) as request:
+            response = session.get("https://ddbj.nig.ac.jp/public/metabobank/study/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+
+    def test_retries_are_bounded(self):
+        session = self.make_session(max_retries=1)
+        with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ReadTimeout()) as request:
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                session.get("https://ddbj.nig.ac.jp/public/metabobank/study/")
+        self.assertEqual(request.call_count, 2)
+
+    def test_attempts_are_measured_per_host(self):
+        session = self.make_session(max_retries=1)
+        host = 'metrics.example.org'
+        latencies = UPSTREAM_LATENCY.count(host=host)
+        with mock.patch.object(requests.Session, 'request', side_effect=[FakeResponse(503), FakeResponse(200)]):
+            session.get(f"https://{host}/study")
+        self.assertEqual(UPSTREAM_LATENCY.count(host=host), latencies + 2)
+        self.assertEqual(UPSTREAM_RESPONSES.value(host=host, status=503), 1)
+        self.assertEqual(UPSTREAM_RESPONSES.value(host=host, status=200), 1)
+
+    def test_host_overrides_keep_the_upstream_host(self):
+        session = self.make_session(host_overrides={'ddbj.nig.ac.jp': 'http://127.0.0.1:8003'})
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(200)) as request:
+            session.get("https://ddbj.nig.ac.jp/public/metabobank/study/?C=N;O=D")
+        self.assertEqual(request.call_args.args[1], "http://127.0.0.1:8003/public/metabobank/study/?C=N;O=D")
+        self.assertIn('ddbj.nig.ac.jp', session.breakers)
+
+    def test_post_is_not_retried(self):
+        session = self.make_session(max_retries=2)
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(503)) as request:
+            response = session.post("https://www.ebi.ac.uk/metabolights/ws/auth/login")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(request.call_count, 1)
+
+    def test_circuit_breaker_fails_fast(self):
+        session = self.make_session(max_retries=0, failure_threshold=2, reset_timeout=60)
+        with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ConnectTimeout()) as request:
+            for _ in range(2):
+                with self.assertRaises(requests.exceptions.ConnectTimeout):
+                    session.get("https://www.metabolomicsworkbench.org/rest/study/study_id/ST/summary")
+            with self.assertRaises(CircuitOpenError):
+                session.get("https://www.metabolomicsworkbench.org/rest/study/study_id/ST000001/summary")
+        self.assertEqual(request.call_count, 2)
+
+        # other hosts are not affected
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(200)):
+            self.assertEqual(session.get("https://www.ebi.ac.uk/metabolights/ws/studies").status_code, 200)
+
+    def test_server_errors_open_the_circuit_without_retries(self):
+        session = self.make_session(max_retries=2, failure_threshold=2, reset_timeout=60)
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(500)) as request:
+            for _ in range(2):
+                self.assertEqual(session.get("https://www.ebi.ac.uk/metabolights/ws/studies").status_code, 500)
+            with self.assertRaises(CircuitOpenError):
+                session.get("https://www.ebi.ac.uk/metabolights/ws/studies")
+        self.assertEqual(request.call_count, 2)
+
+    def test_circuit_half_opens_after_reset_timeout(self):
+        session = self.make_session(max_retries=0, failure_threshold=1, reset_timeout=0)
+        with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ConnectionError()):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                session.get("https://ddbj.nig.ac.jp/public/metabobank/study/")
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(200)):
+            self.assertEqual(session.get("https://ddbj.nig.ac.jp/public/metabobank/study/").status_code, 200)
+        self.assertEqual(session.breaker('ddbj.nig.ac.jp').state, 'closed')
+
+    def test_recorded_responses_are_replayed(self):
+        session = self.make_session()
+        url = "https://www.ebi.ac.uk/metabolights/ws/studies/MTBLS1/download"
+        body = b"x" * (RECORDED_BODY_MEMORY + 10)
+        recorded = RecordedResponse(f"{url}?file=a.txt", status_code=200, headers={'ETag': '"v1"'})
+        for start in range(0, len(body), 4096):
+            recorded.write(body[start:start + 4096])
+        failed = RecordedResponse(f"{url}?file=b.txt", error=requests.exceptions.ReadTimeout())
+        responses = {request_key('GET', url, {'file': 'a.txt'}): recorded,
+                     request_key('GET', url, {'file': 'b.txt'}): failed}
+
+        with mock.patch.object(requests.Session, 'request', return_value=FakeResponse(200)) as request:
+            with replaying(responses):
+                for _ in range(2):
+                    response = session.get(url, params={'file': 'a.txt'}, stream=True)
+                    self.assertEqual(response.headers['etag'], '"v1"')
+                    self.assertEqual(b"".join(response.iter_content(65536)), body)
+                    response.close()
+                with self.assertRaises(requests.exceptions.ReadTimeout):
+                    session.get(url, params={'file': 'b.txt'})
+                session.get(url, params={'file': 'c.txt'})
+        self.assertEqual(request.call_count, 1)
+        recorded.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+import contextvars
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from logging_config import logger
+from metrics import UPSTREAM_LATENCY, UPSTREAM_RESPONSES
+from profiling import propagate, record_phase
+
+# connection pool size per upstream host
+UPSTREAM_POOL_SIZES = {
+    'www.ebi.ac.uk': 32,
+    'www.metabolomicsworkbench.org': 16,
+    'ddbj.nig.ac.jp': 32,
+}
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# recorded bodies up to this size are kept in memory, larger ones in a temporary file
+RECORDED_BODY_MEMORY = 1024 * 1024
+
+
+def parse_host_overrides(value: str) -> dict:
+    """
+    :param value: comma-separated 'host=base url' pairs,
+                  e.g. 'www.ebi.ac.uk=http://127.0.0.1:8001,ddbj.nig.ac.jp=http://127.0.0.1:8003'
+    :return: dictionary {upstream host: base url}
+    """
+    overrides = {}
+    for pair in filter(None, (el.strip() for el in (value or '').split(','))):
+        host, _, base_url = pair.partition('=')
+        overrides[host.strip()] = base_url.strip().rstrip('/')
+    return overrides
+
+
+# upstream hosts served from another address, e.g. by the stand-in servers of the load tests
+UPSTREAM_OVERRIDES = parse_host_overrides(os.environ.get('METABOLOMICS_UPSTREAM_OVERRIDES'))
+
+# upstream responses received ahead of time by the async serving mode (see aio_server.py), by request key
+_recorded = contextvars.ContextVar('recorded_responses', default=None)
+propagate(_recorded)
+
+
+def override_url(url: str, host_overrides: dict):
+    """
+    :param url: upstream url
+    :param host_overrides: dictionary {host: base url} of upstream hosts served from another address
+    :return: the upstream host (metrics and circuit breakers keep its name) and the url to send the request to
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    if host in host_overrides:
+        base = urlsplit(host_overrides[host])
+        url = urlunsplit((base.scheme, base.netloc, base.path + parts.path, parts.query, parts.fragment))
+    return host, url
+
+
+def prepare_url(url: str, params=None) -> str:
+    """
+    :return: the url with the query parameters encoded the way requests sends them
+    """
+    prepared = requests.models.PreparedRequest()
+    prepared.prepare_url(url, params)
+    return prepared.url
+
+
+def request_key(method: str, url: str, params=None) -> str:
+    """
+    :return: the method and full url identifying an upstream request among the recorded responses
+    """
+    return f"{method.upper()} {prepare_url(url, params)}"
+
+
+class RecordedResponse:
+    """
+    An upstream response, or the exception raised instead of it, received ahead of time (e.g. with non-blocking
+    I/O) and returned by UpstreamSession in place of sending the same request; it can be replayed any number
+    of times. Large bodies are spooled to a temporary file, removed by `close`.
+    """
+
+    def __init__(self, url: str, status_code: int = None, reason: str = None, headers=None,
+                 error: Exception = None):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.error = error
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def write(self, chunk: bytes):
+        if self._file is None and self._size + len(chunk) > RECORDED_BODY_MEMORY:
+            self._file = tempfile.NamedTemporaryFile(prefix='recorded-', suffix='.body')
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._chunks.append(chunk)
+        self._size += len(chunk)
+
+    def replay(self) -> requests.Response:
+        """
+        :return: a new streamable requests.Response with the recorded status, headers and body
+        :raise: the recorded exception
+        """
+        if self.error is not None:
+            raise self.error
+        response = requests.Response()
+        response.url = self.url
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        if self._file is not None:
+            self._file.flush()
+            response.raw = open(self._file.name, 'rb')
+        else:
+            response.raw = io.BytesIO(b"".join(self._chunks))
+        return response
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+@contextmanager
+def replaying(recorded: dict):
+    """
+    Answers the upstream requests of the block (and of the worker threads started with `profiling.bind`)
+    found in the recorded responses without contacting the upstream; other requests are sent as usual.
+    :param recorded: dictionary {request_key(): RecordedResponse}
+    """
+    token = _recorded.set(recorded)
+    try:
+        yield
+    finally:
+        _recorded.reset(token)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised without contacting an upstream host whose circuit breaker is open.
+    It is a ConnectionError, so callers report it like an unreachable host.
+    """
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker: after a number of consecutive failures the host is considered down and
+    requests fail fast; after the reset timeout one trial request is let through (half-open state),
+    which closes the circuit on success or opens it again on failure.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        :return: True if a request to the host may be sent now
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let one trial request through per reset timeout
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error(f"Circuit opened after {self.failures} consecutive upstream failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def is_upstream_failure(status: int) -> bool:
+    """
+    :param status: HTTP status code of an upstream response
+    :return: True if the response counts as a failure of the upstream host for its circuit breaker
+    """
+    return status >= 500 or status == 429
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, maximum: float = BACKOFF_MAX) -> float:
+    """
+    :param attempt: number of the failed attempt, starting with 0
+    :return: a "full jitter" exponential backoff delay in seconds
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class UpstreamSession(requests.Session):
+    """
+    requests.Session for the upstream archives (EBI, Metabolomics Workbench, DDBJ) with connection pools
+    sized per host, default connect/read timeouts, bounded retries of idempotent requests with jittered
+    backoff and a circuit breaker per host. It is safe to share between threads.
+    """
+
+    def __init__(self, pool_sizes: dict = None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries: int = MAX_RETRIES, backoff_base: float = BACKOFF_BASE,
+                 failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 host_overrides: dict = None):
+        """
+        :param pool_sizes: dictionary {host: maximum number of pooled connections}
+        :param timeout: default (connect, read) timeout in seconds
+        :param max_retries: maximum number of retries of a failed idempotent request
+        :param backoff_base: base of the exponential backoff between retries in seconds
+        :param failure_threshold: number of consecutive failures opening the circuit of a host
+        :param reset_timeout: number of seconds before a request is tried again on an open circuit
+        :param host_overrides: dictionary {host: base url} of upstream hosts served from another address
+        """
+        super().__init__()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.host_overrides = UPSTREAM_OVERRIDES if host_overrides is None else host_overrides
+        self.breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        pool_sizes = UPSTREAM_POOL_SIZES if pool_sizes is None else pool_sizes
+        for host, pool_size in pool_sizes.items():
+            for scheme in ('https', 'http'):
+                self.mount(f"{scheme}://{host}/", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        for host, base_url in self.host_overrides.items():
+            if host in pool_sizes:
+                self.mount(f"{base_url}/", HTTPAdapter(pool_connections=1, pool_maxsize=pool_sizes[host]))
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.breakers[host]
+
+    def request(self, method, url, **kwargs):
+        recorded = _recorded.get()
+        if recorded:
+            response = recorded.get(request_key(method, url, kwargs.get('params')))
+            if response is not None:
+                return response.replay()
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        # metrics and circuit breakers keep the name of the upstream host
+        host, url = override_url(url, self.host_overrides)
+        breaker = self.breaker(host)
+        attempts = 1 + (self.max_retries if method.upper() in IDEMPOTENT_METHODS else 0)
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                UPSTREAM_RESPONSES.inc(host=host, status='circuit_open')
+                raise CircuitOpenError(f"Upstream host {host} is unavailable (circuit open)")
+            last_attempt = attempt + 1 == attempts
+
+            started = time.perf_counter()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                elapsed = time.perf_counter() - started
+                UPSTREAM_LATENCY.observe(elapsed, host=host)
+                record_phase('upstream', elapsed)
+                UPSTREAM_RESPONSES.inc(host=host, status='error')
+                breaker.record_failure()
+                if last_attempt:
+                    raise
+                logger.info(f"Upstream request to {url} failed ({e}), retrying")
+                time.sleep(backoff_delay(attempt, self.backoff_base))
+                continue
+
+            elapsed = time.perf_counter() - started
+            UPSTREAM_LATENCY.observe(elapsed, host=host)
+            record_phase('upstream', elapsed)
+            UPSTREAM_RESPONSES.inc(host=host, status=response.status_code)
+            if is_upstream_failure(response.status_code):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+            logger.info(f"Upstream request to {url} returned {response.status_code}, retrying")
+            response.close()
+            time.sleep(backoff_delay(attempt, self.backoff_base))
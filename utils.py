@@ -1,39 +1,217 @@
 import functools
-import time
+import os
 from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
+from contextlib import closing
+from itertools import chain
+from operator import itemgetter
 import requests
 
+from autoindex import iter_autoindex, parse_autoindex
+from cache import create_cache
+from jsonstream import ANY, JSON_CHUNK_SIZE, iter_file_chunks, iter_values
 from logging_config import logger
+from metrics import METABOBANK_CRAWL_LISTINGS, METABOBANK_CRAWL_REQUESTS
+from payload_store import CACHE_DIR, payload_store
+from profiling import bind, phase, timed
 
-_cache = {}
 CACHE_EXPIRY = 3600
+NEGATIVE_CACHE_EXPIRY = 60
+ERROR_CACHE_EXPIRY = 15
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 'memory' (per process), 'sqlite' (shared by the worker processes of a host) or a redis:// url (see create_cache)
+CACHE_BACKEND = os.environ.get('METABOLOMICS_CACHE_BACKEND', 'memory')
+SHARED_CACHE_PATH = os.path.join(CACHE_DIR, "shared_cache.sqlite3")
+PAYLOAD_MAX_AGE = 3600
+METABOBANK_CRAWL_WORKERS = 8
+# extract only the needed fields of large JSON documents while they are read; METABOLOMICS_JSON_STREAMING=0 disables it
+JSON_STREAMING = os.environ.get('METABOLOMICS_JSON_STREAMING', '1') != '0'
+METABOLIGHTS_STUDY_URL = "https://www.ebi.ac.uk/metabolights/ws/studies/public/study/{study_id}"
+WORKBENCH_SUMMARY_URL = "https://www.metabolomicsworkbench.org/rest/study/study_id/{study_id}/summary"
+WORKBENCH_METABOLITES_URL = "https://www.metabolomicsworkbench.org/rest/study/study_id/{study_id}/metabolites"
+METABOLIGHTS_RESULT_FILES_URL = "https://www.ebi.ac.uk/metabolights/ws/studies/{study_id}/files?include_raw_data=false"
+METABOBANK_STUDY_URL = "https://ddbj.nig.ac.jp/public/metabobank/study/{study_id}/"
+FILES_PREFIX = 'FILES/'
+RAW_FILE_MODES = ('rows', 'flat', 'unique')
+METABOLIGHTS_STUDY_LIST_PATHS = [('content', ANY)]
+WORKBENCH_STUDY_LIST_PATHS = [(ANY, 'study_id')]
+METABOLIGHTS_DETAILS_PATHS = [
+    ('content', 'title'),
+    ('content', 'description'),
+    ('content', 'assays', ANY, 'assayNumber'),
+    ('content', 'assays', ANY, 'measurement'),
+    ('content', 'assays', ANY, 'technology'),
+    ('content', 'assays', ANY, 'platform'),
+    ('content', 'assays', ANY, 'fileName'),
+    ('content', 'assays', ANY, 'metaboliteAssignment', 'metaboliteAssignmentLines'),
+    ('content', 'assays', ANY, 'assayTable', 'fields'),
+    ('content', 'assays', ANY, 'assayTable', 'data', ANY),
+]
+
+_cache = create_cache(CACHE_BACKEND, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                      sqlite_path=SHARED_CACHE_PATH)
+
+
+def _make_cache_key(func, args, kwargs) -> str:
+    """
+    Builds a cache key from the function name and its arguments, skipping HTTP sessions
+    (their repr is unique per object and would defeat the cache).
+    """
+    args_key = [repr(arg) for arg in args if not isinstance(arg, requests.Session)]
+    kwargs_key = [f"{name}={value!r}" for name, value in sorted(kwargs.items())
+                  if not isinstance(value, requests.Session)]
+    return f"{func.__module__}.{func.__qualname__}:{','.join(args_key)}:{','.join(kwargs_key)}"
+
+
+def _is_negative_result(result) -> bool:
+    """
+    Checks whether a result is empty or an (data, HTTP status code) pair reporting an error.
+    """
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int):
+        return result[1] >= 400 or not result[0]
+    return not result
 
 
-def cached(expiry=CACHE_EXPIRY):
+def cached(expiry=CACHE_EXPIRY, negative_expiry=NEGATIVE_CACHE_EXPIRY, error_expiry=ERROR_CACHE_EXPIRY):
     """
     Decorator to cache function results with a specified expiry time.
+    Concurrent calls with the same arguments share a single call of the function. Results are kept in the
+    cache backend selected with METABOLOMICS_CACHE_BACKEND (in each process by default), so the cached
+    values must be picklable to be shared between processes.
+    The decorated function's `is_cached(*args, **kwargs)` tells whether a call would be answered from the cache.
     :param expiry: the lifetime of the cache in seconds
+    :param negative_expiry: the lifetime of empty or error-code results in seconds
+    :param error_expiry: the lifetime of raised exceptions in seconds
     :return: a decorator that caches the function's result
     """
 
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            key = f"{func.__name__}:{str(args)}:{str(kwargs)}"
+            key = _make_cache_key(func, args, kwargs)
+            return _cache.get_or_load(
+                key,
+                lambda: func(*args, **kwargs),
+                ttl=expiry,
+                negative_ttl=negative_expiry,
+                error_ttl=error_expiry,
+                is_negative=_is_negative_result
+            )
+
+        wrapper.is_cached = lambda *args, **kwargs: _make_cache_key(func, args, kwargs) in _cache
+        return wrapper
 
-            if key in _cache:
-                result, timestamp = _cache[key]
-                if time.time() - timestamp < expiry:
-                    return result
+    return decorator
 
-            result = func(*args, **kwargs)
-            _cache[key] = (result, time.time())
-            return result
 
-        return wrapper
+def load_shared(key: str, loader, ttl: float):
+    """
+    Calls the loader once for all the worker processes sharing the cache backend: its result is kept for ttl
+    seconds and reused by the other processes. Empty results are not shared. With the in-process backend,
+    the loader is simply called.
+    :param key: identifies the loaded value across the processes
+    :param loader: callable without arguments
+    :param ttl: number of seconds the result is shared
+    :return: the result of the loader, possibly loaded by another process
+    """
+    if not _cache.shared:
+        return loader()
+    return _cache.get_or_load(f"shared:{key}", loader, ttl=ttl, negative_ttl=0, is_negative=_is_negative_result)
 
-    return decorator
+
+def cache_stats() -> dict:
+    """
+    Returns hit/miss/eviction counters of the cache used by the `cached` decorator.
+    :return: a dictionary of cache counters
+    """
+    return _cache.stats()
+
+
+def payload_is_fresh(stored, max_age: float = PAYLOAD_MAX_AGE) -> bool:
+    """
+    :param stored: a stored payload or None
+    :return: True if the payload can be used without revalidation
+    """
+    return stored is not None and stored.is_fresh(max_age)
+
+
+def revalidation_headers(stored) -> dict:
+    """
+    :param stored: a stored payload or cached file (with its validators) or None
+    :return: the If-None-Match/If-Modified-Since headers revalidating it with the upstream
+    """
+    headers = {}
+    if stored is not None:
+        if stored.etag:
+            headers['If-None-Match'] = stored.etag
+        if stored.last_modified:
+            headers['If-Modified-Since'] = stored.last_modified
+    return headers
+
+
+def conditional_get(url: str, api_session: requests.Session, max_age: float = PAYLOAD_MAX_AGE):
+    """
+    Fetches an upstream payload through the persistent payload store.
+    A fresh stored copy is returned without a request; a stale one is revalidated with
+    If-None-Match/If-Modified-Since, so an unchanged payload costs a 304 instead of a full body.
+    If the upstream fails (or its circuit is open), a stale stored copy is served instead of the error.
+    :param url: upstream url
+    :param api_session: current session
+    :param max_age: number of seconds a stored payload is used without revalidation
+    :return: the stored payload (or None) and the HTTP status code
+    """
+    stored = payload_store.get(url)
+    if payload_is_fresh(stored, max_age):
+        return stored, 200
+
+    try:
+        response = api_session.get(url, headers=revalidation_headers(stored), stream=True)
+        with closing(response):
+            if response.status_code == 304 and stored is not None:
+                return payload_store.touch(stored), 200
+            if response.ok:
+                # the body goes straight to disk, it is never held in memory as a whole
+                body = response.iter_content(JSON_CHUNK_SIZE)
+                with phase('upstream_body'):
+                    return payload_store.put(url, body, getattr(response, 'headers', None)), 200
+    except requests.exceptions.RequestException:
+        if stored is None:
+            raise
+        logger.error(f"Connection error occurred, serving stale payload for {url}")
+        return stored, 200
+
+    if stored is not None and response.status_code >= 500:
+        logger.error(f"Upstream error {response.status_code}, serving stale payload for {url}")
+        return stored, 200
+    return None, response.status_code
+
+
+def guarded_conditional_get(url: str, api_session: requests.Session, max_age: float = PAYLOAD_MAX_AGE):
+    """
+    Same as `conditional_get`, but a connection error or timeout is logged and reported as the HTTP status code 500.
+    :return: the stored payload (or None) and the HTTP status code
+    """
+    try:
+        return conditional_get(url, api_session, max_age=max_age)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Connection error occurred: {e}")
+        return None, 500
+
+
+def run_concurrently(*calls):
+    """
+    Runs independent calls (usually upstream requests) at the same time,
+    so a page that needs several of them waits for the slowest one instead of their sum.
+    :param calls: callables without arguments
+    :return: a list of the results in the order of the calls; an exception raised by a call is re-raised
+             after all calls have finished
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(bind(call)) for call in calls]
+    return [future.result() for future in futures]
 
 
 @cached()
@@ -49,24 +227,19 @@ def fetch_study_list(api_url: str, source: str, api_session: requests.Session):
     logger.info(f"Fetching study list from {source} (URL: {api_url})")
 
     # process the response based on the source
-    def process_response(content, is_ok, source):
+    def process_response(response, source):
         study_lst = []
-        if not is_ok or not content:
-            return []
-
         try:
             if source == 'metabolights':
-                import json
-                json_data = json.loads(content)
-                study_lst = json_data.get('content', [])
+                chunks = response.iter_content(JSON_CHUNK_SIZE)
+                study_lst = [study for _, study in iter_values(chunks, METABOLIGHTS_STUDY_LIST_PATHS)]
             elif source == 'workbench':
-                import json
-                json_data = json.loads(content)
-                study_lst = [study['study_id'] for study in json_data.values() if 'study_id' in study]
+                # only the study ids are decoded from the summary of all studies
+                chunks = response.iter_content(JSON_CHUNK_SIZE)
+                study_lst = [study for _, study in iter_values(chunks, WORKBENCH_STUDY_LIST_PATHS)]
             elif source == 'metabobank':
-                soup = BeautifulSoup(content, "html.parser")
-                for link in soup.find_all("a"):
-                    href = link.get("href")
+                for entry in parse_autoindex(response.text):
+                    href = entry.href
                     if href and href.endswith("/"):
                         if href.startswith('MTBK'):
                             study_lst.append(href.strip("/"))
@@ -75,51 +248,175 @@ def fetch_study_list(api_url: str, source: str, api_session: requests.Session):
             logger.error(f"Error processing response from {source}: {e}")
             return []
 
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(lambda: api_session.get(api_url))
-        try:
-            response = future.result(timeout=30)
-            if response.ok:
-                return process_response(response.text, True, source)
-        except Exception as e:
-            logger.info(f"Async fetch failed: {e}")
-
     try:
-        response = api_session.get(api_url)
-        if response.ok:
-            return process_response(response.text, True, source)
-    except Exception as e:
-        logger.info(f"Sync fetch failed: {e}")
+        response = api_session.get(api_url, stream=True)
+        with closing(response):
+            if response.ok:
+                return process_response(response, source)
+            logger.info(f"Fetching study list from {source} failed: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        logger.info(f"Fetching study list from {source} failed: {e}")
 
     return []
 
 
-def metabolights_get_study_details(study_id: str, api_session: requests.Session):
+def metabolights_parse_study_content(chunks) -> dict:
+    """
+    Incrementally extracts the fields used by `metabolights_fetch_metadata_and_raw_files` from a MetaboLights
+    study document. Assay table rows are reduced to their file cells as soon as they are decoded, so the
+    memory needed does not grow with the size of the sample and assay tables.
+    :param chunks: iterable of chunks of the study document
+    :return: the 'content' of the study, limited to title, description and the assay fields
+    """
+    content = {'assays': []}
+    file_columns = {}
+    for path, value in iter_values(chunks, METABOLIGHTS_DETAILS_PATHS):
+        if path[1] != 'assays':
+            content[path[1]] = value
+            continue
+
+        index, field = path[2], path[3]
+        assays = content['assays']
+        while len(assays) <= index:
+            assays.append({'assayTable': {'data': []}})
+        if field == 'assayTable' and path[4] == 'fields':
+            file_columns[index] = header_file_columns(value)
+        elif field == 'assayTable':
+            # only the file columns are kept if the header came first, otherwise the file cells of the row
+            columns = file_columns.get(index)
+            cells = [value[i] for i in columns if i < len(value)] if columns else value
+            assays[index]['assayTable']['data'].append(
+                [el for el in cells if isinstance(el, str) and el.startswith(FILES_PREFIX)])
+        elif field == 'metaboliteAssignment':
+            assays[index]['metaboliteAssignment'] = {'metaboliteAssignmentLines': value}
+        else:
+            assays[index][field] = value
+    return content
+
+
+def metabolights_get_study_details(study_id: str, api_session: requests.Session, streaming: bool = JSON_STREAMING):
     """
     Fetches study details from MetaboLights for the given study.
     :param study_id: current study id
     :param api_session: current session
+    :param streaming: extract only the needed fields while reading the document instead of loading all of it
     :return: a dictionary of the study data and the HTTP status code
     """
 
-    study_url = f"https://www.ebi.ac.uk/metabolights/ws/studies/public/study/{study_id}"
+    study_url = METABOLIGHTS_STUDY_URL.format(study_id=study_id)
 
     try:
-        response = api_session.get(study_url)
-    except requests.exceptions.ConnectionError as e:
+        payload, resp_code = conditional_get(study_url, api_session)
+    except requests.exceptions.RequestException as e:
         logger.error(f"Connection error occurred: {e}")
         return {}, 500
 
-    if response.ok:
-        return response.json()['content'], 200
+    if resp_code == 200:
+        with phase('json_decode'):
+            if not streaming:
+                return payload.json()['content'], 200
+            with payload.open() as f:
+                return metabolights_parse_study_content(iter_file_chunks(f)), 200
+    else:
+        return {}, resp_code
+
+
+def header_file_columns(fields) -> list:
+    """
+    Resolves the file columns of an assay table from its header: in ISA-Tab assay tables the
+    'FILES/...' cells are usually the values of the '... File' columns (raw, derived, metabolite assignment etc.).
+    :param fields: the 'fields' of an assay table, a dictionary or a list of column descriptions or headers
+    :return: the sorted indexes of the file columns (empty if the header has none)
+    """
+    if isinstance(fields, dict):
+        fields = list(fields.values())
+    if not isinstance(fields, list):
+        return []
+
+    columns = []
+    for position, field in enumerate(fields):
+        if isinstance(field, dict):
+            index, header = field.get('index', position), field.get('header') or ''
+        else:
+            index, header = position, str(field)
+        if isinstance(index, int) and 'file' in header.lower():
+            columns.append(index)
+    return sorted(columns)
+
+
+def _content_file_columns(rows: list, skip=()) -> list:
+    """
+    Finds the columns of an assay table that contain at least one 'FILES/' cell,
+    with a single join and substring search per column instead of a call per cell.
+    :param rows: rows of a rectangular assay table of strings
+    :param skip: indexes of columns not to search
+    :return: the indexes of the file columns
+    """
+    return [i for i, column in enumerate(zip(*rows))
+            if i not in skip and f'\n{FILES_PREFIX}' in '\n' + '\n'.join(column)]
+
+
+def extract_raw_file_names(rows: list, mode: str = 'rows', fields=None) -> list:
+    """
+    Extracts the raw data file names from the rows of an assay table.
+    The file columns are resolved once per table, so only those columns are scanned row by row: the '... File'
+    columns of the header, and the other columns containing 'FILES/' cells (all of them without a header).
+    :param rows: rows of the assay table ('FILES/...' cells name raw data files)
+    :param mode: 'rows' - a list of file names per row; 'flat' - all file names in table order;
+                 'unique' - like 'flat', without repeated file names
+    :param fields: the header of the assay table
+    :return: a list of lists of file names ('rows') or a list of file names
+    """
+    if mode not in RAW_FILE_MODES:
+        raise ValueError(f"Unknown raw file mode: {mode}")
+    if not rows:
+        return []
+
+    prefix_len = len(FILES_PREFIX)
+    width = len(rows[0])
+    columns = None
+    if all(len(row) == width for row in rows) and all(isinstance(el, str) for el in rows[0]):
+        header_columns = {i for i in header_file_columns(fields) if i < width}
+        try:
+            # 'FILES/' cells are also kept in columns whose header does not name a file
+            columns = sorted(header_columns.union(_content_file_columns(rows, skip=header_columns)))
+        except TypeError:
+            # cells that are not text
+            columns = None
+
+    if columns is None:
+        raw_data_lst = [[el[prefix_len:] for el in row if isinstance(el, str) and el.startswith(FILES_PREFIX)]
+                        for row in rows]
+    elif not columns:
+        raw_data_lst = [[] for _ in rows]
     else:
-        return {}, response.status_code
+        pick = itemgetter(*columns) if len(columns) > 1 else lambda row: (row[columns[0]],)
+        raw_data_lst = [[el[prefix_len:] for el in cells if isinstance(el, str) and el.startswith(FILES_PREFIX)]
+                        for cells in map(pick, rows)]
+
+    return reshape_raw_file_names(raw_data_lst, mode)
 
 
-def metabolights_fetch_metadata_and_raw_files(assays_content: dict):
+def reshape_raw_file_names(raw_data_lst: list, mode: str) -> list:
+    """
+    :param raw_data_lst: raw data file names per assay table row
+    :param mode: 'rows', 'flat' or 'unique', see `extract_raw_file_names`
+    :return: the file names in the given shape
+    """
+    if mode not in RAW_FILE_MODES:
+        raise ValueError(f"Unknown raw file mode: {mode}")
+    if mode == 'rows':
+        return raw_data_lst
+    file_names = chain.from_iterable(raw_data_lst)
+    return list(dict.fromkeys(file_names)) if mode == 'unique' else list(file_names)
+
+
+@timed('extract')
+def metabolights_fetch_metadata_and_raw_files(assays_content: dict, raw_files_mode: str = 'rows'):
     """
     Extracts metadata and raw file names from the study content returned by MetaboLights.
     :param assays_content: a dictionary containing study data from MetaboLights
+    :param raw_files_mode: shape of the raw file names of each assay, see `extract_raw_file_names`
     :return: a dictionary with the study title, description, and a list of assays with their metadata and raw file names
     """
 
@@ -152,11 +449,10 @@ def metabolights_fetch_metadata_and_raw_files(assays_content: dict):
             assays_el_data[number]['reported_metabolite_names'] = reported_metabolite_names
         
         # c. raw data file names
-        assays_data = assays_el['assayTable']['data']
-        raw_data_lst = []
-        for assays_info in assays_data:
-            raw_data_lst.append([el[len('FILES/'):] for el in assays_info if el.startswith('FILES/')])
-        assays_el_data[number]['raw_data_file_names'] = raw_data_lst
+        assay_table = assays_el['assayTable']
+        assays_el_data[number]['raw_data_file_names'] = extract_raw_file_names(assay_table['data'],
+                                                                               mode=raw_files_mode,
+                                                                               fields=assay_table.get('fields'))
         
         assays_lst_data.append(assays_el_data)
         
@@ -165,6 +461,24 @@ def metabolights_fetch_metadata_and_raw_files(assays_content: dict):
     return result_data
 
 
+def metabolights_result_files_request(study_id: str, api_token: str) -> dict:
+    """
+    :param study_id: current study id
+    :param api_token: current api token
+    :return: the keyword arguments of the upstream GET request listing the result files of a MetaboLights study
+    """
+    return {
+        'url': METABOLIGHTS_RESULT_FILES_URL.format(study_id=study_id),
+        'json': {
+            'study_id': study_id,
+            'user_token': api_token
+        },
+        'headers': {
+            "Content-Type": "application/json"
+        }
+    }
+
+
 def metabolights_fetch_result_files(study_id: str, api_token: str, api_session: requests.Session):
     """
     Fetches the list of result files for a given MetaboLights study.
@@ -175,20 +489,9 @@ def metabolights_fetch_result_files(study_id: str, api_token: str, api_session:
     :return: list of the result files (or an empty list) and the HTTP status code
     """
 
-    url = f"https://www.ebi.ac.uk/metabolights/ws/studies/{study_id}/files?include_raw_data=false"
-
-    request_data = {
-        'study_id': study_id,
-        'user_token': api_token
-    }
-
-    headers = {
-        "Content-Type": "application/json"
-    }
-
     try:
-        response = api_session.get(url, json=request_data, headers=headers)
-    except requests.exceptions.ConnectionError as e:
+        response = api_session.get(**metabolights_result_files_request(study_id=study_id, api_token=api_token))
+    except requests.exceptions.RequestException as e:
         logger.error(f"Connection error occurred: {e}")
         return [], 500
 
@@ -208,26 +511,22 @@ def metabolomics_workbench_get_study_details(study_id: str, api_session: request
     :return: dictionary with study details and the HTTP status code
     """
 
-    study_url = f"https://www.metabolomicsworkbench.org/rest/study/study_id/{study_id}/summary"
+    study_url = WORKBENCH_SUMMARY_URL.format(study_id=study_id)
+    metabolites_url = WORKBENCH_METABOLITES_URL.format(study_id=study_id)
 
-    try:
-        response = api_session.get(study_url)
-    except requests.exceptions.ConnectionError as e:
-        logger.error(f"Connection error occurred: {e}")
-        return {}, 500
+    # both requests are independent: issue them together, then check the summary first
+    (payload, resp_code), (metabolites_payload, metabolites_resp_code) = run_concurrently(
+        lambda: guarded_conditional_get(study_url, api_session),
+        lambda: guarded_conditional_get(metabolites_url, api_session)
+    )
 
-    if response.ok:
-        study_info_data = response.json()
-
-        metabolites_url = f"https://www.metabolomicsworkbench.org/rest/study/study_id/{study_id}/metabolites"
-        try:
-            metabolites_response = api_session.get(metabolites_url)
-        except requests.exceptions.ConnectionError as e:
-            logger.error(f"Connection error occurred: {e}")
-            return {}, 500
+    if resp_code == 200:
+        with phase('json_decode'):
+            study_info_data = payload.json()
 
-        if metabolites_response.ok:
-            metabolites_data = metabolites_response.json()
+        if metabolites_resp_code == 200:
+            with phase('json_decode'):
+                metabolites_data = metabolites_payload.json()
             if metabolites_data:
                 assays_lst_data = []
                 if all(key.isdigit() for key in metabolites_data.keys()):
@@ -258,81 +557,131 @@ def metabolomics_workbench_get_study_details(study_id: str, api_session: request
 
             return study_info_data, 200
         else:
-            return {}, metabolites_response.status_code
+            return {}, metabolites_resp_code
     else:
-        return {}, response.status_code
+        return {}, resp_code
 
 
-def metabobank_fetch_result_and_raw_files(study_id: str, api_session: requests.Session):
+def metabobank_get_directories(url: str, api_session: requests.Session):
     """
-    Fetches lists of result files and raw data files for a given Metabobank study.
-    :param study_id: current study id
+    Fetches an Apache directory listing of the Metabobank FTP mirror.
+    :param url: url of the directory (with a trailing slash)
     :param api_session: current session
-    :return: A tuple containing a pair of lists
-             ([list of result files], [list of raw files]) and the HTTP status code
+    :return: list of the entries of the directory (or an empty list) and the HTTP status code
     """
+    directories = []
+
+    payload, resp_code = conditional_get(url, api_session)
+    if resp_code != 200:
+        return [], resp_code
+
+    with payload.open() as f:
+        for entry in iter_autoindex(f):
+            if entry.href:
+                directories.append(entry.href.strip("/"))
+
+    return directories, 200
 
-    def get_directories(url: str):
-        directories = []
-
-        response = api_session.get(url)
-        if response.status_code != 200:
-            return [], response.status_code
-
-        soup = BeautifulSoup(response.text, "lxml")
-        for link in soup.find_all("a"):
-            href = link.get("href")
-            if href:
-                directories.append(href.strip("/"))
-
-        return directories, 200
-
-    def get_result_files(url: str):
-        results_files, _ = get_directories(url=f"{url}OtherData/")
-        results_files = [f"{url}OtherData/{el}" for el in results_files if el.endswith('txt')]
-        return results_files
-
-    def get_raw_files(url: str):
-        raw_files, _ = get_directories(url=f"{url}Rawdata/")
-        if len(raw_files) == 0:
-            raw_files, _ = get_directories(url=f"{url}rawdata/")
-        raw_files_lst = [el for el in raw_files if el.endswith('cdf') or el.endswith('zip')]
-        if len(raw_files_lst) == 0:
-            for dir in raw_files:
-                batch, _ = get_directories(url=f"{base_url}Rawdata/{dir}/")
-                raw_files_lst += [el for el in batch if el.endswith('cdf') or el.endswith('zip')]
-        return raw_files_lst
-
-    def get_raw_result_files(url: str):
-        directories, resp_code = get_directories(url=url)
-        results_files = []
-        raw_files = []
-
-        if 'OtherData' in directories:
-            results_files = get_result_files(url=url)
-        if 'Rawdata' in directories:
-            raw_files = get_raw_files(url=url)
-        else:
-            results_files = [f"{url}{el}" for el in directories if el.endswith('txt')]
-            if 'raw' in directories:
-                raw_files = get_raw_files(url=f"{url}raw/")
 
-        return directories, results_files, raw_files, resp_code
+def _is_raw_file(name: str) -> bool:
+    return name.endswith('cdf') or name.endswith('zip')
 
-    base_url = f"https://ddbj.nig.ac.jp/public/metabobank/study/{study_id}/"
 
-    directories, results_files, raw_files, resp_code = get_raw_result_files(url=base_url)
+def metabobank_crawl_steps(study_id: str):
+    """
+    Describes the crawl of a Metabobank study directory tree independently of how listings are fetched.
+    The generator yields lists of directory urls to fetch and is sent back a dictionary
+    {url: (entries, HTTP status code)} containing (at least) those listings; all listings of one step
+    are independent and can be fetched concurrently.
+    The crawl visits the study root and every E* experiment directory, takes result files from OtherData/
+    (or *.txt files of the directory itself if there is no Rawdata/) and raw files from Rawdata/
+    (falling back to rawdata/ and to Rawdata/<batch>/ subdirectories).
+    :param study_id: current study id
+    :return: (via StopIteration) a tuple ([list of result files], [list of raw files]) and the HTTP status code
+    """
 
-    e_directories = [el for el in directories if el.startswith('E')]
-    for e_dir in e_directories:
-        url = f"{base_url}{e_dir}/"
-        _, e_results_files, e_raw_files, e_resp_code = get_raw_result_files(url=url)
-        results_files += e_results_files
-        raw_files += e_raw_files
+    base_url = METABOBANK_STUDY_URL.format(study_id=study_id)
+
+    listings = yield [base_url]
+    directories, resp_code = listings[base_url]
+
+    targets = [base_url] + [f"{base_url}{el}/" for el in directories if el.startswith('E')]
+    listings = yield targets[1:]
+
+    # result files come from OtherData/ only if the directory also has Rawdata/,
+    # raw files from <dir>/Rawdata/ or <dir>/raw/Rawdata/
+    other_data_urls = {}
+    raw_urls = {}
+    for url in targets:
+        url_directories = listings[url][0]
+        if 'Rawdata' in url_directories:
+            if 'OtherData' in url_directories:
+                other_data_urls[url] = f"{url}OtherData/"
+            raw_urls[url] = url
+        elif 'raw' in url_directories:
+            raw_urls[url] = f"{url}raw/"
+    listings = yield list(other_data_urls.values()) + [f"{raw_url}Rawdata/" for raw_url in raw_urls.values()]
+
+    raw_listings = {url: listings[f"{raw_url}Rawdata/"][0] for url, raw_url in raw_urls.items()}
+    fallback_urls = {url: f"{raw_urls[url]}rawdata/" for url, raw_files in raw_listings.items() if not raw_files}
+    listings = yield list(fallback_urls.values())
+    for url, fallback_url in fallback_urls.items():
+        raw_listings[url] = listings[fallback_url][0]
+
+    # no raw files at the top level: look one level down into the batch directories
+    batch_urls = {url: [f"{base_url}Rawdata/{el}/" for el in raw_files]
+                  for url, raw_files in raw_listings.items() if not any(_is_raw_file(el) for el in raw_files)}
+    listings = yield [batch_url for urls in batch_urls.values() for batch_url in urls]
+
+    results_files = []
+    raw_files = []
+    for url in targets:
+        if url in other_data_urls:
+            results_files += [f"{url}OtherData/{el}" for el in listings[other_data_urls[url]][0] if el.endswith('txt')]
+        elif 'Rawdata' not in listings[url][0]:
+            results_files += [f"{url}{el}" for el in listings[url][0] if el.endswith('txt')]
+        if url in batch_urls:
+            for batch_url in batch_urls[url]:
+                raw_files += [el for el in listings[batch_url][0] if _is_raw_file(el)]
+        elif url in raw_listings:
+            raw_files += [el for el in raw_listings[url] if _is_raw_file(el)]
 
     return (results_files, raw_files), resp_code
 
 
+@timed('crawl')
+def metabobank_fetch_result_and_raw_files(study_id: str, api_session: requests.Session,
+                                          max_workers: int = METABOBANK_CRAWL_WORKERS):
+    """
+    Fetches lists of result files and raw data files for a given Metabobank study.
+    Independent directory listings are fetched concurrently by a bounded pool of threads.
+    :param study_id: current study id
+    :param api_session: current session
+    :param max_workers: maximum number of listings fetched at the same time
+    :return: A tuple containing a pair of lists
+             ([list of result files], [list of raw files]) and the HTTP status code
+    """
+
+    crawl = metabobank_crawl_steps(study_id=study_id)
+    listings = {}
+
+    @bind
+    def get_directories(url: str):
+        return metabobank_get_directories(url=url, api_session=api_session)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            urls = next(crawl)
+            while True:
+                pending = [url for url in dict.fromkeys(urls) if url not in listings]
+                METABOBANK_CRAWL_REQUESTS.inc(len(pending))
+                listings.update(zip(pending, executor.map(get_directories, pending)))
+                urls = crawl.send(listings)
+        except StopIteration as stop:
+            METABOBANK_CRAWL_LISTINGS.observe(len(listings))
+            return stop.value
+
+
 def metabobank_get_study_details(study_id: str, api_session: requests.Session):
     """
     Fetches study details from Metabobank, including lists of result files and raw data files.